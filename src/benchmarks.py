@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+Benchmarks for the data loading and processing code, run against synthetic data so they
+don't need the real observations.
+
+python benchmarks.py decode --samples 1000000
+python benchmarks.py downsample --factor 4
+python benchmarks.py spectra
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy as np
+from scipy import signal
+
+from downsample import decimation_stages, downsample
+from lba import LBAFile, MARKER_INTERVAL, VAL_MAP
+from spectral import Spectra, lombscargle
+
+# The 1 second of samples plots.py reads from each file
+SAMPLES_PER_SECOND = 1919999940 // 2048
+
+
+def write_lba(filename, num_samples, header_size=4096, seed=0):
+    """
+    Write a synthetic 4 frequency, 2 polarisation, 2 bit LBA file with random samples
+    and a 65535 marker every MARKER_INTERVAL samples.
+    :param filename: File to write to
+    :param num_samples: Number of 16 bit samples to write, including markers
+    :param header_size: Size of the header in bytes
+    :param seed: Random seed for the samples
+    """
+    header = "NCHAN 8\nNUMBITS 2\nBANDWIDTH 16\nHEADERSIZE {0}\nEND\n".format(header_size).encode("utf-8")
+    words = np.random.RandomState(seed).randint(0, 65536, num_samples).astype(np.uint16)
+    words[::MARKER_INTERVAL] = 65535
+    with open(filename, "wb") as f:
+        f.write(header.ljust(header_size, b"\0"))
+        f.write(words.tobytes())
+
+
+def read_loop(lba, offset, samples):
+    """
+    The original one sample at a time decoder for LBAFile.read, kept as a reference
+    for checking and timing the vectorised decoder.
+    """
+    num_freq = int(lba.header["NCHAN"]) // 2
+    num_bits = int(lba.header["NUMBITS"])
+    num_freq_bits = num_bits * 2
+    bytes_per_sample = lba.bytes_per_sample
+    freq_mask = (1 << num_freq_bits) - 1
+    sample_mask = (1 << num_bits) - 1
+
+    lba.mm.seek(int(lba.header["HEADERSIZE"]) + offset * bytes_per_sample, os.SEEK_SET)
+    nparray = np.zeros((samples, num_freq, 2), dtype=np.int8)
+    samples_output = 0
+    samples_read = 0
+    while True:
+        intdata = int.from_bytes(lba.mm.read(bytes_per_sample), byteorder=sys.byteorder)
+        if (samples_read + offset) % MARKER_INTERVAL != 0:
+            for frequency in range(num_freq):
+                freqdata = intdata >> frequency * num_freq_bits & freq_mask
+                nparray[samples_output][frequency][0] = VAL_MAP[freqdata & sample_mask]
+                nparray[samples_output][frequency][1] = VAL_MAP[freqdata >> num_bits & sample_mask]
+            samples_output += 1
+            if samples_output == samples:
+                break
+        samples_read += 1
+    return nparray
+
+
+def time_call(function, *args, **kwargs):
+    """
+    :return: Tuple of the function's result and the time it took in seconds
+    """
+    start = default_timer()
+    result = function(*args, **kwargs)
+    return result, default_timer() - start
+
+
+def benchmark_decode(samples, loop_samples, workers, **kwargs):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "benchmark.lba")
+        write_lba(filename, samples + 1)
+        with open(filename, "r") as f:
+            lba = LBAFile(f)
+            expected, loop_time = time_call(read_loop, lba, 0, loop_samples)
+            decoded, decode_time = time_call(lba.read, 0, samples)
+            if not np.array_equal(expected, decoded[:loop_samples]):
+                raise Exception("Vectorised decoder output does not match the reference decoder")
+            parallel_times = []
+            for num_workers in workers:
+                parallel, parallel_time = time_call(lba.read, 0, samples, workers=num_workers)
+                if not np.array_equal(decoded, parallel):
+                    raise Exception("Parallel decoder output does not match the single threaded decoder")
+                parallel_times.append(parallel_time)
+            del lba, decoded, parallel
+
+    print("Reference loop: {0:>14,.0f} samples/s ({1} samples)".format(loop_samples / loop_time, loop_samples))
+    print("LBAFile.read:   {0:>14,.0f} samples/s ({1} samples)".format(samples / decode_time, samples))
+    for num_workers, parallel_time in zip(workers, parallel_times):
+        print("{0:>2} workers:     {1:>14,.0f} samples/s".format(num_workers, samples / parallel_time))
+
+
+def benchmark_downsample(samples, factor, chunk_samples, **kwargs):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "benchmark.lba")
+        output_file = os.path.join(directory, "benchmark.npy")
+        write_lba(filename, samples + 1)
+        with open(filename, "r") as f:
+            lba = LBAFile(f)
+            data = lba.read(0, samples).astype(np.float64)
+            # The original tool's output, from the default zero phase IIR filter
+            baseline, baseline_time = time_call(signal.decimate, data, factor, axis=0)
+            # The streaming downsampler cascades large factors, so decimate the same FIR stages in one shot to check it
+            expected = data
+            for stage in decimation_stages(factor):
+                expected = signal.decimate(expected, stage, ftype='fir', axis=0)
+            _, streaming_time = time_call(downsample, lba, output_file, factor, chunk_samples=chunk_samples)
+            streamed = np.load(output_file)
+            error = np.abs(streamed - expected).max()
+            # The filters differ, so compare the size of the difference to the size of the signal
+            baseline_difference = np.sqrt(np.mean((streamed - baseline) ** 2) / np.mean(baseline ** 2))
+            del lba, data
+
+    print("One shot IIR decimate (original): {0:>14,.0f} samples/s".format(samples / baseline_time))
+    print("Streaming FIR:                    {0:>14,.0f} samples/s (max difference from one shot FIR {1:.3g}, "
+          "relative RMS difference from original {2:.3g})".format(samples / streaming_time, error, baseline_difference))
+
+
+def spectra_loop(samples, sample_rate):
+    """
+    The spectral calls LBAPlotter made for each channel before Spectra, kept as a reference
+    for checking and timing it. mlab.psd is welch without detrending or overlap.
+    """
+    results = []
+    for channel in samples:
+        channel = channel.astype(np.float64)
+        results.append({
+            "spectrogram": signal.spectrogram(channel, fs=sample_rate, window=('tukey', 0.5), noverlap=128)[2],
+            "periodogram": signal.periodogram(channel, fs=sample_rate, window=('tukey', 0.5))[1],
+            "welch": signal.welch(channel, fs=sample_rate, window=('tukey', 0.5))[1],
+            "rfft": np.abs(np.fft.rfft(channel * signal.windows.tukey(channel.shape[0], sym=False))),
+            "ifft": np.imag(np.fft.fft(channel * signal.windows.tukey(channel.shape[0], sym=False))),
+            "psd": signal.welch(channel, fs=sample_rate, window=('tukey', 0.5), noverlap=0, detrend=False)[1]
+        })
+    return results
+
+
+def spectra_views(samples, sample_rate):
+    spectra = Spectra(samples, sample_rate)
+    return [{
+        "spectrogram": spectra.spectrogram(channel)[2],
+        "periodogram": spectra.periodogram(channel)[1],
+        "welch": spectra.welch(channel)[1],
+        "rfft": spectra.rfft(channel)[1],
+        "ifft": spectra.ifft(channel)[1],
+        "psd": spectra.psd(channel)[0]
+    } for channel in range(samples.shape[0])]
+
+
+def benchmark_spectra(samples, plotter, **kwargs):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "benchmark.lba")
+        write_lba(filename, samples + 1)
+        with open(filename, "r") as f:
+            data = LBAFile(f).read(0, samples)
+        data = data.reshape(samples, -1).T
+        sample_rate = 32000000
+
+        expected, loop_time = time_call(spectra_loop, data, sample_rate)
+        shared, shared_time = time_call(spectra_views, data, sample_rate)
+        error = max(np.abs(shared[channel][view] - expected[channel][view]).max() / np.abs(expected[channel][view]).max()
+                    for channel in range(len(expected)) for view in expected[channel])
+
+        print("Per channel calls: {0:>8.3f}s".format(loop_time))
+        print("Spectra:           {0:>8.3f}s (max relative difference {1:.3g})".format(shared_time, error))
+
+        if plotter:
+            # Imported here so the other benchmarks don't need matplotlib
+            from plots import LBAPlotter
+            _, plotter_time = time_call(LBAPlotter(filename, os.path.join(directory, "plots"), num_samples=samples))
+            print("LBAPlotter:        {0:>8.3f}s".format(plotter_time))
+
+
+def benchmark_lombscargle(samples, **kwargs):
+    sample_rate = 32000000
+    data = np.random.RandomState(0).randint(-3, 4, samples).astype(np.float64)
+    times = np.linspace(0, samples / sample_rate, samples)
+    freqs = np.linspace(0.001, 1.6e6, 1000) * 10
+
+    expected, scipy_time = time_call(signal.lombscargle, times, data, freqs, normalize=True)
+    fast, fast_time = time_call(lombscargle, times, data, freqs, normalize=True)
+
+    print("scipy:       {0:>8.3f}s".format(scipy_time))
+    print("lombscargle: {0:>8.3f}s (max difference {1:.3g})".format(fast_time, np.abs(fast - expected).max()))
+
+
+def benchmark_rfi_dataset(samples, batch_size, sequence_length, batches, **kwargs):
+    # Imported here so the other benchmarks don't need torch
+    from utilities import RfiDataset, create_data_loader
+
+    random = np.random.RandomState(0)
+    x_data = random.normal(size=samples)
+    labels = random.randint(0, 2, samples).astype(np.uint8)
+    dataset = RfiDataset(random.permutation(samples - sequence_length), x_data, labels, sequence_length)
+
+    for name, batch_loading in [("Per item", False), ("Batch", True)]:
+        loader = create_data_loader(dataset, batch_size, False, batch_loading)
+        start = default_timer()
+        for batch, _ in zip(loader, range(batches)):
+            pass
+        print("{0:<9} {1:>8.2f} batches/second".format(name + ":", batches / (default_timer() - start)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the data loading and processing code.")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    decode = subparsers.add_parser("decode", help="Decoding samples from an LBA file")
+    decode.add_argument('--samples', type=int, default=SAMPLES_PER_SECOND, help="Number of samples to decode")
+    decode.add_argument('--loop_samples', type=int, default=100000, help="Number of samples to decode with the reference loop")
+    decode.add_argument('--workers', type=int, nargs='*', default=[2, 4, 8], help="Numbers of threads to decode with in parallel")
+    decode.set_defaults(function=benchmark_decode)
+
+    downsample = subparsers.add_parser("downsample", help="Downsampling an LBA file")
+    downsample.add_argument('--samples', type=int, default=SAMPLES_PER_SECOND, help="Number of samples to downsample")
+    downsample.add_argument('--factor', type=int, default=4, help="Downsample factor")
+    downsample.add_argument('--chunk_samples', type=int, default=1024 * 1024, help="Number of samples to downsample at a time")
+    downsample.set_defaults(function=benchmark_downsample)
+
+    spectra = subparsers.add_parser("spectra", help="Spectral views for LBAPlotter")
+    spectra.add_argument('--samples', type=int, default=SAMPLES_PER_SECOND, help="Number of samples per channel")
+    spectra.add_argument('--plotter', action='store_true', help="Also time the whole LBAPlotter")
+    spectra.set_defaults(function=benchmark_spectra)
+
+    lomb = subparsers.add_parser("lombscargle", help="Lomb-Scargle periodogram for LBAPlotter")
+    lomb.add_argument('--samples', type=int, default=20000, help="Number of samples, scipy's memory use grows with samples * 1000")
+    lomb.set_defaults(function=benchmark_lombscargle)
+
+    rfi_dataset = subparsers.add_parser("rfi_dataset", help="Loading RfiDataset batches for training")
+    rfi_dataset.add_argument('--samples', type=int, default=1000000, help="Number of samples in the dataset")
+    rfi_dataset.add_argument('--batch_size', type=int, default=20000, help="Items per batch")
+    rfi_dataset.add_argument('--sequence_length', type=int, default=10, help="Elements in each item's window")
+    rfi_dataset.add_argument('--batches', type=int, default=5, help="Number of batches to load with each loader")
+    rfi_dataset.set_defaults(function=benchmark_rfi_dataset)
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    args.pop("function")(**args)
+
+
+if __name__ == "__main__":
+    main()
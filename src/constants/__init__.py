@@ -26,4 +26,4 @@
 
 NUMBER_CHANNELS = 1
 NUMBER_OF_CLASSES = 2
-H5_VERSION = '2017_10_16_001'
+H5_VERSION = '2026_10_17_002'
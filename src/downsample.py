@@ -22,38 +22,374 @@
 #
 
 """
-Reads an LBA file, downsamples it, and writes it out as a numpy array.
+Reads LBA files, downsamples them, and writes them out as numpy arrays.
+
+Each file is read and downsampled a chunk at a time, and written out as it goes,
+so a whole LBA file can be downsampled in constant memory.
+Large factors are split into a cascade of small decimation stages.
+
+The streaming filter is a causal FIR filter, so its output is not the same as this tool's
+original output, which came from signal.decimate's default zero phase IIR filter. --ftype iir
+gives the original output, but the filter runs both ways over the signal, so the whole
+selection of the file is read into memory.
+
+python downsample.py file.lba file.npy --factor 4
+python downsample.py "../data/*.lba" ../downsampled/ --factor 2048 --processes 8
+python downsample.py file.lba file.npy --factor 4 --ftype iir
 """
 import argparse
+import glob
+import json
+import logging
+import os
 import numpy as np
-import itertools
 from scipy import signal
-from lba import LBAFile
+from jobs import JobQueue
+from lba import LBAFile, check_range
+
+LOG = logging.getLogger(__name__)
+
+# Samples read from the LBA file and downsampled at a time
+CHUNK_SAMPLES = 1024 * 1024
+
+# Largest factor to decimate by in one stage. scipy recommends splitting factors larger than 13
+MAX_STAGE_FACTOR = 8
+
+# Extension of the sidecar file recording the parameters each output was downsampled with
+PARAMETERS_EXTENSION = ".json"
+
+# Decimation filters: the streaming FIR cascade, or the original one shot zero phase IIR filter
+FILTER_TYPES = ["fir", "iir"]
+
+
+class StreamingDecimator(object):
+    """
+    Decimates a signal a chunk at a time with the same FIR filter as signal.decimate(x, factor, ftype='fir'),
+    carrying the filter state between chunks so the whole signal never needs to be in memory.
+    The output matches the one shot signal.decimate(x, factor, ftype='fir') to within floating point error.
+    It does not match the default signal.decimate(x, factor), which is a zero phase IIR filter.
+
+    decimator = StreamingDecimator(4)
+    for chunk in chunks:
+        output.append(decimator.process(chunk))
+    output.append(decimator.flush())
+    """
+
+    def __init__(self, factor):
+        """
+        :param factor: Downsample factor
+        """
+        self.factor = factor
+        half_length = 10 * factor
+        self.taps = signal.firwin(2 * half_length + 1, 1. / factor, window='hamming')
+
+        # The filter delays the signal by half_length samples, decimate compensates by
+        # dropping that many samples from the start of the output.
+        self._skip = half_length // factor
+        # Input samples the filter needs from before each chunk, rounded up to a whole number of outputs
+        self._history_length = -(-(self.taps.shape[0] - 1) // factor) * factor
+        self._history = None
+        self._pending = None  # Input samples left over from the last chunk that didn't make a whole output
+        self._input_samples = 0
+        self._output_samples = 0
+
+    def _filter(self, chunk):
+        if self._history is None:
+            self._history = np.zeros((self._history_length,) + chunk.shape[1:])
+            self._pending = np.zeros((0,) + chunk.shape[1:])
+
+        data = np.concatenate((self._pending, chunk))
+        usable = data.shape[0] // self.factor * self.factor
+        buffer = np.concatenate((self._history, data[:usable]))
+        self._history = buffer[-self._history_length:]
+        self._pending = data[usable:]
+
+        # upfirdn only works out every factor'th output of the filter, which is all decimation needs.
+        # Output i is the filter at buffer[i * factor], so skip the ones inside the history.
+        first = self._history_length // self.factor
+        output = signal.upfirdn(self.taps, buffer, down=self.factor, axis=0)[first:first + usable // self.factor]
+
+        skip = min(self._skip, output.shape[0])
+        self._skip -= skip
+        return output[skip:]
+
+    def process(self, chunk):
+        """
+        Decimate the next chunk of the signal
+        :param chunk: ndarray with X = samples, and any number of channels on the other axes
+        :return: The decimated output that is ready, which lags the input by the filter delay
+        """
+        self._input_samples += chunk.shape[0]
+        output = self._filter(chunk.astype(np.float64))
+        self._output_samples += output.shape[0]
+        return output
+
+    def flush(self):
+        """
+        Finish the signal, as if it continued with zeros
+        :return: The rest of the decimated output
+        """
+        if self._history is None:
+            return np.zeros((0,))
+        total = -(-self._input_samples // self.factor)
+        zeros = np.zeros(((self._skip + 1) * self.factor + self._history_length,) + self._history.shape[1:])
+        output = self._filter(zeros)[:total - self._output_samples]
+        self._output_samples += output.shape[0]
+        return output
+
+
+def decimation_stages(factor, max_stage_factor=MAX_STAGE_FACTOR):
+    """
+    Split a downsample factor into stages that multiply to the factor, each no larger than max_stage_factor
+    where possible. Prime factors larger than max_stage_factor get a stage of their own.
+    decimation_stages(2048) == [8, 8, 8, 4], decimation_stages(1) == []
+    :param factor: Downsample factor
+    :param max_stage_factor: Largest factor for a single stage
+    :return: List of stage factors, largest first
+    """
+    primes = []
+    prime = 2
+    while factor > 1:
+        while factor % prime == 0:
+            primes.append(prime)
+            factor //= prime
+        prime += 1
+
+    stages = []
+    for prime in sorted(primes, reverse=True):
+        # Put each prime into the fullest stage that it still fits into
+        fits = [index for index, stage in enumerate(stages) if stage * prime <= max_stage_factor]
+        if fits:
+            index = max(fits, key=lambda i: stages[i])
+            stages[index] *= prime
+        else:
+            stages.append(prime)
+    return sorted(stages, reverse=True)
+
+
+class CascadedDecimator(object):
+    """
+    Decimates a signal a chunk at a time through a cascade of StreamingDecimators, one per stage.
+    Smaller stages need far shorter filters than one large stage, so are faster and more numerically stable.
+    The output is the same length as a single stage of the full factor.
+    """
+
+    def __init__(self, factor, max_stage_factor=MAX_STAGE_FACTOR):
+        """
+        :param factor: Downsample factor
+        :param max_stage_factor: Largest factor for a single stage
+        """
+        self.factor = factor
+        self.stages = [StreamingDecimator(stage) for stage in decimation_stages(factor, max_stage_factor)]
+
+    def process(self, chunk):
+        """
+        Decimate the next chunk of the signal
+        :param chunk: ndarray with X = samples, and any number of channels on the other axes
+        :return: The decimated output that is ready
+        """
+        for stage in self.stages:
+            chunk = stage.process(chunk)
+        return chunk
+
+    def flush(self):
+        """
+        Finish the signal, as if it continued with zeros
+        :return: The rest of the decimated output
+        """
+        output = None
+        for stage in self.stages:
+            if output is None:
+                output = stage.flush()
+            else:
+                # Push the end of the previous stage through before finishing this one
+                output = np.concatenate((stage.process(output), stage.flush()))
+        return output if output is not None else np.zeros((0,))
+
+
+def downsample(lba_file, output_file, factor, offset=0, samples=0, chunk_samples=CHUNK_SAMPLES, ftype="fir"):
+    """
+    Downsample part of an LBA file, writing it to a .npy file as it goes
+    :param lba_file: Opened LBAFile to read from
+    :param output_file: .npy file to write the downsampled X = samples, Y = frequencies(4), Z = polarisations(2) to
+    :param factor: Downsample factor
+    :param offset: Offset to read samples from
+    :param samples: Number of samples to read from the file, 0 for the rest of the file
+    :param chunk_samples: Samples to read and downsample at a time
+    :param ftype: "fir" to stream through the FIR cascade, or "iir" for the original signal.decimate output,
+                  which reads all of the samples into memory
+    """
+    if ftype not in FILTER_TYPES:
+        raise Exception("Unknown filter type {0}, expected one of {1}".format(ftype, FILTER_TYPES))
+    if not output_file.endswith(".npy"):
+        raise Exception("Output file {0} must end in .npy, as it is written in .npy format".format(output_file))
+    samples = check_range(offset, samples, lba_file.max_samples)
+    shape = (lba_file.num_freq, 2)
+    if ftype == "iir":
+        np.save(output_file, signal.decimate(lba_file.read(offset, samples).astype(np.float64), factor, axis=0))
+        return
+
+    output = np.lib.format.open_memmap(output_file, mode='w+', dtype=np.float64, shape=(-(-samples // factor),) + shape)
+
+    # All 8 channels are downsampled together as the columns of one 2D array
+    decimator = CascadedDecimator(factor)
+    position = 0
+    for chunk in lba_file.iter_chunks(chunk_samples, offset, samples):
+        decimated = decimator.process(chunk.reshape(chunk.shape[0], -1))
+        output[position:position + decimated.shape[0]] = decimated.reshape((-1,) + shape)
+        position += decimated.shape[0]
+    decimated = decimator.flush()
+    output[position:position + decimated.shape[0]] = decimated.reshape((-1,) + shape)
+    output.flush()
+
+
+def output_up_to_date(lba_filename, output_file, parameters):
+    """
+    :param lba_filename: LBA file the output comes from
+    :param output_file: Downsampled output
+    :param parameters: Parameters the output should have been downsampled with, as from DownsampleJob.parameters
+    :return: True if the output file exists, is newer than the LBA file it came from,
+             and its sidecar records the same parameters
+    """
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < os.path.getmtime(lba_filename):
+        return False
+    try:
+        with open(output_file + PARAMETERS_EXTENSION, 'r') as f:
+            return json.load(f) == parameters
+    except (OSError, ValueError):
+        return False
+
+
+class DownsampleJob(object):
+    """
+    Downsample one LBA file to a .npy file. The output is written to a temporary file and moved
+    into place once it is complete, so an interrupted job never leaves a partial output behind.
+    The parameters are written to a sidecar file after the output, so an output is only up to date
+    if it was made with the same parameters.
+    """
+
+    def __init__(self, lba_filename, output_file, factor, offset=0, samples=0, chunk_samples=CHUNK_SAMPLES, ftype="fir"):
+        self.lba_filename = lba_filename
+        self.output_file = output_file
+        self.factor = factor
+        self.offset = offset
+        self.samples = samples
+        self.chunk_samples = chunk_samples
+        self.ftype = ftype
+
+    @property
+    def parameters(self):
+        """
+        :return: dict of everything that changes the output
+        """
+        return {"lba_file": os.path.abspath(self.lba_filename), "factor": self.factor, "offset": self.offset,
+                "samples": self.samples, "ftype": self.ftype}
+
+    def __call__(self):
+        LOG.info("Downsampling {0} to {1}".format(self.lba_filename, self.output_file))
+        # Keep the .npy extension, so numpy doesn't add one
+        temporary_file = "{0}.{1}.tmp.npy".format(os.path.splitext(self.output_file)[0], os.getpid())
+        try:
+            with open(self.lba_filename, 'r') as f:
+                lba_file = LBAFile(f)
+                downsample(lba_file, temporary_file, self.factor, self.offset, self.samples, self.chunk_samples, self.ftype)
+            parameters_file = self.output_file + PARAMETERS_EXTENSION
+            if os.path.exists(parameters_file):
+                os.remove(parameters_file)
+            os.replace(temporary_file, self.output_file)
+            with open(parameters_file, 'w') as f:
+                json.dump(self.parameters, f)
+        finally:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+
+
+def expand_filenames(patterns):
+    """
+    Expand a list of filenames and glob patterns
+    :param patterns: Filenames or glob patterns
+    :return: Sorted list of the files they match
+    """
+    filenames = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern)
+        if not matches:
+            raise Exception("No files match {0}".format(pattern))
+        filenames.update(matches)
+    return sorted(filenames)
+
+
+def create_jobs(lba_files, output, factor, offset=0, samples=0, chunk_samples=CHUNK_SAMPLES, ftype="fir", force=False):
+    """
+    Create a DownsampleJob for each LBA file that doesn't already have an up to date output.
+    :param lba_files: LBA filenames or glob patterns
+    :param output: Output .npy file for a single LBA file, or a directory to write outputs to.
+                   Outputs in a directory are named after the LBA file and factor, e.g. file_x2048.npy
+                   Each output's parameters are recorded in a sidecar, file_x2048.npy.json
+    :param ftype: Decimation filter, "fir" or "iir" as for downsample
+    :param force: Downsample files even if their outputs are up to date, i.e. newer than the LBA file
+                  and made with the same parameters
+    :return: List of DownsampleJobs
+    """
+    lba_filenames = expand_filenames(lba_files)
+    if len(lba_filenames) > 1 or os.path.isdir(output):
+        os.makedirs(output, exist_ok=True)
+        output_files = [os.path.join(output, "{0}_x{1}.npy".format(os.path.splitext(os.path.basename(filename))[0], factor))
+                        for filename in lba_filenames]
+    else:
+        # Anything else, e.g. the .npz the original tool wrote, would be .npy bytes that open_samples can't read
+        if not output.endswith(".npy"):
+            raise Exception("Output file {0} must end in .npy, or be a directory".format(output))
+        output_files = [output]
+
+    jobs = []
+    for lba_filename, output_file in zip(lba_filenames, output_files):
+        job = DownsampleJob(lba_filename, output_file, factor, offset, samples, chunk_samples, ftype)
+        if not force and output_up_to_date(lba_filename, output_file, job.parameters):
+            LOG.info("Skipping {0}, {1} is up to date".format(lba_filename, output_file))
+        else:
+            jobs.append(job)
+    return jobs
 
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="Downsample an LBA file and output it as a numpy array.")
-    parser.add_argument('lba_file', type=str, help="LBA file to downsample")
-    parser.add_argument('output_file', type=str, help="File to output numpy array to")
+    parser = argparse.ArgumentParser(description="Downsample LBA files and output them as numpy arrays.")
+    parser.add_argument('lba_files', type=str, nargs='+', help="LBA files or glob patterns to downsample")
+    parser.add_argument('output', type=str, help="File to output a numpy array to, which must end in .npy, or a directory for multiple files")
     parser.add_argument('--factor', type=int, default=2, help="Downsample factor")
     parser.add_argument('--offset', type=int, default=0, help="Offset to read samples from")
-    parser.add_argument('--samples', type=int, default=0, help="Number of samples to read from the file")
+    parser.add_argument('--samples', type=int, default=0, help="Number of samples to read from each file")
+    parser.add_argument('--chunk_samples', type=int, default=CHUNK_SAMPLES, help="Number of samples to downsample at a time")
+    parser.add_argument('--ftype', choices=FILTER_TYPES, default="fir",
+                        help="Streaming FIR filter, or the original zero phase IIR filter, which reads each file into memory")
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Number of files to downsample in parallel")
+    parser.add_argument('--force', action='store_true', help="Downsample files even if their outputs are up to date")
     return vars(parser.parse_args())
 
 
 def main():
     args = parse_args()
+    processes = args.pop('processes')
+    jobs = create_jobs(**args)
+
+    if len(jobs) == 1 or processes <= 1:
+        for job in jobs:
+            job()
+    elif len(jobs) > 1:
+        with JobQueue(min(processes, len(jobs))) as queue:
+            futures = [queue.submit(job) for job in jobs]
+            queue.join()
 
-    with open(args['lba_file'], 'r') as f:
-        lba_file = LBAFile(f)
-        samples = lba_file.read(args['offset'], args['samples'])
-        factor = args['factor']
-        downsamples = np.zeros((samples.shape[0] // factor, samples.shape[1], samples.shape[2]))
-        for pindex, f in itertools.product(range(2), range(4)):
-            readsamples = samples[:, f, pindex]
-            downsamples[:, f, pindex] = signal.decimate(readsamples, args['factor'])
-        np.savez_compressed(args['output_file'], downsamples)
+        failed = []
+        for job, future in zip(jobs, futures):
+            if future.exception() is None:
+                LOG.info("Downsampled {0} in {1:.1f}s".format(job.lba_filename, future.timing.run))
+            else:
+                failed.append(job.lba_filename)
+        if failed:
+            raise Exception("Failed to downsample {0}".format(", ".join(failed)))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+Out of core spectrograms (dynamic spectra) of whole observations.
+
+DynamicSpectrumWriter takes samples a chunk at a time, carries the samples that overlap the next
+segment over to the next chunk, and appends the new time columns to a HDF5 file. Alongside the full
+resolution spectrum it keeps a pyramid of coarser levels, each averaging pyramid_factor columns of the
+level below, so any time range of a long observation can be plotted from a level with about as many
+columns as there are pixels, without recomputing anything.
+
+File layout:
+    attrs: sample_rate, nperseg, hop, integration, pyramid_factor, start_time, num_channels
+    frequencies: (frequencies,)
+    levels/<level>: (channels, times, frequencies) float32, resizable along the time axis
+
+python dynamic_spectrum.py build file.lba file_spectrum.h5
+python dynamic_spectrum.py plot file_spectrum.h5 spectrum.png --channel 0 --start 10 --end 20
+"""
+
+import argparse
+import logging
+import h5py
+import numpy as np
+from lba import SAMPLE_RATE, check_range
+from lba_cache import open_samples
+from spectral import segment_densities
+
+LOG = logging.getLogger(__name__)
+
+# Samples read and added to the spectrum at a time
+CHUNK_SAMPLES = 256 * 1024
+
+# Time columns per HDF5 chunk
+COLUMNS_PER_CHUNK = 256
+
+
+def _group_mean(pending, columns, factor):
+    """
+    Average columns in groups of factor, carrying over the columns that don't make a whole group
+    :param pending: Columns left over from last time, or None
+    :param columns: ndarray of X = channels, Y = times, Z = frequencies
+    :param factor: Number of columns to average into each output column
+    :return: The averaged columns, and the columns left over
+    """
+    if pending is not None:
+        columns = np.concatenate((pending, columns), axis=1)
+    groups = columns.shape[1] // factor
+    averaged = columns[:, :groups * factor].reshape(columns.shape[0], groups, factor, columns.shape[2]).mean(axis=2)
+    return averaged, columns[:, groups * factor:]
+
+
+class DynamicSpectrumWriter(object):
+    """
+    Builds a dynamic spectrum in a HDF5 file from chunks of samples
+
+    with DynamicSpectrumWriter("spectrum.h5", SAMPLE_RATE) as writer:
+        for chunk in lba_file.iter_chunks(CHUNK_SAMPLES):
+            writer.append(chunk)
+    """
+
+    def __init__(self, filename, sample_rate, nperseg=256, window=('tukey', 0.5), integration=1, pyramid_factor=4, start_time=0.0):
+        """
+        :param filename: HDF5 file to write
+        :param sample_rate: Sample rate of the signal
+        :param nperseg: Samples per segment. Segments overlap by half
+        :param window: Window to apply, in any form accepted by scipy.signal.get_window
+        :param integration: Number of segments to average into each column of the full resolution level
+        :param pyramid_factor: Number of columns of each level to average into each column of the next
+        :param start_time: Time of the first sample, in seconds
+        """
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.hop = nperseg // 2
+        self.window = window
+        self.integration = integration
+        self.pyramid_factor = pyramid_factor
+        self._carry = None
+        self._integration_pending = None
+        self._pending = []  # Columns of each level waiting to be averaged into the next level
+        self._levels = []
+
+        self._file = h5py.File(filename, 'w')
+        self._file.attrs["sample_rate"] = sample_rate
+        self._file.attrs["nperseg"] = nperseg
+        self._file.attrs["hop"] = self.hop
+        self._file.attrs["integration"] = integration
+        self._file.attrs["pyramid_factor"] = pyramid_factor
+        self._file.attrs["start_time"] = start_time
+        self._file.create_dataset("frequencies", data=np.fft.rfftfreq(nperseg, 1.0 / sample_rate))
+        self._file.create_group("levels")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _append_level(self, level, columns):
+        if columns.shape[1] == 0:
+            return
+        if level == len(self._levels):
+            self._file.attrs["num_channels"] = columns.shape[0]
+            self._levels.append(self._file["levels"].create_dataset(
+                str(level),
+                shape=(columns.shape[0], 0, columns.shape[2]),
+                maxshape=(columns.shape[0], None, columns.shape[2]),
+                chunks=(1, COLUMNS_PER_CHUNK, columns.shape[2]),
+                dtype=np.float32))
+            self._pending.append(None)
+
+        dataset = self._levels[level]
+        position = dataset.shape[1]
+        dataset.resize(position + columns.shape[1], axis=1)
+        dataset[:, position:, :] = columns
+
+        averaged, self._pending[level] = _group_mean(self._pending[level], columns, self.pyramid_factor)
+        self._append_level(level + 1, averaged)
+
+    def append(self, chunk):
+        """
+        Add the next chunk of samples to the spectrum
+        :param chunk: ndarray with X = samples, and any number of channels on the other axes
+        """
+        samples = chunk.reshape(chunk.shape[0], -1).T
+        if self._carry is not None:
+            samples = np.concatenate((self._carry, samples), axis=1)
+        if samples.shape[1] < self.nperseg:
+            self._carry = samples
+            return
+
+        # The samples after the start of the next segment are needed again for the next chunk
+        num_segments = (samples.shape[1] - self.nperseg) // self.hop + 1
+        used = (num_segments - 1) * self.hop + self.nperseg
+        columns = segment_densities(samples[:, :used], self.sample_rate, self.nperseg, self.hop, self.window)
+        self._carry = samples[:, num_segments * self.hop:].copy()
+
+        columns, self._integration_pending = _group_mean(self._integration_pending, columns, self.integration)
+        self._append_level(0, columns)
+
+    def close(self):
+        """
+        Average any leftover columns into the levels that already exist, and close the file.
+        Samples that don't fill a last segment are dropped, as for scipy.signal.spectrogram.
+        """
+        if self._file is None:
+            return
+        if self._integration_pending is not None and self._integration_pending.shape[1] > 0 and self._levels:
+            self._append_level(0, self._integration_pending.mean(axis=1, keepdims=True))
+        # Partial groups only become a column of a level that exists already, so the top of the pyramid stays whole
+        for level in range(len(self._levels) - 1):
+            pending = self._pending[level]
+            if pending is not None and pending.shape[1] > 0:
+                self._pending[level] = None
+                self._append_level(level + 1, pending.mean(axis=1, keepdims=True))
+        self._file.close()
+        self._file = None
+
+
+class DynamicSpectrum(object):
+    """
+    Reads a dynamic spectrum written by DynamicSpectrumWriter
+    """
+
+    def __init__(self, filename):
+        self._file = h5py.File(filename, 'r')
+        attrs = self._file.attrs
+        self.sample_rate = float(attrs["sample_rate"])
+        self.nperseg = int(attrs["nperseg"])
+        self.hop = int(attrs["hop"])
+        self.integration = int(attrs["integration"])
+        self.pyramid_factor = int(attrs["pyramid_factor"])
+        self.start_time = float(attrs["start_time"])
+        self.frequencies = self._file["frequencies"][()]
+        self.levels = [self._file["levels"][str(level)] for level in range(len(self._file["levels"]))]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def column_samples(self, level):
+        """
+        :return: Number of samples between the columns of a level
+        """
+        return self.hop * self.integration * self.pyramid_factor ** level
+
+    def times(self, level, start=0, stop=None):
+        """
+        :return: The time at the centre of each column of a level, from column start to stop
+        """
+        stop = self.levels[level].shape[1] if stop is None else stop
+        step = self.column_samples(level)
+        # Centre of the first segment, plus half of the segments averaged into each column
+        first = self.nperseg / 2 + (step - self.hop) / 2
+        return self.start_time + (first + np.arange(start, stop) * step) / self.sample_rate
+
+    def choose_level(self, start_time=None, end_time=None, max_columns=2048):
+        """
+        :return: The finest level with no more than max_columns columns between the start and end times
+        """
+        start_time = self.start_time if start_time is None else start_time
+        end_time = self.times(0, self.levels[0].shape[1] - 1)[0] if end_time is None else end_time
+        for level in range(len(self.levels)):
+            if (end_time - start_time) * self.sample_rate / self.column_samples(level) <= max_columns:
+                return level
+        return len(self.levels) - 1
+
+    def read(self, channel=None, start_time=None, end_time=None, max_columns=2048, level=None):
+        """
+        Read part of the spectrum from the level that best fits max_columns
+        :param channel: Channel to read, or None for all of them
+        :param start_time: Time to read from in seconds, or None for the start
+        :param end_time: Time to read to in seconds, or None for the end
+        :param max_columns: Largest number of columns to read, such as the width of the plot in pixels
+        :param level: Level to read from, or None to pick one with choose_level
+        :return: frequencies, times, ndarray of [channels], frequencies, times as for Spectra.spectrogram
+        """
+        level = self.choose_level(start_time, end_time, max_columns) if level is None else level
+        times = self.times(level)
+        start = 0 if start_time is None else np.searchsorted(times, start_time)
+        stop = times.shape[0] if end_time is None else np.searchsorted(times, end_time, side='right')
+        dataset = self.levels[level]
+        sxx = dataset[:, start:stop, :] if channel is None else dataset[channel, start:stop, :]
+        return self.frequencies, times[start:stop], np.swapaxes(sxx, -1, -2)
+
+
+def build(filename, output_file, offset=0, samples=0, chunk_samples=CHUNK_SAMPLES, **kwargs):
+    """
+    Build the dynamic spectrum of all 8 channels of an LBA file or sample cache, a chunk at a time
+    :param filename: File to read samples from, anything open_samples can read
+    :param output_file: HDF5 file to write to
+    :param offset: Offset to read samples from
+    :param samples: Number of samples to read, 0 for the rest of the file
+    :param chunk_samples: Samples to read at a time
+    :param kwargs: Passed on to DynamicSpectrumWriter
+    """
+    source = open_samples(filename)
+    samples = check_range(offset, samples, source.max_samples)
+    with DynamicSpectrumWriter(output_file, SAMPLE_RATE, start_time=offset / SAMPLE_RATE, **kwargs) as writer:
+        for position in range(offset, offset + samples, chunk_samples):
+            LOG.info("{0} {1:.1f}%".format(filename, 100.0 * (position - offset) / samples))
+            writer.append(source.read(position, min(chunk_samples, offset + samples - position)))
+
+
+def plot(filename, output_file, channel, start_time=None, end_time=None, max_columns=2048):
+    """
+    Plot part of a dynamic spectrum
+    """
+    # Only plotting needs matplotlib
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    with DynamicSpectrum(filename) as spectrum:
+        f, t, sxx = spectrum.read(channel, start_time, end_time, max_columns)
+    fig = plt.figure(figsize=(16, 9), dpi=80)
+    plt.xlabel("Time [sec]")
+    plt.ylabel("Frequency [MHz]")
+    plt.title("channel {0} dynamic spectrum".format(channel))
+    plt.pcolormesh(t, f / 1e6, sxx)
+    plt.colorbar()
+    plt.savefig(output_file)
+    fig.clear()
+    plt.close(fig)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build and plot out of core spectrograms of LBA files.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    build_parser = subparsers.add_parser("build", help="Build the dynamic spectrum of a file")
+    build_parser.add_argument('filename', type=str, help="LBA file or sample cache to read")
+    build_parser.add_argument('output_file', type=str, help="HDF5 file to write the spectrum to")
+    build_parser.add_argument('--offset', type=int, default=0, help="Offset to read samples from")
+    build_parser.add_argument('--samples', type=int, default=0, help="Number of samples to read, 0 for the whole file")
+    build_parser.add_argument('--chunk_samples', type=int, default=CHUNK_SAMPLES, help="Number of samples to read at a time")
+    build_parser.add_argument('--nperseg', type=int, default=256, help="Samples per segment")
+    build_parser.add_argument('--integration', type=int, default=1, help="Number of segments to average into each full resolution column")
+    build_parser.add_argument('--pyramid_factor', type=int, default=4, help="Number of columns averaged into each column of the next level")
+    build_parser.set_defaults(function=build)
+
+    plot_parser = subparsers.add_parser("plot", help="Plot part of a dynamic spectrum")
+    plot_parser.add_argument('filename', type=str, help="HDF5 file holding the spectrum")
+    plot_parser.add_argument('output_file', type=str, help="Image to write")
+    plot_parser.add_argument('--channel', type=int, default=0, help="Channel to plot, frequency * 2 + polarisation")
+    plot_parser.add_argument('--start_time', type=float, default=None, help="Time to plot from in seconds")
+    plot_parser.add_argument('--end_time', type=float, default=None, help="Time to plot to in seconds")
+    plot_parser.add_argument('--max_columns', type=int, default=2048, help="Largest number of time columns to plot")
+    plot_parser.set_defaults(function=plot)
+
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    args.pop("command")
+    args.pop("function")(**args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
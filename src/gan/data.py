@@ -26,7 +26,7 @@ import scipy.fftpack as fft
 import torch
 import logging
 from torch.utils.data import DataLoader
-from lba import LBAFile
+from lba_cache import open_samples
 
 LOG = logging.getLogger(__name__)
 
@@ -70,27 +70,22 @@ def load_real_noise(filename, num_batches, batch_size, frequency=None, polarisat
     :param use_cuda:
     :return:
     """
-    data = np.zeros((num_batches, batch_size), dtype=np.float32)
-    with open(filename, 'r') as f:
-        lba = LBAFile(f)
-        # Get a bunch of random indexes into the file that will not overflow if we read batch_size samples from
-        # that index onward
-        indexes = (np.random.rand(num_batches) * (lba.max_samples - batch_size)).astype(int)
-
-        # For each batch, either use the provided frequency and polarisation values,
-        # or pick randomly from the 4 frequencies and 2 polarisations.
-        frequency_indexes = (np.random.rand(num_batches) * 3).astype(int) \
-            if frequency is None else np.repeat(frequency, num_batches)
-
-        polarisation_indexes = (np.random.rand(num_batches) * 2).astype(int) \
-            if polarisation is None else np.repeat(polarisation, num_batches)
-
-        # Get data for each batch
-        for batch in range(num_batches):
-            if batch % 100 == 0 or batch == num_batches - 1:
-                LOG.info("Loading real data batch {0} / {1}".format(batch + 1, num_batches))
-            lba_data = lba.read(indexes[batch], batch_size)
-            data[batch] = lba_data[:, frequency_indexes[batch], polarisation_indexes[batch]]
+    lba = open_samples(filename)
+    # Get a bunch of random indexes into the file that will not overflow if we read batch_size samples from
+    # that index onward
+    indexes = (np.random.rand(num_batches) * (lba.max_samples - batch_size)).astype(int)
+
+    # For each batch, either use the provided frequency and polarisation values,
+    # or pick randomly from the 4 frequencies and 2 polarisations.
+    frequency_indexes = (np.random.rand(num_batches) * 3).astype(int) \
+        if frequency is None else np.repeat(frequency, num_batches)
+
+    polarisation_indexes = (np.random.rand(num_batches) * 2).astype(int) \
+        if polarisation is None else np.repeat(polarisation, num_batches)
+
+    # Get data for all batches at once, only decoding the channel each batch uses
+    LOG.info("Loading {0} real data batches".format(num_batches))
+    data = lba.read_windows(indexes, batch_size, frequency_indexes, polarisation_indexes).astype(np.float32)
 
     data = normalise(data)
 
@@ -32,7 +32,7 @@ file.
 import argparse
 import numpy as np
 import h5py
-from lba import LBAFile
+from lba_cache import open_samples
 from scipy import signal
 
 
@@ -62,23 +62,21 @@ def save_fft_data(filename, outfilename, sample_size, chunks_per_file):
     # Read the data
     # Create a dataset for each frequency, then under each frequency, each polarisation
 
-    with open(filename, 'r') as f:
-        lba = LBAFile(f)
-        with h5py.File(outfilename, 'w') as outfile:
-            real = {}
-            fake1 = generate_fake_noise(chunks_per_file, sample_size)
-            fake2 = generate_fake_noise(chunks_per_file, sample_size)
-            for _ in range(chunks_per_file):
-                sample_position = np.random.randint(0, lba.max_samples - sample_size)
-                samples = lba.read(sample_position, sample_size)
-                for pindex in range(samples.shape[2]):
-                    pdict = real.setdefault("p{0}".format(pindex), {})
-                    for findex in range(samples.shape[1]):
-                        flist = pdict.setdefault("f{0}".format(findex), [])
-                        fft = np.fft.fft(samples[:, findex, pindex])
-                        flist.append(np.concatenate((fft.real, fft.imag)))
-
-            save_hdf5(outfile, {"fake1": fake1, "fake2": fake2, "real": real})
+    lba = open_samples(filename)
+    with h5py.File(outfilename, 'w') as outfile:
+        real = {}
+        fake1 = generate_fake_noise(chunks_per_file, sample_size)
+        fake2 = generate_fake_noise(chunks_per_file, sample_size)
+        sample_positions = np.random.randint(0, lba.max_samples - sample_size, chunks_per_file)
+        samples = lba.read_windows(sample_positions, sample_size)
+        ffts = np.fft.fft(samples, axis=1)
+        for pindex in range(samples.shape[3]):
+            pdict = real.setdefault("p{0}".format(pindex), {})
+            for findex in range(samples.shape[2]):
+                fft = ffts[:, :, findex, pindex]
+                pdict["f{0}".format(findex)] = np.concatenate((fft.real, fft.imag), axis=1)
+
+        save_hdf5(outfile, {"fake1": fake1, "fake2": fake2, "real": real})
 
 
 def parse_args():
@@ -21,17 +21,216 @@
 #    MA 02111-1307  USA
 #
 
-from multiprocessing import JoinableQueue, Process
+"""
+A pool of worker processes to run jobs in.
+
+Jobs are callable objects that are pickled to a worker process. submit() returns a
+concurrent.futures.Future for the job's result, and map() and imap_unordered() stream results
+back while keeping a bounded number of jobs in flight.
+
+Large numpy arrays in jobs and results aren't copied through the queue's pipe. They are put into shared memory,
+and only their names are pickled, so workers use the job's arrays without copying them.
+A job's shared memory is freed when its result comes back, or if the worker running it dies.
+
+with JobQueue(4) as queue:
+    future = queue.submit(job)
+    for result in queue.imap_unordered(function, items):
+        ...
+"""
+
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from multiprocessing import JoinableQueue, Process, Queue, RawValue, resource_tracker, shared_memory
+import io
+import itertools
+import pickle
+import queue
+import threading
+import time
 import traceback, sys
+import numpy as np
+
+# Arrays at least this large are sent through shared memory rather than pickled
+SHARED_MEMORY_MIN_BYTES = 1024 * 1024
+
+# Seconds between checks that the worker processes are still alive
+WORKER_CHECK_INTERVAL = 1.0
+
+# Held while _attach turns off resource tracker registration on Python before 3.13, and while shared memory is
+# created, so memory another thread creates in that window is still registered
+_TRACKER_LOCK = threading.Lock()
+
+
+class TaskTiming(namedtuple("TaskTiming", ["submitted", "started", "finished"])):
+    """
+    When a job was submitted, and started and finished running in a worker, as time.time() values
+    """
+
+    @property
+    def queued(self):
+        """
+        :return: Seconds the job waited for a worker
+        """
+        return self.started - self.submitted
+
+    @property
+    def run(self):
+        """
+        :return: Seconds the job ran for
+        """
+        return self.finished - self.started
+
+
+class TaskTransfer(namedtuple("TaskTransfer", ["job_pickled", "job_shared", "result_pickled", "result_shared"])):
+    """
+    Bytes moved to run a job: pickled through the queues, and put in shared memory, for the job and its result
+    """
+
+    @property
+    def total(self):
+        return sum(self)
+
+
+def _attach(name):
+    """
+    Attach to existing shared memory without registering it with the resource tracker,
+    which would unlink it when this process exits. Only the process that created it should free it.
+    :param name: Name of the shared memory
+    :return: SharedMemory
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python before 3.13 always registers, so stop it for this call
+        with _TRACKER_LOCK:
+            register = resource_tracker.register
+            resource_tracker.register = lambda *args: None
+            try:
+                return shared_memory.SharedMemory(name=name)
+            finally:
+                resource_tracker.register = register
+
+
+def _create(size):
+    """
+    Create shared memory, registered with the resource tracker so it is unlinked if this process dies
+    :param size: Bytes of shared memory
+    :return: SharedMemory
+    """
+    with _TRACKER_LOCK:
+        return shared_memory.SharedMemory(create=True, size=size)
+
+
+def _close(segments):
+    for memory in segments:
+        try:
+            memory.close()
+        except BufferError:
+            # Something still holds an array in it. It'll be unmapped when that's gone
+            pass
+
+
+def _unlink(segments):
+    _close(segments)
+    for memory in segments:
+        try:
+            memory.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class _SharedMemoryPickler(pickle.Pickler):
+    """
+    Pickles large numpy arrays as the name of a shared memory copy of them
+    """
+
+    def __init__(self, file, min_bytes):
+        pickle.Pickler.__init__(self, file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.min_bytes = min_bytes
+        self.segments = []
+        self.shared_bytes = 0
+
+    def persistent_id(self, obj):
+        if not self.min_bytes or type(obj) is not np.ndarray or obj.dtype.hasobject or obj.nbytes < self.min_bytes:
+            return None
+        memory = _create(obj.nbytes)
+        self.segments.append(memory)
+        np.ndarray(obj.shape, obj.dtype, buffer=memory.buf)[...] = obj
+        self.shared_bytes += obj.nbytes
+        return memory.name, obj.shape, obj.dtype
+
+
+class _SharedMemoryUnpickler(pickle.Unpickler):
+    """
+    Unpickles arrays pickled by _SharedMemoryPickler as views of their shared memory, or copies of it
+    """
+
+    def __init__(self, file, copy):
+        pickle.Unpickler.__init__(self, file)
+        self.copy = copy
+        self.segments = []
+
+    def persistent_load(self, pid):
+        name, shape, dtype = pid
+        memory = _attach(name)
+        self.segments.append(memory)
+        array = np.ndarray(shape, dtype, buffer=memory.buf)
+        return array.copy() if self.copy else array
+
+
+def dumps(obj, min_bytes=SHARED_MEMORY_MIN_BYTES):
+    """
+    Pickle an object, putting any numpy arrays of at least min_bytes into shared memory
+    :param obj: Object to pickle
+    :param min_bytes: Smallest array to put into shared memory, 0 to pickle everything
+    :return: The pickled bytes, the SharedMemory the arrays were put in, and the number of bytes put in them.
+             The creator of the SharedMemory must unlink it once it has been loaded.
+    """
+    file = io.BytesIO()
+    pickler = _SharedMemoryPickler(file, min_bytes)
+    try:
+        pickler.dump(obj)
+    except BaseException:
+        _unlink(pickler.segments)
+        raise
+    return file.getvalue(), pickler.segments, pickler.shared_bytes
+
+
+def loads(data, copy=False):
+    """
+    Unpickle an object from dumps
+    :param data: Pickled bytes
+    :param copy: If False, arrays in shared memory are views of it. If True they are copied out of it
+    :return: The object, and the SharedMemory it was in, which must be closed once the object is finished with
+    """
+    unpickler = _SharedMemoryUnpickler(io.BytesIO(data), copy)
+    return unpickler.load(), unpickler.segments
 
 
 class Consumer(Process):
     """
     A class to process jobs from the queue
     """
-    def __init__(self, queue):
+    def __init__(self, queue, result_queue, min_shared_bytes=SHARED_MEMORY_MIN_BYTES):
         Process.__init__(self)
         self._queue = queue
+        self._result_queue = result_queue
+        self._min_shared_bytes = min_shared_bytes
+        # The id of the job this consumer last started, so the parent knows which job was lost if it dies.
+        # Written straight to shared memory, unlike the queues, which send from a background thread.
+        self.current_task = RawValue('q', -1)
+
+    def _send_result(self, task_id, success, value, started):
+        finished = time.time()
+        try:
+            data, segments, shared_bytes = dumps((success, value), self._min_shared_bytes)
+        except Exception as e:
+            # Still send something back, or the job's future will never finish
+            value = Exception("Could not send back the result of the job: {0}".format(e))
+            data, segments, shared_bytes = dumps((False, value), 0)
+        self._result_queue.put((task_id, data, shared_bytes, started, finished))
+        # The parent unlinks these once it has copied the result out of them
+        _close(segments)
 
     def run(self):
         """
@@ -43,28 +242,278 @@ class Consumer(Process):
                 # Poison pill means shutdown this consumer
                 self._queue.task_done()
                 return
+            task_id, data = next_task
+            self.current_task.value = task_id
+            started = time.time()
+            segments = []
             # noinspection PyBroadException
             try:
-                next_task()
+                job, segments = loads(data)
+                success, value = True, job()
             except Exception as e:
                 exc_type, exc_value, exc_traceback = sys.exc_info()
                 traceback.print_exception(exc_type, exc_value, exc_traceback)
+                success, value = False, e
+            job = None
+            try:
+                self._send_result(task_id, success, value, started)
             finally:
+                value = None
+                _close(segments)
                 self._queue.task_done()
 
 
+class _Call(object):
+    """
+    A job that calls function(item), for map and imap_unordered
+    """
+
+    def __init__(self, function, item):
+        self.function = function
+        self.item = item
+
+    def __call__(self):
+        return self.function(self.item)
+
+
+class _Task(object):
+    """
+    A submitted job that hasn't finished yet
+    """
+
+    def __init__(self, future, submitted, segments, job_pickled, job_shared):
+        self.future = future
+        self.submitted = submitted
+        self.segments = segments
+        self.job_pickled = job_pickled
+        self.job_shared = job_shared
+
+
 class JobQueue(object):
 
-    def __init__(self, num_processes=8):
-        self.queue = JoinableQueue()
-        self.consumers = [Consumer(self.queue) for x in range(num_processes)]
-        for consumer in self.consumers:
-            consumer.start()
+    def __init__(self, num_processes=8, max_queued=None, min_shared_bytes=SHARED_MEMORY_MIN_BYTES):
+        """
+        :param num_processes: Number of processes to run jobs in
+        :param max_queued: Number of jobs that can wait for a worker before submit() blocks.
+                           Defaults to 2 * num_processes, 0 for no limit
+        :param min_shared_bytes: Smallest numpy array in a job or result to send through shared memory, 0 for none
+        """
+        self.max_queued = 2 * num_processes if max_queued is None else max_queued
+        self.min_shared_bytes = min_shared_bytes
+        self.queue = JoinableQueue(self.max_queued)
+        self.result_queue = Queue()
+        self.timings = []  # TaskTiming of every finished job
+        self.transfers = []  # TaskTransfer of every finished job
+        self._tasks = {}  # task id: _Task
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # Start the resource tracker before the workers, so they share it. Then any shared memory
+        # still around when every process has exited is freed, whichever process created it.
+        resource_tracker.ensure_running()
+        self.consumers = [self._start_consumer() for x in range(num_processes)]
+
+        # Results are read in a thread, so futures finish even while submit() is blocked
+        self._collector = threading.Thread(target=self._collect_results, daemon=True)
+        self._collector.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def _start_consumer(self):
+        consumer = Consumer(self.queue, self.result_queue, self.min_shared_bytes)
+        consumer.start()
+        return consumer
+
+    @property
+    def _in_flight(self):
+        """
+        Number of jobs map and imap_unordered keep submitted at once
+        """
+        return len(self.consumers) + max(self.max_queued, len(self.consumers))
+
+    def _finish_task(self, task_id, success, value, started, finished, result_pickled=0, result_shared=0):
+        with self._lock:
+            task = self._tasks.pop(task_id, None)
+        if task is None:
+            # Already failed because its worker died
+            return
+        with self._lock:
+            future = task.future
+            future.timing = TaskTiming(task.submitted, started, finished)
+            future.transfer = TaskTransfer(task.job_pickled, task.job_shared, result_pickled, result_shared)
+            self.timings.append(future.timing)
+            self.transfers.append(future.transfer)
+        _unlink(task.segments)
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _receive_result(self, task_id, data, shared_bytes, started, finished):
+        segments = []
+        try:
+            # Copy the arrays out, so the result's shared memory can be freed now
+            (success, value), segments = loads(data, copy=True)
+        except Exception as e:
+            success, value = False, e
+        finally:
+            _unlink(segments)
+        self._finish_task(task_id, success, value, started, finished, len(data), shared_bytes)
+
+    def _check_consumers(self):
+        """
+        Fail the job of any worker that has died while running it, and replace the worker
+        """
+        for index, consumer in enumerate(self.consumers):
+            if consumer.is_alive() or consumer.exitcode == 0:
+                continue
+            # If its job finished, the result came in before this check and the job is no longer pending
+            task_id = consumer.current_task.value
+            if task_id in self._tasks:
+                now = time.time()
+                error = Exception("Worker {0} exited with code {1} while running the job".format(consumer.pid, consumer.exitcode))
+                self._finish_task(task_id, False, error, now, now)
+            if not self._closed:
+                self.consumers[index] = self._start_consumer()
+
+    def _collect_results(self):
+        while True:
+            try:
+                message = self.result_queue.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                message = False
+            if message is False:
+                # Outside the except block, so replacement workers don't inherit the exception being handled
+                self._check_consumers()
+                continue
+            if message is None:
+                return
+            self._receive_result(*message)
+
+    def submit(self, job):
+        """
+        Queue a job to run in a worker process, blocking while the queue is full.
+        :param job: Picklable callable to run
+        :return: Future for the job's return value or the exception it raised.
+                 Once finished, future.timing holds the job's TaskTiming and future.transfer its TaskTransfer
+        """
+        if self._closed:
+            raise Exception("Can't submit jobs to a closed JobQueue")
+        data, segments, shared_bytes = dumps(job, self.min_shared_bytes)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._tasks[task_id] = _Task(future, time.time(), segments, len(data), shared_bytes)
+        self.queue.put((task_id, data))
+        return future
+
+    def map(self, function, iterable):
+        """
+        Call function on each item in worker processes, submitting items as the results are used
+        :param function: Picklable function taking one item
+        :param iterable: Items to call the function with
+        :return: Generator of the results, in the same order as the items. Raises the exception from a failed call
+        """
+        futures = deque()
+        for item in iterable:
+            futures.append(self.submit(_Call(function, item)))
+            if len(futures) >= self._in_flight:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+    def imap_unordered(self, function, iterable):
+        """
+        Call function on each item in worker processes, submitting items as the results are used
+        :param function: Picklable function taking one item
+        :param iterable: Items to call the function with
+        :return: Generator of the results, in the order they finish. Raises the exception from a failed call
+        """
+        pending = set()
+        for item in iterable:
+            pending.add(self.submit(_Call(function, item)))
+            if len(pending) >= self._in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
 
     def join(self):
+        """
+        Wait for every job submitted so far to finish. More jobs can be submitted afterwards
+        """
+        with self._lock:
+            futures = [task.future for task in self._tasks.values()]
+        wait(futures)
+
+    def close(self):
+        """
+        Wait for every job to finish, and shut down the worker processes
+        """
+        if self._closed:
+            return
+        self.join()
+        self._closed = True
         for consumer in self.consumers:
             self.queue.put(None)
-        self.queue.join()
+        for consumer in self.consumers:
+            consumer.join()
+        self.result_queue.put(None)
+        self._collector.join()
 
-    def submit(self, job):
-        self.queue.put(job)
\ No newline at end of file
+
+class SharedArray(object):
+    """
+    A numpy array in shared memory, that can be sent to jobs without copying the data.
+    Only the name of the shared memory block is pickled, and the job attaches to the same memory again.
+    The process that created it must unlink() it once every job is finished with it.
+    """
+
+    def __init__(self, shape, dtype):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._memory = _create(max(1, int(np.prod(self.shape)) * self.dtype.itemsize))
+
+    @classmethod
+    def copy(cls, array):
+        """
+        :param array: ndarray to copy into shared memory
+        :return: SharedArray holding a copy of the array
+        """
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @property
+    def array(self):
+        """
+        :return: ndarray view of the shared memory. Views must be released before close() is called
+        """
+        return np.ndarray(self.shape, self.dtype, buffer=self._memory.buf)
+
+    def __getstate__(self):
+        return {"shape": self.shape, "dtype": self.dtype, "name": self._memory.name}
+
+    def __setstate__(self, state):
+        self.shape = state["shape"]
+        self.dtype = state["dtype"]
+        self._memory = _attach(state["name"])
+
+    def close(self):
+        self._memory.close()
+
+    def unlink(self):
+        """
+        Free the shared memory. Only call this from the process that created it
+        """
+        self._memory.close()
+        self._memory.unlink()
\ No newline at end of file
@@ -25,11 +25,228 @@
 Utilities for loading LBA files
 """
 
+import argparse
+import functools
+import json
+import logging
 import mmap
 import os
 import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from timeit import default_timer
 import numpy as np
 
+LOG = logging.getLogger(__name__)
+
+# Every 32 million samples there is a 65535 marker which is meaningless
+MARKER_INTERVAL = 32000000
+
+# Samples per second in each frequency channel
+SAMPLE_RATE = 32000000
+
+# Frequency range in MHz for each channel within a polarisation
+# http://www.atnf.csiro.au/vlbi/dokuwiki/doku.php/lbaops/lbamar2018/v255ae
+CHANNEL_FREQUENCY_MAP = [
+    (6300, 6316),  # f1
+    (6316, 6332),  # f2
+    (6642, 6658),  # f3
+    (6658, 6674)   # f4
+]
+
+# Each worker's share of a parallel read starts on a multiple of this many samples
+WORKER_ALIGNMENT = 4096
+
+# Extension of the sidecar file LBAHeader.load caches each file's header in
+HEADER_SIDECAR_EXTENSION = ".header.json"
+
+# Richard orginally gave this map [3, -3, 1, -1], but it seems to be wrong as
+# I don't get the correct spread of output values (about 2x the number of 1s as there are 3s)
+# This map was taken from some ancient csiro C code
+VAL_MAP = [3, 1, -1, -3]  # 2 bit encoding map
+
+
+def build_lookup_table(num_bits):
+    """
+    Build a table that maps every possible byte to the samples encoded in it.
+    Samples are stored lowest bits first, so for 2 bit samples the row for byte b is
+    [VAL_MAP[b & 3], VAL_MAP[b >> 2 & 3], VAL_MAP[b >> 4 & 3], VAL_MAP[b >> 6 & 3]]
+    :param num_bits: Number of bits in a single sample
+    :return: int8 ndarray with X = byte value (256), Y = samples in that byte (8 / num_bits)
+    """
+    sample_mask = (1 << num_bits) - 1
+    shifts = np.arange(8 // num_bits) * num_bits
+    codes = np.arange(256)[:, np.newaxis] >> shifts & sample_mask
+    return np.array(VAL_MAP, dtype=np.int8)[codes]
+
+
+def check_range(offset, samples, max_samples):
+    """
+    Confirm that the requested samples are inside the file
+    :param offset: Sample index to start at (0 indexed)
+    :param samples: Number of samples to read from that index, 0 for the rest of the file
+    :param max_samples: Max samples that can be requested from the file
+    :return: Number of samples to read
+    """
+    if samples < 0:
+        raise Exception("Negative samples requested")
+
+    if samples == 0:
+        samples = max_samples - offset
+    elif samples > max_samples:
+        raise Exception("{0} samples requested with {1} max samples".format(samples, max_samples))
+
+    # Confirm that the user requested a sane offset
+    if offset > max_samples:
+        raise Exception("Offset {0} > Maxsamples {1}".format(offset, max_samples))
+    elif offset < 0:
+        raise Exception("Offset {0} < 0".format(offset))
+
+    if offset + samples > max_samples:
+        raise Exception("Offset {0}, samples {1} will overflow lba file".format(offset, samples))
+
+    return samples
+
+
+def select_channels(frequency, polarisation, num_freq):
+    """
+    Work out which channels a frequency and polarisation selection picks out.
+    A single index drops that axis from the result, and a list selects a subset along it,
+    so selecting frequency 1 and polarisations [0, 1] gives samples with one axis of 2 polarisations.
+    :param frequency: Frequency index, list of frequency indexes, or None for all frequencies
+    :param polarisation: Polarisation index, list of polarisation indexes, or None for both
+    :param num_freq: Number of frequencies
+    :return: Tuple of the shape of one selected sample, and a list of
+             (index into that shape, frequency, polarisation) for each channel
+    """
+    frequencies = np.arange(num_freq) if frequency is None else np.asarray(frequency)
+    polarisations = np.arange(2) if polarisation is None else np.asarray(polarisation)
+    shape = frequencies.shape + polarisations.shape
+
+    channels = []
+    for index in np.ndindex(*shape):
+        channels.append((index, int(frequencies[index[:frequencies.ndim]]), int(polarisations[index[frequencies.ndim:]])))
+    return shape, channels
+
+
+def read_header(f):
+    """
+    Reads in an LBA header.
+    It's basically just a flat key = value structure
+    :param f: Anything with a readline method returning bytes, positioned at the start of the file
+    :return: dict of the header's keys and values, as strings
+    """
+    header = {}
+
+    bytecount = 0
+    expected_size = None  # Expected size of the header. We'll know this once we hit the "HEADERSIZE" field
+    while True:
+        line = f.readline()
+        if not line:
+            break  # End of file
+
+        bytecount += len(line)
+        if expected_size is not None and bytecount >= expected_size:
+            break  # Gone over expected size of header
+
+        line = line.strip()
+
+        if line == b"END":
+            break  # Hit the end of header flag
+
+        k, v = line.split(b' ', 1)
+        header_key = k.decode("utf-8")
+        header_value = v.decode("utf-8")
+        header[header_key] = header_value
+
+        if header_key == "HEADERSIZE":
+            expected_size = int(header_value)
+
+    return header
+
+
+class LBAHeader(namedtuple("LBAHeader", [
+        "fields", "size", "mtime", "num_chan", "num_bits", "bandwidth", "data_start", "bytes_per_sample",
+        "num_freq", "num_words", "marker_interval", "num_markers", "max_samples"])):
+    """
+    The parsed header of an LBA file, with all the numbers needed to read the file worked out up front.
+    Headers are cached per (path, mtime, size), in memory and in a sidecar file next to the LBA file,
+    so listing many files doesn't need to open or map them.
+
+    header = LBAHeader.load('file.lba')
+    print(header.max_samples)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_fields(cls, fields, size, mtime):
+        """
+        :param fields: dict of the header's keys and values, as returned by read_header
+        :param size: Size of the file in bytes
+        :param mtime: Modification time of the file
+        :return: LBAHeader
+        """
+        num_chan = int(fields["NCHAN"])
+        num_bits = int(fields["NUMBITS"])
+        bandwidth = int(float(fields["BANDWIDTH"]))
+        data_start = int(fields["HEADERSIZE"])
+
+        # Each sample contains num_chan channels, the reading for each channel is num_bits
+        # bandwidth >> 4 converts a bandwidth value into a byte value
+        # e.g. 64 bandwidth = 4, 32 bandwidth = 2, 16 bandwidth = 1
+        # final divide by 8 converts from bits to bytes
+        bytes_per_sample = num_chan * num_bits * (bandwidth >> 4) // 8
+
+        # Every MARKER_INTERVAL samples, starting with the first, is a marker which is meaningless
+        num_words = (size - data_start) // bytes_per_sample
+        num_markers = -(-num_words // MARKER_INTERVAL)
+
+        return cls(fields=fields, size=size, mtime=mtime, num_chan=num_chan, num_bits=num_bits, bandwidth=bandwidth,
+                   data_start=data_start, bytes_per_sample=bytes_per_sample,
+                   # 2 polarisations per frequency, so there are half as many frequencies as channels
+                   num_freq=num_chan // 2,
+                   num_words=num_words, marker_interval=MARKER_INTERVAL, num_markers=num_markers,
+                   max_samples=num_words - num_markers)
+
+    @classmethod
+    def load(cls, path, stat=None):
+        """
+        Get the header for an LBA file, parsing it only if it isn't already cached
+        :param path: Path to the LBA file
+        :param stat: os.stat result for the file, if the caller already has it
+        :return: LBAHeader
+        """
+        if stat is None:
+            stat = os.stat(path)
+        return _load_header(os.path.abspath(path), stat.st_mtime, stat.st_size)
+
+
+@functools.lru_cache(maxsize=1024)
+def _load_header(path, mtime, size):
+    """
+    Load an LBA header from its sidecar file if that's up to date, otherwise parse
+    it from the LBA file and write a new sidecar file.
+    """
+    sidecar = path + HEADER_SIDECAR_EXTENSION
+    try:
+        with open(sidecar, "r") as f:
+            cached = json.load(f)
+        if cached["mtime"] == mtime and cached["size"] == size:
+            return LBAHeader.from_fields(cached["fields"], size, mtime)
+    except (OSError, ValueError, KeyError):
+        pass  # No usable sidecar, so parse the file
+
+    with open(path, "rb") as f:
+        fields = read_header(f)
+
+    try:
+        with open(sidecar, "w") as f:
+            json.dump({"mtime": mtime, "size": size, "fields": fields}, f, indent=4)
+    except OSError as e:
+        LOG.debug("Couldn't write header sidecar {0}: {1}".format(sidecar, e))
+
+    return LBAHeader.from_fields(fields, size, mtime)
+
 
 class LBAFile(object):
     """
@@ -46,155 +263,296 @@ class LBAFile(object):
         :param f: opened file
         """
         self.mm = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
-        self.header = self._read_header()
-        self.size = os.fstat(f.fileno()).st_size
+        stat = os.fstat(f.fileno())
+        if isinstance(getattr(f, "name", None), str):
+            self.lba_header = LBAHeader.load(f.name, stat)
+        else:
+            self.lba_header = LBAHeader.from_fields(read_header(self.mm), stat.st_size, stat.st_mtime)
+        self.header = self.lba_header.fields
+        self.size = self.lba_header.size
+        self._lookup_table = build_lookup_table(self.lba_header.num_bits)
+
+        # View the data region as one row of bytes per sample, so whole blocks of samples
+        # can be decoded with the lookup table instead of one at a time.
+        bytes_per_sample = self.lba_header.bytes_per_sample
+        self._data = np.frombuffer(self.mm, dtype=np.uint8, count=self.lba_header.num_words * bytes_per_sample,
+                                   offset=self.lba_header.data_start)
+        self._data = self._data.reshape(self.lba_header.num_words, bytes_per_sample)
+        if sys.byteorder == "big":
+            # Samples are read as native integers, so the low bits are in the last byte
+            self._data = self._data[:, ::-1]
+        self._check_markers()
 
     @property
     def bytes_per_sample(self):
-        num_chan = int(self.header["NCHAN"])
-        num_bits = int(self.header["NUMBITS"])
-        bandwidth = int(float(self.header["BANDWIDTH"]))
-
-        # Each sample contains num_chan channels, the reading for each channel is num_bits
-        # bandwidth >> 4 converts a bandwidth value into a byte value
-        # e.g. 64 bandwidth = 4, 32 bandwidth = 2, 16 bandwidth = 1
-        # final divide by 8 converts from bits to bytes
-        return num_chan * num_bits * (bandwidth >> 4) // 8
+        return self.lba_header.bytes_per_sample
 
     @property
     def max_samples(self):
-        data_size = self.size - int(self.header["HEADERSIZE"])
-        max_samples = data_size // self.bytes_per_sample
-        # Skip over this number of samples, because every 32 million samples there is
-        # a 65535 marker which is meaningless
-        max_samples -= max_samples // 32000000
-        return max_samples
+        # Skip over the markers, which are meaningless
+        return self.lba_header.max_samples
 
-    def _read_header(self):
+    def _decode(self, words, out):
         """
-        Reads in an LBA header and stores it in self.header
-        It's basically just a flat key = value structure
-        :return:
+        Decode a block of raw samples into out using the lookup table.
+        One sample contains data across all frequencies (4), with two polarisations per frequency
+        e.g. 16 bit sample: 1001,1010,0101,0000
+        freq1: 0000, P0: 00, P1: 11
+        freq2: 0101, P0: 01, P1: 01
+        freq3: 1010, P0: 10, P1: 10
+        freq4: 1001, p0: 01, p1: 10
+        so the decoded values come out of the table already in frequency, polarisation order.
+        :param words: uint8 ndarray with X = samples, Y = bytes per sample
+        :param out: int8 ndarray with X = samples, Y = frequencies, Z = polarisations
         """
-        header = {}
-
-        bytecount = 0
-        expected_size = None  # Expected size of the header. We'll know this once we hit the "HEADERSIZE" field
-        while True:
-            line = self.mm.readline()
-            if line is None:
-                break
-
-            bytecount += len(line)
-            if expected_size is not None and bytecount >= expected_size:
-                break  # Gone over expected size of header
+        values = out.reshape(words.shape[0], -1)
+        values_per_byte = self._lookup_table.shape[1]
+        if values.shape[1] == words.shape[1] * values_per_byte:
+            np.take(self._lookup_table, words, axis=0, out=values.reshape(words.shape + (values_per_byte,)), mode='clip')
+        else:
+            # The sample has unused high bits, so decode everything then drop them
+            values[:] = self._lookup_table[words].reshape(words.shape[0], -1)[:, :values.shape[1]]
+
+    def _check_markers(self):
+        """
+        Every 32 million samples there is a 65535 marker, starting with the very first sample.
+        Check that they really are markers, once when the file is opened, rather than on every read that crosses one.
+        Reads skip them by position, in _word_index.
+        Richard said this was all 0s but it was actually all 1s, I hope this is correct.
+        """
+        markers = np.arange(0, self._data.shape[0], self.lba_header.marker_interval)
+        for word in markers[np.any(self._data[markers] != 0xFF, axis=1)]:
+            LOG.warning("Skip value should have been 65535 @ sample {0}, data may be corrupted.".format(word))
 
-            line = line.strip()
+    def _word_index(self, sample):
+        """
+        Convert a sample index into an index into the data, which includes the markers.
+        Every block of MARKER_INTERVAL words is one marker followed by MARKER_INTERVAL - 1 samples.
+        :param sample: Sample index (0 indexed), or ndarray of them
+        :return: Index of the sample in the data
+        """
+        return sample + sample // (self.lba_header.marker_interval - 1) + 1
 
-            if line == b"END":
-                break  # Hit the end of header flag
+    @property
+    def num_freq(self):
+        return self.lba_header.num_freq
 
-            k, v = line.split(b' ', 1)
-            header_key = k.decode("utf-8")
-            header_value = v.decode("utf-8")
-            header[header_key] = header_value
+    def _check_range(self, offset, samples):
+        return check_range(offset, samples, self.max_samples)
 
-            if header_key == "HEADERSIZE":
-                expected_size = int(header_value)
+    def _select_channels(self, frequency, polarisation):
+        """
+        Work out which channels need decoding for a frequency and polarisation selection.
+        The value for frequency f, polarisation p is the (2f + p)th set of num_bits bits in a sample.
+        :param frequency: Frequency index, list of frequency indexes, or None for all frequencies
+        :param polarisation: Polarisation index, list of polarisation indexes, or None for both
+        :return: Tuple of the shape of one decoded sample, and a list of
+                 (index into that shape, byte in the sample, lookup table column) for each channel.
+                 The list is None if everything is selected, as whole samples can be decoded at once.
+        """
+        if frequency is None and polarisation is None:
+            return (self.num_freq, 2), None
+
+        num_bits = self.lba_header.num_bits
+        shape, selected = select_channels(frequency, polarisation, self.num_freq)
+        channels = []
+        for index, channel_frequency, channel_polarisation in selected:
+            bit = (2 * channel_frequency + channel_polarisation) * num_bits
+            channels.append((index, bit // 8, bit % 8 // num_bits))
+        return shape, channels
+
+    def _read_into(self, offset, out, channels=None):
+        """
+        Decode samples into out, skipping over any markers on the way
+        :param offset: Sample index to start at (0 indexed)
+        :param out: ndarray with X = samples, followed by the shape from _select_channels to fill
+        :param channels: Channels from _select_channels to decode, or None to decode all of them
+        """
+        samples = out.shape[0]
+        samples_output = 0  # Number of samples we dumped into out
+        while samples_output < samples:
+            word = self._word_index(offset + samples_output)
+
+            # Decode everything up to the next marker in one go
+            marker_interval = self.lba_header.marker_interval
+            count = min(samples - samples_output, marker_interval - word % marker_interval)
+            words = self._data[word:word + count]
+            output = slice(samples_output, samples_output + count)
+            if channels is None:
+                self._decode(words, out[output])
+            else:
+                # Look up each channel's byte straight into its place in the output
+                for index, byte, column in channels:
+                    np.take(self._lookup_table[:, column], words[:, byte], out=out[(output,) + index], mode='clip')
+            samples_output += count
 
-        return header
+    def _read_parallel(self, offset, out, channels, workers):
+        """
+        Decode samples into out using a pool of threads. Each thread decodes its own aligned range of
+        samples, skipping markers as _read_into does. Numpy releases the GIL while doing the lookups,
+        so the threads run concurrently.
+        :param offset: Sample index to start at (0 indexed)
+        :param out: ndarray to fill, as for _read_into
+        :param channels: Channels to decode, as for _read_into
+        :param workers: Number of threads to decode with
+        """
+        start = default_timer()
+        samples = out.shape[0]
+        bounds = [min(samples, (samples * worker // workers) // WORKER_ALIGNMENT * WORKER_ALIGNMENT)
+                  for worker in range(workers)] + [samples]
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(self._read_into, offset + low, out[low:high], channels)
+                       for low, high in zip(bounds[:-1], bounds[1:]) if high > low]
+            for future in futures:
+                future.result()  # Raises any exception from the worker
+
+        elapsed = default_timer() - start
+        LOG.info("Decoded {0} samples in {1:.3f}s with {2} workers ({3:.0f} samples/s)".format(
+            samples, elapsed, workers, samples / elapsed if elapsed > 0 else float("inf")))
+
+    def _read_samples(self, offset, out, channels, workers):
+        """
+        Decode samples into out, in parallel if more than one worker is requested
+        """
+        if workers is not None and workers > 1:
+            self._read_parallel(offset, out, channels, workers)
+        else:
+            self._read_into(offset, out, channels)
 
-    def read(self, offset=0, samples=0):
+    def read(self, offset=0, samples=0, frequency=None, polarisation=None, workers=None):
         """
         Reads a set of samples out of the lba file.
         Note that you can read samples from anywhere in the file by specifying
         an offset to start at.
+        Selecting a frequency and polarisation only decodes that channel, so
+        lba.read(offset, samples, 1, 0) gives the same values as lba.read(offset, samples)[:, 1, 0],
+        but contiguous and without decoding the other 7 channels. A list selects a subset instead.
         :param offset: Sample index to start at (0 indexed)
         :param samples: Number of samples to read from that index.
-        :return: ndarray with X = samples, Y = frequencies(4), Z = polarisations(2)
+        :param frequency: Frequency index or list of frequency indexes to read, None for all frequencies
+        :param polarisation: Polarisation index or list of polarisation indexes to read, None for both
+        :param workers: Number of threads to decode with. None or 1 decodes in the calling thread.
+        :return: ndarray with X = samples, Y = frequencies(4), Z = polarisations(2),
+                 without the Y or Z axis if a single frequency or polarisation was selected
         """
-        if samples < 0:
-            raise Exception("Negative samples requested")
+        samples = self._check_range(offset, samples)
 
-        num_chan = int(self.header["NCHAN"])
-        num_bits = int(self.header["NUMBITS"])
-        data_start = int(self.header["HEADERSIZE"])
-        # Richard orginally gave this map [3, -3, 1, -1], but it seems to be wrong as
-        # I don't get the correct spread of output values (about 2x the number of 1s as there are 3s)
-        # This map was taken from some ancient csiro C code
-        val_map = [3, 1, -1, -3]  # 2 bit encoding map
+        # X = samples, Y = frequency, Z = polarisation
+        shape, channels = self._select_channels(frequency, polarisation)
+        nparray = np.empty((samples,) + shape, dtype=np.int8)
+        self._read_samples(offset, nparray, channels, workers)
+        return nparray
 
-        # 2 polarisations per frequency, so there are half as many frequencies as channels
-        # and twice as many bits per frequency.
-        num_freq = num_chan // 2
-        num_freq_bits = num_bits * 2
+    def _channel_values(self, words, frequency, polarisation):
+        """
+        Decode single channels out of the data without decoding the others.
+        The value for frequency f, polarisation p is the (2f + p)th set of num_bits bits in a sample.
+        :param words: Indexes of the samples in the data
+        :param frequency: Frequency indexes, broadcastable against words
+        :param polarisation: Polarisation indexes, broadcastable against words
+        :return: int8 ndarray of the decoded values
+        """
+        num_bits = self.lba_header.num_bits
+        bit = (2 * np.asarray(frequency) + np.asarray(polarisation)) * num_bits
+        return self._lookup_table[self._data[words, bit // 8], bit % 8 // num_bits]
 
-        # Calculate number of bytes per sample
-        bytes_per_sample = self.bytes_per_sample
+    def read_windows(self, starts, length, frequency=None, polarisation=None):
+        """
+        Reads many short windows of samples out of the lba file at once, decoding
+        only the requested channels.
 
-        # Max samples that can be requested from the file
-        max_samples = self.max_samples
-        if samples == 0:
-            samples = max_samples
-        elif samples > max_samples:
-            raise Exception("{0} samples requested with {1} max samples".format(samples, max_samples))
+        windows = lba.read_windows(np.random.randint(0, lba.max_samples - 1024, 10000), 1024, 0, 1)
 
-        # Confirm that the user requested a sane offset
-        if offset > max_samples:
-            raise Exception("Offset {0} > Maxsamples {1}".format(offset, max_samples))
-        elif offset < 0:
-            raise Exception("Offset {0} < 0".format(offset))
+        :param starts: Sample index (0 indexed) that each window starts at
+        :param length: Number of samples in each window
+        :param frequency: Frequency to read, either one for all windows or one per window. None for all frequencies.
+        :param polarisation: Polarisation to read, either one for all windows or one per window. None for both.
+        :return: ndarray with X = windows, Y = samples, followed by Z = frequencies(4) if frequency is None
+                 and then polarisations(2) if polarisation is None
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        if length <= 0:
+            raise Exception("Window length {0} <= 0".format(length))
+        if starts.size > 0 and (starts.min() < 0 or starts.max() + length > self.max_samples):
+            raise Exception("Windows of {0} samples must start between 0 and {1}".format(length, self.max_samples - length))
+
+        # Broadcast everything to X = windows, Y = samples, Z = frequencies, W = polarisations
+        words = self._word_index(starts[:, np.newaxis] + np.arange(length))[:, :, np.newaxis, np.newaxis]
+        if frequency is None:
+            frequency = np.arange(self.num_freq)[:, np.newaxis]
+        else:
+            frequency = np.reshape(frequency, (-1, 1, 1, 1))
+        if polarisation is None:
+            polarisation = np.arange(2)
+        else:
+            polarisation = np.reshape(polarisation, (-1, 1, 1, 1))
+        values = self._channel_values(words, frequency, polarisation)
+
+        # Drop the axes the caller selected a single channel from
+        squeeze = tuple(axis for axis, selected in ((2, frequency.ndim == 4), (3, polarisation.ndim == 4)) if selected)
+        return values.squeeze(axis=squeeze)
+
+    def iter_chunks(self, chunk_samples, offset=0, samples=0, overlap=0, frequency=None, polarisation=None, workers=None):
+        """
+        Reads a set of samples out of the lba file a chunk at a time, so the whole
+        file can be processed without loading it all into ram.
+
+        for chunk in lba.iter_chunks(1000000, overlap=256):
+            ...
 
-        if offset + samples > max_samples:
-            raise Exception("Offset {0}, samples {1} will overflow lba file".format(offset, samples))
+        :param chunk_samples: Number of samples in each chunk. The last chunk may be shorter.
+        :param offset: Sample index to start at (0 indexed)
+        :param samples: Number of samples to read from that index, 0 for the rest of the file.
+        :param overlap: Number of samples from the end of each chunk to repeat at the start of the next one.
+        :param frequency: Frequency index or list of frequency indexes to read, as for read()
+        :param polarisation: Polarisation index or list of polarisation indexes to read, as for read()
+        :param workers: Number of threads to decode each chunk with, as for read()
+        :return: generator of ndarrays with X = samples, Y = frequencies(4), Z = polarisations(2),
+                 without the Y or Z axis if a single frequency or polarisation was selected
+        """
+        if chunk_samples <= 0:
+            raise Exception("Chunk size {0} <= 0".format(chunk_samples))
+        if overlap < 0 or overlap >= chunk_samples:
+            raise Exception("Overlap {0} must be between 0 and chunk size {1}".format(overlap, chunk_samples))
+
+        remaining = self._check_range(offset, samples)
+        shape, channels = self._select_channels(frequency, polarisation)
+
+        tail = None  # Overlap samples from the end of the previous chunk
+        while remaining > 0:
+            carried = 0 if tail is None else tail.shape[0]
+            new_samples = min(chunk_samples - carried, remaining)
+            chunk = np.empty((carried + new_samples,) + shape, dtype=np.int8)
+            if carried > 0:
+                chunk[:carried] = tail
+            self._read_samples(offset, chunk[carried:], channels, workers)
+            offset += new_samples
+            remaining -= new_samples
+
+            if overlap > 0:
+                # Copy it now in case the caller modifies the chunk in place
+                tail = chunk[-overlap:].copy()
+            yield chunk
 
-        sample_offset = offset * bytes_per_sample
+    def __del__(self):
+        # The data view holds a reference to the mmap buffer, so it must go first
+        self._data = None
+        self.mm.close()
 
-        # This will result in a mask for the number of bits in each frequency
-        # e.g. for 4 bits per frequency, this will have the low 4 bits set
-        freq_mask = (1 << num_freq_bits) - 1
 
-        # This will result in a mask for the number of bits in a single sample
-        # e.g. for 2 bits per sample, this will have the low 2 bits set
-        sample_mask = (1 << num_bits) - 1
+def parse_args():
+    parser = argparse.ArgumentParser(description="List the metadata of LBA files.")
+    parser.add_argument('lba_files', type=str, nargs='+', help="LBA files to list")
+    return vars(parser.parse_args())
 
-        # Seek to the desired offset
-        self.mm.seek(data_start + sample_offset, os.SEEK_SET)
 
-        # X = samples, Y = frequency, Z = polarisation
-        nparray = np.zeros((samples, num_freq, 2), dtype=np.int8)
-
-        samples_output = 0  # Number of samples we dumped into nparray
-        samples_read = 0  # Number of samples read, including skipped samples every 32M samples
-        while True:
-            data = self.mm.read(bytes_per_sample)
-            # Read one sample into a byte (should be a short between 0 and 65535)
-            intdata = int.from_bytes(data, byteorder=sys.byteorder)
-
-            if (samples_read + offset) % 32000000 == 0:
-                # Richard said this was all 0s but it was actually all 1s, I hope this is correct.
-                if intdata != 65535:
-                    print("Skip value should have been 65535 @ sample {0}, data may be corrupted.".format(offset + samples_read))
-                else:
-                    print("Skip {0} marker @ sample {1}".format(intdata, offset + samples_read))
-            else:
-                for frequency in range(num_freq):
-                    # One sample contains data across all frequencies (4), with two polarisations per frequency
-                    # e.g. 16 bit sample: 1001,1010,0101,0000
-                    # freq1: 0000, P0: 00, P1: 11
-                    # freq2: 0101, P0: 01, P1: 01
-                    # freq3: 1010, P0: 10, P1: 10
-                    # freq4: 1001, p0: 01, p1: 10
-                    freqdata = intdata >> frequency * num_freq_bits & freq_mask  # Pull out the low 4 bits for this frequency
-                    nparray[samples_output][frequency][0] = val_map[freqdata & sample_mask]  # Pull out the low two bits for P0
-                    nparray[samples_output][frequency][1] = val_map[freqdata >> num_bits & sample_mask]  # Pull out the high two bits for P1
-                samples_output += 1
-
-                if samples_output == samples:
-                    break  # Got everything we need
-            samples_read += 1
+def main():
+    args = parse_args()
+    for path in args['lba_files']:
+        header = LBAHeader.load(path)
+        print("{0}: {1} samples, {2} frequencies, {3} bits, {4} MHz bandwidth, {5} markers".format(
+            path, header.max_samples, header.num_freq, header.num_bits, header.bandwidth, header.num_markers))
 
-        return nparray
 
-    def __del__(self):
-        self.mm.close()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+A cache format for decoded LBA samples, and a single way of opening samples from
+LBA files, numpy files or caches.
+
+The cache stores each channel's samples contiguously, either one int8 per sample or packed
+4 samples to a byte using the same 2 bit encoding as the LBA file. Nothing is compressed,
+so the cache can be memory mapped and int8 channels read without copying.
+
+Layout:
+    8 bytes     CACHE_MAGIC
+    8 bytes     Length of the JSON header, little endian
+    n bytes     JSON header, with the encoding, number of samples and the offset of each channel from the data start
+    padding     Up to a multiple of CACHE_ALIGNMENT bytes, where the data starts
+    channels    Frequency 0 polarisation 0, frequency 0 polarisation 1, frequency 1 polarisation 0...
+                each one starting on a multiple of CACHE_ALIGNMENT bytes
+
+samples = open_samples('file.lbac')
+channel = samples.read(0, 1000000, frequency=1, polarisation=0)
+"""
+
+import argparse
+import json
+import struct
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from lba import LBAFile, build_lookup_table, check_range, select_channels
+
+CACHE_MAGIC = b"LBACACHE"
+CACHE_VERSION = 1
+CACHE_ALIGNMENT = 4096
+CACHE_EXTENSION = ".lbac"
+ENCODINGS = ["int8", "2bit"]
+
+# Samples of every channel are decoded and written to the cache this many at a time
+WRITE_CHUNK_SAMPLES = 4 * 1024 * 1024
+
+
+def open_samples(filename):
+    """
+    Open samples from an LBA file, a cache, or a numpy .npz/.npy file of X = samples, Y = frequencies, Z = polarisations.
+    Everything returned has the same max_samples, read() and read_windows() as LBAFile.
+    :param filename: File to open
+    :return: LBAFile, LBACache or NumpySamples
+    """
+    if filename.endswith(".lba"):
+        with open(filename, "r") as f:
+            # The memory map stays open after the file is closed
+            return LBAFile(f)
+    elif filename.endswith(CACHE_EXTENSION):
+        return LBACache(filename)
+    elif filename.endswith(".npz"):
+        return NumpySamples(np.load(filename)["arr_0"])
+    elif filename.endswith(".npy"):
+        return NumpySamples(np.load(filename, mmap_mode='r'))
+    raise Exception("Unknown file type {0}".format(filename))
+
+
+def _align(offset):
+    return -(-offset // CACHE_ALIGNMENT) * CACHE_ALIGNMENT
+
+
+def _channel_bytes(encoding, samples):
+    return samples if encoding == "int8" else -(-samples // 4)
+
+
+def pack_samples(samples):
+    """
+    Pack int8 samples into 4 samples per byte, lowest bits first, using the LBA 2 bit encoding
+    :param samples: 1D int8 ndarray of -3, -1, 1, 3 values
+    :return: uint8 ndarray
+    """
+    # VAL_MAP is [3, 1, -1, -3], so the code for a value is (3 - value) / 2
+    codes = np.zeros(_channel_bytes("2bit", samples.shape[0]) * 4, dtype=np.uint8)
+    codes[:samples.shape[0]] = (3 - samples.astype(np.int16)) // 2
+    codes = codes.reshape(-1, 4)
+    return codes[:, 0] | codes[:, 1] << 2 | codes[:, 2] << 4 | codes[:, 3] << 6
+
+
+def write_cache(lba, filename, offset=0, samples=0, encoding="int8"):
+    """
+    Decode samples from an LBA file into a cache
+    :param lba: LBAFile to read from
+    :param filename: Cache file to write
+    :param offset: Sample index to start at (0 indexed)
+    :param samples: Number of samples to read from that index, 0 for the rest of the file
+    :param encoding: "int8" or "2bit"
+    """
+    if encoding not in ENCODINGS:
+        raise Exception("Unknown encoding {0}".format(encoding))
+    samples = check_range(offset, samples, lba.max_samples)
+
+    header = {
+        "version": CACHE_VERSION,
+        "encoding": encoding,
+        "samples": samples,
+        "num_freq": lba.num_freq,
+        "sample_offset": offset,
+        "lba_header": lba.header,
+    }
+
+    # Channels are laid out one after the other from the first aligned offset after the header
+    channel_bytes = _channel_bytes(encoding, samples)
+    header["offsets"] = [[_align(channel_bytes) * (frequency * 2 + polarisation) for polarisation in range(2)]
+                         for frequency in range(lba.num_freq)]
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(CACHE_MAGIC) + 8 + len(header_bytes))
+
+    with open(filename, "wb") as f:
+        f.write(CACHE_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+
+        # Decode each chunk of the file once for all the channels, and write each channel's part at the end of it so far.
+        # Chunks are a multiple of 4 samples so they pack into whole bytes
+        positions = [[data_start + channel_offset for channel_offset in offsets] for offsets in header["offsets"]]
+        for chunk in lba.iter_chunks(WRITE_CHUNK_SAMPLES, offset, samples):
+            for frequency in range(lba.num_freq):
+                for polarisation in range(2):
+                    channel = chunk[:, frequency, polarisation]
+                    data = channel.tobytes() if encoding == "int8" else pack_samples(channel).tobytes()
+                    f.seek(positions[frequency][polarisation])
+                    f.write(data)
+                    positions[frequency][polarisation] += len(data)
+        f.truncate(data_start + _align(channel_bytes) * lba.num_freq * 2)
+
+
+class Samples(ABC):
+    """
+    Reading samples the same way as LBAFile from something that can give back a single channel.
+    Subclasses set the num_freq and max_samples attributes, and implement _channel_slice and _channel_gather.
+    """
+
+    @abstractmethod
+    def _channel_slice(self, frequency, polarisation, start, stop):
+        """
+        :param frequency: Frequency index of the channel
+        :param polarisation: Polarisation index of the channel
+        :param start: First sample to return
+        :param stop: Sample to stop before, with 0 <= start <= stop <= max_samples
+        :return: 1D ndarray of samples start to stop for a channel
+        """
+
+    @abstractmethod
+    def _channel_gather(self, frequency, polarisation, indexes):
+        """
+        :param frequency: Frequency index of the channel
+        :param polarisation: Polarisation index of the channel
+        :param indexes: ndarray of sample indexes, all within 0 to max_samples
+        :return: ndarray of the samples at indexes for a channel, with the same shape as indexes
+        """
+
+    def read(self, offset=0, samples=0, frequency=None, polarisation=None):
+        """
+        Reads a set of samples, as for LBAFile.read.
+        A single channel is returned without copying it where possible.
+        :param offset: Sample index to start at (0 indexed)
+        :param samples: Number of samples to read from that index, 0 for the rest
+        :param frequency: Frequency index or list of frequency indexes to read, None for all frequencies
+        :param polarisation: Polarisation index or list of polarisation indexes to read, None for both
+        :return: ndarray with X = samples, Y = frequencies(4), Z = polarisations(2),
+                 without the Y or Z axis if a single frequency or polarisation was selected
+        """
+        samples = check_range(offset, samples, self.max_samples)
+        shape, channels = select_channels(frequency, polarisation, self.num_freq)
+        if shape == ():
+            return self._channel_slice(channels[0][1], channels[0][2], offset, offset + samples)
+
+        nparray = None
+        for index, channel_frequency, channel_polarisation in channels:
+            channel = self._channel_slice(channel_frequency, channel_polarisation, offset, offset + samples)
+            if nparray is None:
+                nparray = np.empty((samples,) + shape, dtype=channel.dtype)
+            nparray[(slice(None),) + index] = channel
+        return nparray
+
+    def read_windows(self, starts, length, frequency=None, polarisation=None):
+        """
+        Reads many short windows of samples at once, as for LBAFile.read_windows
+        :param starts: Sample index (0 indexed) that each window starts at
+        :param length: Number of samples in each window
+        :param frequency: Frequency to read, either one for all windows or one per window. None for all frequencies.
+        :param polarisation: Polarisation to read, either one for all windows or one per window. None for both.
+        :return: ndarray with X = windows, Y = samples, followed by Z = frequencies(4) if frequency is None
+                 and then polarisations(2) if polarisation is None
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        if length <= 0:
+            raise Exception("Window length {0} <= 0".format(length))
+        if starts.size > 0 and (starts.min() < 0 or starts.max() + length > self.max_samples):
+            raise Exception("Windows of {0} samples must start between 0 and {1}".format(length, self.max_samples - length))
+
+        indexes = starts[:, np.newaxis] + np.arange(length)
+        nparray = None
+
+        # Gather each channel for all the windows that use it
+        for channel_frequency in range(self.num_freq):
+            for channel_polarisation in range(2):
+                windows = np.ones(starts.shape[0], dtype=bool)
+                output = ()
+                if frequency is None:
+                    output += (channel_frequency,)
+                else:
+                    windows &= np.asarray(frequency) == channel_frequency
+                if polarisation is None:
+                    output += (channel_polarisation,)
+                else:
+                    windows &= np.asarray(polarisation) == channel_polarisation
+                if not np.any(windows):
+                    continue
+
+                values = self._channel_gather(channel_frequency, channel_polarisation, indexes[windows])
+                if nparray is None:
+                    shape = ((self.num_freq,) if frequency is None else ()) + ((2,) if polarisation is None else ())
+                    nparray = np.empty(indexes.shape + shape, dtype=values.dtype)
+                nparray[(windows, slice(None)) + output] = values
+        return nparray
+
+
+class NumpySamples(Samples):
+    """
+    Samples already held in an ndarray, or a memory mapped .npy file
+    """
+
+    def __init__(self, samples):
+        """
+        :param samples: ndarray with X = samples, Y = frequencies, Z = polarisations
+        """
+        self.samples = samples
+
+    @property
+    def num_freq(self):
+        return self.samples.shape[1]
+
+    @property
+    def max_samples(self):
+        return self.samples.shape[0]
+
+    def _channel_slice(self, frequency, polarisation, start, stop):
+        return np.ascontiguousarray(self.samples[start:stop, frequency, polarisation])
+
+    def _channel_gather(self, frequency, polarisation, indexes):
+        return self.samples[indexes, frequency, polarisation]
+
+
+class LBACache(Samples):
+    """
+    Memory mapped reader for a cache written by write_cache
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: Cache file to open
+        """
+        with open(filename, "rb") as f:
+            if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                raise Exception("{0} is not an LBA cache".format(filename))
+            header_length, = struct.unpack("<Q", f.read(8))
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+        data_start = _align(len(CACHE_MAGIC) + 8 + header_length)
+        if self.header["version"] != CACHE_VERSION:
+            raise Exception("{0} is cache version {1}, expected {2}".format(filename, self.header["version"], CACHE_VERSION))
+
+        self.filename = filename
+        self.encoding = self.header["encoding"]
+        self._lookup_table = build_lookup_table(2)
+        self._mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        channel_bytes = _channel_bytes(self.encoding, self.max_samples)
+        self._channels = [[self._mm[data_start + offset:data_start + offset + channel_bytes] for offset in offsets]
+                          for offsets in self.header["offsets"]]
+        if self.encoding == "int8":
+            self._channels = [[channel.view(np.int8) for channel in channels] for channels in self._channels]
+
+    @property
+    def num_freq(self):
+        return self.header["num_freq"]
+
+    @property
+    def max_samples(self):
+        return self.header["samples"]
+
+    def _channel_slice(self, frequency, polarisation, start, stop):
+        channel = self._channels[frequency][polarisation]
+        if self.encoding == "int8":
+            return channel[start:stop]
+        # Unpack the bytes covering the range, then trim to the samples asked for
+        unpacked = self._lookup_table[channel[start // 4:-(-stop // 4)]].reshape(-1)
+        return unpacked[start % 4:start % 4 + stop - start]
+
+    def _channel_gather(self, frequency, polarisation, indexes):
+        channel = self._channels[frequency][polarisation]
+        if self.encoding == "int8":
+            return channel[indexes]
+        return self._lookup_table[channel[indexes // 4], indexes % 4]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Decode an LBA file into a memory mappable cache.")
+    parser.add_argument('lba_file', type=str, help="LBA file to decode")
+    parser.add_argument('output_file', type=str, help="Cache file to write, should end in {0}".format(CACHE_EXTENSION))
+    parser.add_argument('--offset', type=int, default=0, help="Offset to read samples from")
+    parser.add_argument('--samples', type=int, default=0, help="Number of samples to read from the file")
+    parser.add_argument('--encoding', type=str, default="int8", choices=ENCODINGS, help="How to store each sample")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    with open(args['lba_file'], 'r') as f:
+        lba = LBAFile(f)
+        write_cache(lba, args['output_file'], args['offset'], args['samples'], args['encoding'])
+
+
+if __name__ == "__main__":
+    main()
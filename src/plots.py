@@ -25,21 +25,22 @@
 Methods to generate a variety of plots from lba files
 """
 
-import cupy as cp
-from scipy import signal
 import numpy as np
+import argparse
 import logging
+from concurrent.futures import as_completed
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.mlab as mlab
-from jobs import JobQueue
-from lba import LBAFile
+from jobs import JobQueue, SharedArray
+from lba import CHANNEL_FREQUENCY_MAP, SAMPLE_RATE
+from lba_cache import open_samples
+from renderer import get_renderer
+from sample_statistics import SampleStatistics
+from spectral import Spectra, lombscargle, lombscargle_average
 import os
 import json
 import gc
-
-SAMPLE_RATE = 32000000
+import functools
 
 # Data is at 6.7GHz
 # Each frequency channel is 16MHz wide (stacked upward from 6.7GHz)
@@ -48,15 +49,22 @@ SAMPLE_RATE = 32000000
 
 class LBAPlotter(object):
     # Frequency range for each channel within a polarisation
-    # http://www.atnf.csiro.au/vlbi/dokuwiki/doku.php/lbaops/lbamar2018/v255ae
-    channel_frequency_map = [
-        (6300, 6316),  # f1
-        (6316, 6332),  # f2
-        (6642, 6658),  # f3
-        (6658, 6674)   # f4
-    ]
+    channel_frequency_map = CHANNEL_FREQUENCY_MAP
 
-    def __init__(self, filename, out_directory, sample_offset=0, num_samples=0):
+    # Angular frequencies for the lombscargle periodogram
+    lombscargle_frequencies = np.linspace(0.001, 1.6e6, 1000) * 10
+
+    def __init__(self, filename, out_directory, sample_offset=0, num_samples=0, lombscargle_frequencies=None, lombscargle_chunk_samples=0,
+                 output_format="png"):
+        """
+        :param filename: LBA file or sample cache to plot
+        :param out_directory: Directory to write the plots to
+        :param sample_offset: Offset to read samples from
+        :param num_samples: Number of samples to plot, 0 for the rest of the file
+        :param lombscargle_frequencies: Angular frequencies for the lombscargle periodogram, instead of the default grid
+        :param lombscargle_chunk_samples: If > 0, plot the mean lombscargle periodogram of chunks of this many samples
+        :param output_format: "png" to draw the plots, or "hdf5" to save the arrays that would be plotted
+        """
         self.filename = filename
         self.basefilename = os.path.basename(self.filename)
         self.out_directory = out_directory
@@ -64,6 +72,17 @@ class LBAPlotter(object):
         self.num_samples = num_samples
         self.polarisation = None
         self.frequency = None
+        if lombscargle_frequencies is not None:
+            self.lombscargle_frequencies = lombscargle_frequencies
+        self.lombscargle_chunk_samples = lombscargle_chunk_samples
+        self.output_format = output_format
+        self.renderer = None
+
+    def __getstate__(self):
+        # The renderer's figures stay in the process that made them
+        state = self.__dict__.copy()
+        state["renderer"] = None
+        return state
 
     def get_output_filename(self, filename=""):
         path = self.out_directory
@@ -92,27 +111,11 @@ class LBAPlotter(object):
     @staticmethod
     def create_sample_statistics(samples):
         """
-        Prints some counting statistics for the provided samples
-        :param samples:
-        :return:
+        Counts the sample values of each channel in one pass
+        :param samples: ndarray of X = samples, with any remaining axes channels
+        :return: SampleStatistics, which can be indexed by channel for the statistics of part of the samples
         """
-        unique, counts = np.unique(samples, return_counts=True)
-        counts = dict(zip([int(x) for x in unique], [int(x) for x in counts]))
-        negative = counts[-3] + counts[-1]
-        positive = counts[3] + counts[1]
-        low = counts[-1] + counts[1]
-        high = counts[-3] + counts[3]
-
-        return {
-            "shape": samples.shape,
-            "counts": counts,
-            "neg_counts": negative,
-            "pos_counts": positive,
-            "neg_pos_ratio": negative / positive,
-            "low": low,
-            "high": high,
-            "low_high_radio": low / high
-        }
+        return SampleStatistics.from_samples(samples)
 
     def save_sample_statistics_histogram(self, sample_statistics):
         """
@@ -122,29 +125,26 @@ class LBAPlotter(object):
         """
         x = [-3, -1, 1, 3]
         y = [sample_statistics["counts"][i] for i in x]
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.bar(x, y)
-        plt.title(self.get_plot_title("sample statistics histogram"))
-        plt.xlabel("Sample")
-        plt.ylabel("Count")
-        plt.savefig(self.get_output_filename("sample_statistics_histogram.png"))
-        fig.clear()
-        plt.close(fig)
-
-    def output_sample_statistics(self, samples):
-        # Sample statistics
+        self.renderer.bar(self.get_output_filename("sample_statistics_histogram"),
+                          self.get_plot_title("sample statistics histogram"), "Sample", "Count", x, y)
+
+    def save_sample_statistics(self, sample_statistics):
+        with open(self.get_output_filename("sample_statistics.json"), "w") as sf:
+            json.dump(sample_statistics, sf, indent=4)
+        # histogram of sample statistics
+        self.save_sample_statistics_histogram(sample_statistics)
+
+    def sample_statistics_renders(self, statistics):
+        """
+        Summarises sample statistics to be saved by render()
+        :param statistics: SampleStatistics of the samples to save the statistics of
+        :return: list of (method name, args) to pass to render()
+        """
         try:
-            ss = self.create_sample_statistics(samples)
-            with open(self.get_output_filename("sample_statistics.json"), "w") as sf:
-                json.dump(ss, sf, indent=4)
-            # histogram of sample statistics
-            self.save_sample_statistics_histogram(ss)
+            return [("save_sample_statistics", (statistics.summary(),))]
         except Exception as e:
             print("Error ouputting sample statistics {0}".format(e))
-
-    @staticmethod
-    def create_spectrogram(freq):
-        return signal.spectrogram(freq, fs=SAMPLE_RATE, window=('tukey', 0.5))
+            return []
 
     def merge_spectrograms(self, spectrograms, normalise_local=False):
         fs = []
@@ -161,258 +161,355 @@ class LBAPlotter(object):
 
         return np.concatenate(fs), ts, np.concatenate(sxxs)
 
-    def save_spectrogram(self, spectogram, title="spectrogram", filename="spectrogram.png"):
-        f, t, sxx = spectogram
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Time [sec]")
-        plt.ylabel("Frequency [MHz]")
-        plt.title(self.get_plot_title(title))
-        plt.pcolormesh(t, f, sxx)
-        plt.colorbar()
-        plt.savefig(self.get_output_filename(filename))
-        fig.clear()
-        plt.close(fig)
+    def save_merged_spectrograms(self, index, group):
+        merged = self.merge_spectrograms(group)
+        merged_normalised = self.merge_spectrograms(group, normalise_local=True)
+        self.save_spectrogram(merged, "group {0} merged".format(index), "spectrogram_group{0}_merged".format(index))
+        self.save_spectrogram(merged_normalised, "group {0} merged local normalisation".format(index), "spectrogram_group{0}_merged_normalised".format(index))
 
     @staticmethod
-    def create_periodogram(freq):
-        return signal.periodogram(freq, fs=SAMPLE_RATE, window=('tukey', 0.5))
+    def merged_spectrogram_renders(spectrograms):
+        """
+        :param spectrograms: The spectrogram of each of the 4 frequencies in a polarisation
+        :return: list of (method name, args) to pass to render() to save the merged spectrograms
+        """
+        # freq1, freq2 : freq3, freq4
+        return [("save_merged_spectrograms", (index, spectrograms[index * 2:index * 2 + 2])) for index in range(2)]
+
+    def save_spectrogram(self, spectogram, title="spectrogram", filename="spectrogram"):
+        f, t, sxx = spectogram
+        self.renderer.image(self.get_output_filename(filename), self.get_plot_title(title),
+                            "Time [sec]", "Frequency [MHz]", t, f, sxx)
 
     def save_periodogram(self, periodogram):
         f, pxx = periodogram
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel("Power Spectral Density [V/rtMHz]")
-        plt.title(self.get_plot_title("periodogram"))
-        plt.grid()
-        plt.plot(f, pxx)
-        plt.savefig(self.get_output_filename("periodogram"))
-        fig.clear()
-        plt.close(fig)
-
-    @staticmethod
-    def create_welch(freq):
-        return signal.welch(freq, fs=SAMPLE_RATE, window=('tukey', 0.5))
+        self.renderer.line(self.get_output_filename("periodogram"), self.get_plot_title("periodogram"), "Frequency [MHz]", "Power Spectral Density [V/rtMHz]", f, pxx)
 
     def save_welch(self, welch):
         f, spec = welch
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel("Power Spectral Density [V/rtMHz]")
-        plt.title(self.get_plot_title("welch"))
-        plt.grid()
-        plt.plot(f, spec)
-        plt.savefig(self.get_output_filename("welch"))
-        fig.clear()
-        plt.close(fig)
+        self.renderer.line(self.get_output_filename("welch"), self.get_plot_title("welch"), "Frequency [MHz]", "Power Spectral Density [V/rtMHz]", f, spec)
 
     def create_lombscargle(self, samples):
         start = self.sample_offset / SAMPLE_RATE
-        end = start + self.num_samples / SAMPLE_RATE
+        end = start + samples.shape[0] / SAMPLE_RATE
         times = np.linspace(start, end, samples.shape[0])
 
-        start = 0.001
-        end = 1.6e6
-        freqs = np.linspace(start, end, 1000) * 10
-        return freqs, signal.lombscargle(times, samples, freqs, normalize=True)
+        # The samples and the default frequencies are evenly spaced, so this takes the fast path
+        freqs = np.array(self.lombscargle_frequencies, dtype=np.float64)
+        if self.lombscargle_chunk_samples > 0:
+            return freqs, lombscargle_average(times, samples, freqs, self.lombscargle_chunk_samples, normalize=True)
+        return freqs, lombscargle(times, samples, freqs, normalize=True)
 
     def save_lombscargle(self, lombscargle):
         f, pgram = lombscargle
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel("Power Spectral Density [V/rtMHz]")
-        plt.title(self.get_plot_title("lombscargle"))
-        plt.grid()
-        plt.plot(f, pgram)
-        plt.savefig(self.get_output_filename("lombscargle"))
-        fig.clear()
-        plt.close(fig)
-
-    def create_rfft(self, samples):
-        ft = np.fft.rfft(samples * signal.windows.tukey(samples.shape[0], sym=False))
-        f = np.fft.rfftfreq(samples.shape[0], d=SAMPLE_RATE)
-        np.abs(ft, ft)
-        return f, ft
+        self.renderer.line(self.get_output_filename("lombscargle"), self.get_plot_title("lombscargle"), "Frequency [MHz]", "Power Spectral Density [V/rtMHz]", f, pgram)
 
     def save_rfft(self, fft):
         f, ft = fft
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel("Power [V]")
-        plt.title(self.get_plot_title("fft"))
-        plt.grid()
-        plt.plot(f, ft)
-        plt.savefig(self.get_output_filename("fft"))
-        fig.clear()
-        plt.close(fig)
-
-    def create_ifft(self, samples):
-        ft = np.fft.fft(samples * signal.windows.tukey(samples.shape[0]))
-        f = np.fft.fftfreq(samples.shape[0], d=SAMPLE_RATE)
-        return f, np.imag(ft)
+        self.renderer.line(self.get_output_filename("fft"), self.get_plot_title("fft"), "Frequency [MHz]", "Power [V]", f, ft)
 
     def save_ifft(self, fft):
         f, ft = fft
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel("Power [V]")
-        plt.title(self.get_plot_title("ifft"))
-        plt.grid()
-        plt.plot(f, ft)
-        plt.savefig(self.get_output_filename("ifft"))
-        fig.clear()
-        plt.close(fig)
-
-    def create_psd(self, samples):
-        return mlab.psd(samples, Fs=SAMPLE_RATE, window=signal.get_window(('tukey', 0.5), 256))
+        self.renderer.line(self.get_output_filename("ifft"), self.get_plot_title("ifft"), "Frequency [MHz]", "Power [V]", f, ft)
+
+    @staticmethod
+    def create_spectra(samples):
+        """
+        Computes the FFTs for the spectrogram, periodogram, welch, rfft, ifft, psd and asd of all channels at once
+        :param samples: ndarray of X = samples, Y = frequencies(4), Z = polarisations(2)
+        :return: Spectra with channel frequency * 2 + polarisation
+        """
+        return Spectra(samples.reshape(samples.shape[0], -1).T, SAMPLE_RATE)
 
     def save_psd(self, psd, type, ylabel):
         Pxx, freqs = psd
-        fig = plt.figure(figsize=(16, 9), dpi=80)
-        plt.xlabel("Frequency [MHz]")
-        plt.ylabel(ylabel)
-        plt.title(self.get_plot_title(type))
-        plt.grid()
-        plt.plot(freqs, Pxx)
-        plt.savefig(self.get_output_filename(type))
-        fig.clear()
-        plt.close(fig)
+        self.renderer.line(self.get_output_filename(type), self.get_plot_title(type), "Frequency [MHz]", ylabel, freqs, Pxx)
 
-    def __call__(self):
+    def open_samples(self):
+        """
+        Opens the input file for reading samples from.
+        A single frequency and polarisation can be read on its own, or all of the channels at once.
+        :return: function taking (frequency=None, polarisation=None) that returns the selected samples,
+                 with X = samples, Y = frequencies(4), Z = polarisations(2) as for LBAFile.read
+        """
+        self.LOG.info("Opening {0}...".format(self.filename))
+        samples = open_samples(self.filename)
+        return functools.partial(samples.read, self.sample_offset, self.num_samples)
+
+    def analyse_channel(self, freq_samples, spectra, channel, freq, pindex, statistics=None):
+        """
+        Calculates everything that is plotted for one channel
+        :param freq_samples: Samples for the channel
+        :param spectra: Spectra holding the channel
+        :param channel: Index of the channel in spectra
+        :param freq: Frequency index of the channel
+        :param pindex: Polarisation index of the channel
+        :param statistics: SampleStatistics of the channel, if they've already been counted
+        :return: list of (method name, args) to pass to render(), and the spectrogram for merging
+        """
+        self.LOG.info("{0}, P{1}, F{2} Sample statistics...".format(self.filename, pindex, freq))
+        if statistics is None:
+            statistics = self.create_sample_statistics(freq_samples)
+        renders = self.sample_statistics_renders(statistics)
+
+        # Spectrogram for this frequency
+        self.LOG.info("{0}, P{1}, F{2} Spectrogram".format(self.filename, pindex, freq))
+        f, t, sxx = spectra.spectrogram(channel)
+        # Calculate the actual frequencies for the spectrogram
+        self.fix_freq(f, freq)
+        spectrogram = (f, t, sxx)
+        renders.append(("save_spectrogram", (spectrogram,)))
+
+        # Periodogram for this frequency
+        self.LOG.info("{0}, P{1}, F{2} Periodogram".format(self.filename, pindex, freq))
+        f, pxx = spectra.periodogram(channel)
+        self.fix_freq(f, freq)
+        renders.append(("save_periodogram", ((f, pxx),)))
+
+        # Welch
+        self.LOG.info("{0}, P{1}, F{2} Welch".format(self.filename, pindex, freq))
+        f, spec = spectra.welch(channel)
+        self.fix_freq(f, freq)
+        renders.append(("save_welch", ((f, spec),)))
+
+        # Lombscargle
+        try:
+            self.LOG.info("{0}, P{1}, F{2} Lombscargle".format(self.filename, pindex, freq))
+            f, pxx = self.create_lombscargle(freq_samples)
+            self.fix_freq(f, freq)
+            renders.append(("save_lombscargle", ((f, pxx),)))
+        except ZeroDivisionError:
+            print("Zero division in Lombscargle")
+
+        # RFFT
+        self.LOG.info("{0}, P{1}, F{2} RFFT".format(self.filename, pindex, freq))
+        f, ft = spectra.rfft(channel)
+        self.fix_freq(f, freq)
+        renders.append(("save_rfft", ((f, ft),)))
+
+        # IFFT
+        self.LOG.info("{0}, P{1}, F{2} IRFFT".format(self.filename, pindex, freq))
+        f, ft = spectra.ifft(channel)
+        self.fix_freq(f, freq)
+        renders.append(("save_ifft", ((f, ft),)))
+
+        # power spectral density
+        self.LOG.info("{0}, P{1}, F{2} PSD".format(self.filename, pindex, freq))
+        Pxx, f = spectra.psd(channel)
+        self.fix_freq(f, freq)
+        renders.append(("save_psd", ((Pxx, f), "Power Spectral Density", "Power Spectral Density [V/rtMHz]")))
+
+        # amplitude spectral density
+        self.LOG.info("{0}, P{1}, F{2} ASD".format(self.filename, pindex, freq))
+        Pxx, f = spectra.asd(channel)
+        self.fix_freq(f, freq)
+        renders.append(("save_psd", ((Pxx, f), "Amplitude Spectral Density", "Amplitude Spectral Density [sqrt(V/rtMHz)]")))
+
+        return renders, spectrogram
+
+    def render(self, renders, polarisation=None, frequency=None):
+        """
+        Saves the plots calculated for the whole file, a polarisation or a channel
+        :param renders: list of (method name, args) to call to save each plot
+        :param polarisation: Polarisation the plots are for, or None
+        :param frequency: Frequency the plots are for, or None
+        """
+        self.polarisation = polarisation
+        self.frequency = frequency
+        os.makedirs(self.get_output_filename(), exist_ok=True)
+        for method, args in renders:
+            self.LOG.info("{0}, P{1}, F{2} Saving {3}".format(self.filename, polarisation, frequency, method))
+            getattr(self, method)(*args)
+        self.polarisation = None
+        self.frequency = None
+
+    def setup(self):
+        """
+        Sets up logging and matplotlib in the process the plotter runs in
+        """
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
         self.LOG = logging.getLogger(__name__)
+        matplotlib.rc('font', weight='normal', size=18)
+        self.renderer = get_renderer(self.output_format)
 
+    def __call__(self):
+        self.setup()
         self.LOG.info("Plotter for {0} started".format(self.filename))
-        matplotlib.rc('font', weight='normal', size=18)
 
         # Firstly, create the output directory
         os.makedirs(self.out_directory, exist_ok=True)
         self.LOG.info("Output directory {0} created".format(self.out_directory))
 
-        if self.filename.endswith(".lba"):
-            with open(self.filename, "r") as f:
-                self.LOG.info("Opening LBA file {0} and reading samples...".format(self.filename))
-                lba = LBAFile(f)
-                samples = lba.read(self.sample_offset, self.num_samples)
-                del lba
-                gc.collect()  # Ensure the loaded lba file is unloaded
-        elif self.filename.endswith(".npz"):
-            samples = np.load(self.filename)["arr_0"]
-
-        self.LOG.info("Read {0} samples".format(self.num_samples))
+        read_samples = self.open_samples()
 
         # Do global things across all samples
+        samples = read_samples()
+        # Count every channel's samples once. The polarisation and file statistics are sums of the channel counts.
         self.LOG.info("Calculating sample statistics for entire dataset...")
-        self.output_sample_statistics(samples)
+        statistics = self.create_sample_statistics(samples)
+        self.render(self.sample_statistics_renders(statistics))
+
+        # Window and FFT every channel once, in one batch, for all of the spectral plots
+        self.LOG.info("Calculating spectra for all channels...")
+        spectra = self.create_spectra(samples)
 
         # Iterate over each of the two polarisations
-        for pindex in range(samples.shape[2]):
+        for pindex in range(2):
             self.LOG.info("{0} Polarisation {1}".format(self.filename, pindex))
-            p = samples[:, :, pindex]
-
-            self.polarisation = pindex
-            os.makedirs(self.get_output_filename(), exist_ok=True)
             self.LOG.info("{0}, P{1} Sample statistics...".format(self.filename, pindex))
-            self.output_sample_statistics(p)
+            self.render(self.sample_statistics_renders(statistics[:, pindex]), pindex)
 
-            spectrogram_groups = [[], []]  # freq1, freq2 : freq3, freq4
+            spectrograms = []
             # Iterate over each of the four frequencies
-            for freq in range(p.shape[1]):
+            for freq in range(len(self.channel_frequency_map)):
                 self.LOG.info("{0}, P{1} Frequency {2}".format(self.filename, pindex, freq))
-                freq_samples = p[:, freq]
-
-                self.frequency = freq
-                os.makedirs(self.get_output_filename(), exist_ok=True)
-                self.LOG.info("{0}, P{1}, F{2} Sample statistics...".format(self.filename, pindex, freq))
-                self.output_sample_statistics(freq_samples)
-
-                # Spectrogram for this frequency
-                self.LOG.info("{0}, P{1}, F{2} Spectrogram".format(self.filename, pindex, freq))
-                f, t, sxx = self.create_spectrogram(freq_samples)
-                # Calculate the actual frequencies for the spectrogram
-                self.fix_freq(f, freq)
-                spectrogram = (f, t, sxx)
-                spectrogram_groups[freq // 2].append(spectrogram)
-                self.LOG.info("{0}, P{1}, F{2} Spectrogram Saving".format(self.filename, pindex, freq))
-                self.save_spectrogram(spectrogram)
-
-                # Periodogram for this frequency
-                self.LOG.info("{0}, P{1}, F{2} Periodogram".format(self.filename, pindex, freq))
-                f, pxx = self.create_periodogram(freq_samples)
-                self.fix_freq(f, freq)
-                self.LOG.info("{0}, P{1}, F{2} Periodogram Saving".format(self.filename, pindex, freq))
-                self.save_periodogram((f, pxx))
-
-                # Welch
-                self.LOG.info("{0}, P{1}, F{2} Welch".format(self.filename, pindex, freq))
-                f, spec = self.create_welch(freq_samples)
-                self.fix_freq(f, freq)
-                self.LOG.info("{0}, P{1}, F{2} Welch Saving".format(self.filename, pindex, freq))
-                self.save_welch((f, spec))
-
-                # Lombscargle
-                try:
-                    self.LOG.info("{0}, P{1}, F{2} Lombscargle".format(self.filename, pindex, freq))
-                    f, pxx = self.create_lombscargle(freq_samples)
-                    self.fix_freq(f, freq)
-                    self.LOG.info("{0}, P{1}, F{2} Lombscargle Saving".format(self.filename, pindex, freq))
-                    self.save_lombscargle((f, pxx))
-                except ZeroDivisionError:
-                    print("Zero division in Lombscargle")
-
-                # RFFT
-                self.LOG.info("{0}, P{1}, F{2} RFFT".format(self.filename, pindex, freq))
-                f, ft = self.create_rfft(freq_samples)
-                self.fix_freq(f, freq)
-                self.LOG.info("{0}, P{1}, F{2} RFFT Saving".format(self.filename, pindex, freq))
-                self.save_rfft((f, ft))
-
-                # IFFT
-                self.LOG.info("{0}, P{1}, F{2} IRFFT".format(self.filename, pindex, freq))
-                f, ft = self.create_ifft(freq_samples)
-                self.fix_freq(f, freq)
-                self.LOG.info("{0}, P{1}, F{2} IRFFT Saving".format(self.filename, pindex, freq))
-                self.save_ifft((f, ft))
-
-                # power spectral density
-                self.LOG.info("{0}, P{1}, F{2} PSD".format(self.filename, pindex, freq))
-                Pxx, f = self.create_psd(freq_samples)
-                self.fix_freq(f, freq)
-                self.LOG.info("{0}, P{1}, F{2} PSD Saving".format(self.filename, pindex, freq))
-                self.save_psd((Pxx, f), "Power Spectral Density", "Power Spectral Density [V/rtMHz]")
-
-                # amplitude spectral density
-                self.LOG.info("{0}, P{1}, F{2} ASD".format(self.filename, pindex, freq))
-                np.sqrt(Pxx, Pxx)
-                self.LOG.info("{0}, P{1}, F{2} ASD Saving".format(self.filename, pindex, freq))
-                self.save_psd((Pxx, f), "Amplitude Spectral Density", "Amplitude Spectral Density [sqrt(V/rtMHz)]")
-
-            self.frequency = None
+                # Slice the channel out of the samples already read, rather than decoding the file again
+                freq_samples = np.ascontiguousarray(samples[:, freq, pindex])
+                renders, spectrogram = self.analyse_channel(freq_samples, spectra, freq * 2 + pindex, freq, pindex,
+                                                            statistics[freq, pindex])
+                self.render(renders, pindex, freq)
+                spectrograms.append(spectrogram)
 
             # Create merged spectrograms for this p
             self.LOG.info("{0}, P{1} Merged Spectrograms...".format(self.filename, pindex))
-            for index, group in enumerate(spectrogram_groups):
-                self.LOG.info("{0}, P{1} Merged Spectrograms Group {2}".format(self.filename, pindex, index))
-                merged = self.merge_spectrograms(group)
-                merged_normalised = self.merge_spectrograms(group, normalise_local=True)
-                self.LOG.info("{0}, P{1} Merged Spectrograms Group {2} Saving".format(self.filename, pindex, index))
-                self.save_spectrogram(merged, "group {0} merged".format(index), "spectrogram_group{0}_merged.png".format(index))
-                self.save_spectrogram(merged_normalised, "group {0} merged local normalisation".format(index), "spectrogram_group{0}_merged_normalised.png".format(index))
+            self.render(self.merged_spectrogram_renders(spectrograms), pindex)
 
 
-if __name__ == "__main__":
-    #queue = JobQueue(8)
-
-    # Load each file using a process pool
-    num_samples = 1919999940 // 2048  # SAMPLE_RATE # should be 1 second
-    LBAPlotter("../data/v255ae_At_072_060000.lba", "./At_out/", num_samples=num_samples)()
-    gc.collect()
-    LBAPlotter("../data/v255ae_Mp_072_060000.lba", "./Mp_out/", num_samples=num_samples)()
-    gc.collect()
-    LBAPlotter("../data/vt255ae_Pa_072_060000.lba", "./Pa_out/", num_samples=num_samples)()
-    gc.collect()
-    #queue.submit()
-    #queue.submit()
-    #queue.submit()
+class AnalysisTask(object):
+    """
+    Calculates the plots for one channel of a file in a worker process. The file's samples are read from shared memory.
+    The channel's sample statistics are returned too, to be merged into the statistics of its polarisation and file.
+    """
+
+    def __init__(self, plotter, samples, polarisation, frequency):
+        """
+        :param plotter: LBAPlotter for the file
+        :param samples: SharedArray of X = samples, Y = frequencies(4), Z = polarisations(2)
+        :param polarisation: Polarisation to analyse
+        :param frequency: Frequency to analyse
+        """
+        self.plotter = plotter
+        self.samples = samples
+        self.polarisation = polarisation
+        self.frequency = frequency
+
+    def __call__(self):
+        self.plotter.setup()
+        samples = self.samples.array
+        try:
+            freq_samples = np.ascontiguousarray(samples[:, self.frequency, self.polarisation])
+            statistics = self.plotter.create_sample_statistics(freq_samples)
+            # The pool already runs a task per core, so one FFT thread each rather than a thread per core in every worker
+            spectra = Spectra(freq_samples, SAMPLE_RATE, workers=1)
+            renders, spectrogram = self.plotter.analyse_channel(freq_samples, spectra, 0, self.frequency, self.polarisation, statistics)
+        finally:
+            # The shared memory can't be closed while there are still views of it
+            del samples
+            self.samples.close()
+        return RenderTask(self.plotter, renders, self.polarisation, self.frequency), spectrogram, statistics
+
+
+class RenderTask(object):
+    """
+    Saves the plots calculated by an AnalysisTask in a worker process
+    """
+
+    def __init__(self, plotter, renders, polarisation=None, frequency=None):
+        self.plotter = plotter
+        self.renders = renders
+        self.polarisation = polarisation
+        self.frequency = frequency
+
+    def __call__(self):
+        self.plotter.setup()
+        self.plotter.render(self.renders, self.polarisation, self.frequency)
+
+
+def plot_parallel(plotters, analysis_workers=8, render_workers=8):
+    """
+    Runs LBAPlotters in parallel. Each channel of each file is analysed by a pool of analysis processes,
+    and the results are plotted by a separate pool of render processes as soon as they are ready.
+    Each file is decoded once into shared memory, which every analysis process reads without copying.
+    :param plotters: LBAPlotters to run
+    :param analysis_workers: Number of processes to analyse channels in
+    :param render_workers: Number of processes to plot in
+    """
+    shared_samples = []
+    try:
+        with JobQueue(analysis_workers) as analysis_queue, JobQueue(render_workers) as render_queue:
+            futures = []
+            for plotter in plotters:
+                plotter.setup()
+                os.makedirs(plotter.out_directory, exist_ok=True)
+                samples = SharedArray.copy(plotter.open_samples()())
+                shared_samples.append(samples)
+
+                for pindex in range(2):
+                    futures.extend(analysis_queue.submit(AnalysisTask(plotter, samples, pindex, freq))
+                                   for freq in range(len(plotter.channel_frequency_map)))
+
+            # Plot each result as it comes in. Once all of a polarisation's channels are in, plot its merged
+            # spectrograms and statistics, and once both polarisations are in, the statistics of the whole file.
+            spectrograms = {}
+            file_statistics = {}
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    # The consumer has already printed it
+                    continue
+                render, spectrogram, statistics = future.result()
+                render_queue.submit(render)
+                plotter = render.plotter
+                num_frequencies = len(plotter.channel_frequency_map)
+                group = spectrograms.setdefault((plotter.out_directory, render.polarisation), [None] * num_frequencies)
+                group[render.frequency] = spectrogram
+                merged = file_statistics.setdefault(plotter.out_directory, [SampleStatistics((num_frequencies, 2)), 0])
+                merged[0].merge(statistics, (render.frequency, render.polarisation))
+                merged[1] += 1
+                if all(s is not None for s in group):
+                    renders = plotter.merged_spectrogram_renders(group) + plotter.sample_statistics_renders(merged[0][:, render.polarisation])
+                    render_queue.submit(RenderTask(plotter, renders, render.polarisation))
+                if merged[1] == num_frequencies * 2:
+                    render_queue.submit(RenderTask(plotter, plotter.sample_statistics_renders(merged[0])))
+            render_queue.join()
+
+            logging.getLogger(__name__).info("Analysis took {0:.1f}s and rendering {1:.1f}s of worker time, moving {2:,} bytes".format(
+                sum(timing.run for timing in analysis_queue.timings), sum(timing.run for timing in render_queue.timings),
+                sum(transfer.total for transfer in analysis_queue.transfers + render_queue.transfers)))
+    finally:
+        for samples in shared_samples:
+            samples.unlink()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Plot the At, Mp and Pa LBA files.")
+    parser.add_argument('--samples', type=int, default=1919999940 // 2048, help="Number of samples to plot from each file")
+    parser.add_argument('--workers', type=int, default=0, help="Number of processes to analyse channels in, 0 to plot each file in turn in this process")
+    parser.add_argument('--render_workers', type=int, default=4, help="Number of processes to plot in")
+    parser.add_argument('--lombscargle_chunk_samples', type=int, default=0, help="Average the lombscargle periodogram over chunks of this many samples")
+    parser.add_argument('--output_format', choices=["png", "hdf5"], default="png", help="Draw the plots as PNGs, or save the arrays to HDF5 files")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    num_samples = args['samples']  # SAMPLE_RATE # should be 1 second
+    options = {"num_samples": num_samples,
+               "lombscargle_chunk_samples": args['lombscargle_chunk_samples'],
+               "output_format": args['output_format']}
+    plotters = [
+        LBAPlotter("../data/v255ae_At_072_060000.lba", "./At_out/", **options),
+        LBAPlotter("../data/v255ae_Mp_072_060000.lba", "./Mp_out/", **options),
+        LBAPlotter("../data/vt255ae_Pa_072_060000.lba", "./Pa_out/", **options)
+    ]
     # queue.submit(LBAPlotter("../data/downsamples.npz", "./downsamples_out/"))
 
-    #queue.join()
+    if args['workers'] > 0:
+        plot_parallel(plotters, args['workers'], args['render_workers'])
+    else:
+        for plotter in plotters:
+            plotter()
+            gc.collect()
+
+
+if __name__ == "__main__":
+    main()
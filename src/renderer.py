@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+Renderers that save the plots made by LBAPlotter.
+
+FigureRenderer draws PNGs. It keeps one figure per kind of plot and updates the artists in it for each
+plot, rather than creating and destroying a figure every time. Lines are reduced to a min / max envelope
+with one pair of points per pixel column, and images are averaged down to the size of the axes before
+being drawn with imshow, so the cost of a plot doesn't grow with the number of samples.
+
+HDF5Renderer writes the full resolution arrays of each plot to a HDF5 file instead, for plotting or
+analysing later.
+"""
+
+import h5py
+import numpy as np
+from matplotlib.figure import Figure
+
+FIGURE_SIZE = (16, 9)
+DPI = 80
+
+
+def reduce_bins(array, bins, ufunc, axis=0):
+    """
+    Reduces an array along an axis into bins of (nearly) equal numbers of elements
+    :param array: Array to reduce
+    :param bins: Number of bins
+    :param ufunc: numpy ufunc to reduce each bin with, e.g. np.minimum
+    :param axis: Axis to reduce along
+    :return: Array with bins elements along axis, and the index each bin starts at
+    """
+    starts = np.linspace(0, array.shape[axis], bins, endpoint=False).astype(np.int64)
+    return ufunc.reduceat(array, starts, axis=axis), starts
+
+
+def envelope(x, y, max_points):
+    """
+    Reduces a line to the min and max of y in each of max_points / 2 bins, which draws the same as the whole
+    line when there is a bin per pixel column.
+    :param x: x values of the line
+    :param y: y values of the line
+    :param max_points: Maximum number of points to return
+    :return: x, y of the envelope, or of the line if it is short enough already
+    """
+    y = np.asarray(y)
+    bins = max_points // 2
+    if y.shape[0] <= max_points or bins < 1:
+        return x, y
+    low, starts = reduce_bins(y, bins, np.minimum)
+    high, _ = reduce_bins(y, bins, np.maximum)
+    return np.repeat(np.asarray(x)[starts], 2), np.stack((low, high), axis=1).ravel()
+
+
+def downsample_image(z, max_shape):
+    """
+    Averages an image down to at most max_shape
+    :param z: 2D array
+    :param max_shape: (rows, columns) to reduce z to
+    :return: The averaged array, or z if it is small enough already
+    """
+    for axis, size in enumerate(max_shape):
+        if z.shape[axis] > size > 0:
+            total, starts = reduce_bins(z, size, np.add, axis)
+            counts = np.diff(np.append(starts, z.shape[axis]))
+            z = total / (counts if axis == 1 else counts[:, np.newaxis])
+    return z
+
+
+class FigureRenderer(object):
+    """
+    Saves plots as PNGs, reusing a figure and its artists for each kind of plot
+    """
+
+    extension = ".png"
+
+    def __init__(self, figsize=FIGURE_SIZE, dpi=DPI):
+        self.figsize = figsize
+        self.dpi = dpi
+        self.figures = {}
+
+    def _figure(self, kind, title, xlabel, ylabel, grid):
+        """
+        :return: The figure and axes for a kind of plot, and the artists already in it
+        """
+        if kind not in self.figures:
+            fig = Figure(figsize=self.figsize, dpi=self.dpi)
+            ax = fig.add_subplot(1, 1, 1)
+            ax.grid(grid)
+            self.figures[kind] = (fig, ax, {})
+        fig, ax, artists = self.figures[kind]
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        return fig, ax, artists
+
+    def _pixels(self, fig, ax):
+        """
+        :return: (height, width) of the axes in pixels
+        """
+        bbox = ax.get_position()
+        width, height = fig.get_size_inches() * fig.dpi
+        return int(np.ceil(bbox.height * height)), int(np.ceil(bbox.width * width))
+
+    def line(self, filename, title, xlabel, ylabel, x, y):
+        """
+        Saves a line plot
+        :param filename: File to save to, without the extension
+        :param title: Plot title
+        :param xlabel: x axis label
+        :param ylabel: y axis label
+        :param x: x values
+        :param y: y values
+        """
+        fig, ax, artists = self._figure("line", title, xlabel, ylabel, True)
+        _, width = self._pixels(fig, ax)
+        x, y = envelope(x, y, width * 2)
+        if "line" not in artists:
+            artists["line"], = ax.plot(x, y)
+        else:
+            artists["line"].set_data(x, y)
+            ax.relim()
+            ax.autoscale_view()
+        fig.savefig(filename + self.extension)
+
+    def image(self, filename, title, xlabel, ylabel, x, y, z):
+        """
+        Saves an image, such as a spectrogram, with a colour bar
+        :param filename: File to save to, without the extension
+        :param title: Plot title
+        :param xlabel: x axis label
+        :param ylabel: y axis label
+        :param x: Evenly spaced x values of the columns of z
+        :param y: Evenly spaced y values of the rows of z
+        :param z: 2D array of values to plot
+        """
+        fig, ax, artists = self._figure("image", title, xlabel, ylabel, False)
+        z = downsample_image(z, self._pixels(fig, ax))
+        extent = (x[0], x[-1], y[0], y[-1])
+        if "image" not in artists:
+            artists["image"] = ax.imshow(z, extent=extent, origin='lower', aspect='auto', interpolation='nearest')
+            artists["colorbar"] = fig.colorbar(artists["image"], ax=ax)
+        else:
+            artists["image"].set_data(z)
+            artists["image"].set_extent(extent)
+            artists["image"].set_clim(np.min(z), np.max(z))
+        fig.savefig(filename + self.extension)
+
+    def bar(self, filename, title, xlabel, ylabel, x, heights):
+        """
+        Saves a bar chart
+        :param filename: File to save to, without the extension
+        :param title: Plot title
+        :param xlabel: x axis label
+        :param ylabel: y axis label
+        :param x: x position of each bar
+        :param heights: Height of each bar
+        """
+        fig, ax, artists = self._figure("bar", title, xlabel, ylabel, False)
+        if artists.get("x") != list(x):
+            # Different bars, rather than new heights for the same ones
+            if "bars" in artists:
+                artists["bars"].remove()
+            artists["bars"] = ax.bar(x, heights)
+            artists["x"] = list(x)
+        else:
+            for bar, height in zip(artists["bars"], heights):
+                bar.set_height(height)
+            ax.relim()
+            ax.autoscale_view()
+        fig.savefig(filename + self.extension)
+
+
+class HDF5Renderer(object):
+    """
+    Saves the full resolution arrays of each plot to a HDF5 file, with the title and labels as attributes
+    """
+
+    extension = ".h5"
+
+    @classmethod
+    def _save(cls, filename, title, labels, **arrays):
+        with h5py.File(filename + cls.extension, "w") as f:
+            f.attrs["title"] = title
+            for name, label in labels.items():
+                f.attrs[name] = label
+            for name, array in arrays.items():
+                f.create_dataset(name, data=np.asarray(array))
+
+    def line(self, filename, title, xlabel, ylabel, x, y):
+        self._save(filename, title, {"xlabel": xlabel, "ylabel": ylabel}, x=x, y=y)
+
+    def image(self, filename, title, xlabel, ylabel, x, y, z):
+        self._save(filename, title, {"xlabel": xlabel, "ylabel": ylabel}, x=x, y=y, z=z)
+
+    def bar(self, filename, title, xlabel, ylabel, x, heights):
+        self._save(filename, title, {"xlabel": xlabel, "ylabel": ylabel}, x=x, heights=heights)
+
+
+RENDERERS = {
+    "png": FigureRenderer,
+    "hdf5": HDF5Renderer
+}
+
+# The renderer of each format in this process, so its figures are reused by every plotter the process runs
+_renderers = {}
+
+
+def get_renderer(output_format="png"):
+    """
+    :param output_format: "png" or "hdf5"
+    :return: The renderer for the format in this process
+    """
+    if output_format not in RENDERERS:
+        raise Exception("Unknown output format {0}, expected one of {1}".format(output_format, ", ".join(RENDERERS)))
+    if output_format not in _renderers:
+        _renderers[output_format] = RENDERERS[output_format]()
+    return _renderers[output_format]
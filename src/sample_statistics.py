@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+Counting statistics of LBA samples, accumulated a chunk at a time.
+
+SampleStatistics counts the -3, -1, 1 and 3 samples of every channel with one bincount per chunk. The
+statistics of a polarisation or the whole file are sums of the channel counts, so they don't need
+another pass over the samples, and statistics from separate chunks or workers can be merged.
+"""
+
+import numpy as np
+from lba import VAL_MAP
+
+# The sample values that are counted, in the order they're stored
+VALUES = sorted(VAL_MAP)
+
+# Samples counted at a time, to bound the memory used by bincount
+CHUNK_SAMPLES = 1024 * 1024
+
+# Bin of each int8 sample, through its uint8 view. Anything that isn't a sample value goes in the last bin.
+_BINS = np.full(256, len(VALUES), dtype=np.uint8)
+_BINS[np.array(VALUES, dtype=np.int8).view(np.uint8)] = np.arange(len(VALUES))
+
+
+class SampleStatistics(object):
+    """
+    Counts of each sample value per channel
+    """
+
+    def __init__(self, channel_shape=()):
+        """
+        :param channel_shape: Shape of the channel axes of the samples, e.g. (frequencies, polarisations)
+        """
+        # The last bin counts values other than VALUES
+        self.counts = np.zeros(tuple(channel_shape) + (len(VALUES) + 1,), dtype=np.int64)
+
+    @classmethod
+    def from_samples(cls, samples):
+        """
+        :param samples: ndarray of X = samples, with the remaining axes channels
+        :return: SampleStatistics of the samples
+        """
+        statistics = cls(samples.shape[1:])
+        statistics.add(samples)
+        return statistics
+
+    @property
+    def channel_shape(self):
+        return self.counts.shape[:-1]
+
+    def add(self, samples):
+        """
+        Counts a chunk of samples
+        :param samples: ndarray of X = samples, with the remaining axes matching channel_shape
+        """
+        if samples.shape[1:] != self.channel_shape:
+            raise Exception("Samples have channel shape {0}, expected {1}".format(samples.shape[1:], self.channel_shape))
+        if samples.dtype != np.int8:
+            if not np.issubdtype(samples.dtype, np.integer):
+                raise Exception("Sample statistics need integer samples, not {0}".format(samples.dtype))
+            samples = np.clip(samples, -128, 127).astype(np.int8)
+
+        num_bins = self.counts.shape[-1]
+        num_channels = self.counts.size // num_bins
+        # Offset each channel's bins, so one bincount counts every channel
+        offsets = (np.arange(num_channels, dtype=np.intp) * num_bins).reshape(self.channel_shape)
+        for start in range(0, samples.shape[0], CHUNK_SAMPLES):
+            chunk = samples[start:start + CHUNK_SAMPLES]
+            bins = _BINS[chunk.view(np.uint8)] + offsets
+            self.counts += np.bincount(bins.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other, index=()):
+        """
+        Adds the counts of other statistics to these
+        :param other: SampleStatistics to add
+        :param index: Index of the channels the other statistics are for, e.g. (frequency, polarisation)
+        :return: self
+        """
+        self.counts[index] += other.counts
+        return self
+
+    def __getitem__(self, index):
+        """
+        :param index: Index into the channel axes, e.g. [:, polarisation]
+        :return: SampleStatistics of the selected channels
+        """
+        if not isinstance(index, tuple):
+            index = (index,)
+        statistics = SampleStatistics()
+        statistics.counts = self.counts[index + (Ellipsis,)]
+        return statistics
+
+    def summary(self):
+        """
+        :return: dict of the counts and ratios over all of the channels
+        """
+        counts = self.counts.reshape(-1, self.counts.shape[-1])
+        totals = counts.sum(axis=0)
+        counts = dict(zip(VALUES, (int(x) for x in totals)))
+        negative = counts[-3] + counts[-1]
+        positive = counts[3] + counts[1]
+        low = counts[-1] + counts[1]
+        high = counts[-3] + counts[3]
+
+        return {
+            "shape": (int(self.counts.sum(axis=-1).max(initial=0)),) + self.channel_shape,
+            "counts": counts,
+            "invalid": int(totals[-1]),
+            "neg_counts": negative,
+            "pos_counts": positive,
+            "neg_pos_ratio": negative / positive,
+            "low": low,
+            "high": high,
+            "low_high_radio": low / high
+        }
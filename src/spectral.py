@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+Shared FFT spectral engine.
+
+The spectrogram, Welch, periodogram, PSD, ASD and FFT views of a signal all window and FFT the same samples.
+Spectra does those FFTs once, for any number of channels at a time, and derives each view from them.
+
+The segmented views all share one set of segments, overlapping by half, with one FFT per segment:
+ - spectrogram: the density of each (detrended) segment
+ - welch: the mean density of all (detrended) segments
+ - psd: the mean density of every other segment without detrending, which don't overlap (as for mlab.psd)
+
+The whole signal views share one full length FFT:
+ - periodogram: the density of the (detrended) signal
+ - rfft: the magnitude of the FFT
+ - ifft: the imaginary part of the FFT, over positive and negative frequencies
+
+Removing the mean of a segment before windowing subtracts mean * FFT(window) from its FFT,
+so detrended and raw views can come from the same FFT.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft, signal
+
+
+def one_sided_density(ft, window, sample_rate, length):
+    """
+    Power spectral density of one sided FFTs, scaled the same as scipy.signal.welch and mlab.psd
+    :param ft: rfft output, with the frequencies on the last axis
+    :param window: Window the FFT input was multiplied by
+    :param sample_rate: Sample rate of the signal
+    :param length: Number of samples in the FFT input
+    :return: Power spectral density, same shape as ft
+    """
+    density = ft.real ** 2 + ft.imag ** 2
+    density /= sample_rate * np.sum(window ** 2)
+    # Double everything except DC and Nyquist for the power in the negative frequencies
+    density[..., 1:None if length % 2 else -1] *= 2
+    return density
+
+
+def segment_densities(samples, sample_rate, nperseg=256, hop=None, window=('tukey', 0.5)):
+    """
+    The (detrended) density of each segment of the samples, the same as Spectra.spectrogram but without
+    the whole signal FFT. For building spectrograms a block of samples at a time.
+    :param samples: ndarray of X = channels, Y = samples
+    :param sample_rate: Sample rate of the signal
+    :param nperseg: Samples per segment
+    :param hop: Samples between the start of each segment, defaults to nperseg // 2
+    :param window: Window to apply, in any form accepted by scipy.signal.get_window
+    :return: ndarray of X = channels, Y = segments, Z = frequencies
+    """
+    hop = nperseg // 2 if hop is None else hop
+    segment_window = signal.get_window(window, nperseg)
+    segments = sliding_window_view(np.asarray(samples, dtype=np.float64), nperseg, axis=1)[:, ::hop]
+    ft = fft.rfft(segments * segment_window, axis=2, workers=-1)
+    ft -= segments.mean(axis=2)[:, :, np.newaxis] * fft.rfft(segment_window)
+    return one_sided_density(ft, segment_window, sample_rate, nperseg)
+
+
+def _even_step(values, rtol=1e-6):
+    """
+    :return: The step between evenly spaced values, or None if they aren't evenly spaced
+    """
+    if values.shape[0] < 2:
+        return None
+    step = (values[-1] - values[0]) / (values.shape[0] - 1)
+    if step == 0 or not np.allclose(np.diff(values), step, rtol=rtol, atol=0):
+        return None
+    return step
+
+
+def lombscargle(times, samples, frequencies, normalize=False):
+    """
+    Lomb-Scargle periodogram, the same as scipy.signal.lombscargle.
+
+    When the times and the angular frequencies are both evenly spaced, the sum of samples * exp(i w t)
+    for every frequency is one chirp-z transform, and the sum of exp(2i w t) a geometric series,
+    so the cost is O((N + M) log(N + M)) rather than O(N M). Otherwise this falls back to scipy.
+    The fast path matches scipy to within 1e-8 of the normalised power.
+    :param times: Sample times
+    :param samples: Samples
+    :param frequencies: Angular frequencies to calculate the periodogram at
+    :param normalize: Normalise the periodogram by the power in the samples, 2 / dot(samples, samples)
+    :return: ndarray of the periodogram at each frequency
+    """
+    times = np.asarray(times, dtype=np.float64)
+    samples = np.asarray(samples, dtype=np.float64)
+    frequencies = np.asarray(frequencies, dtype=np.float64)
+    dt = _even_step(times)
+    dw = _even_step(frequencies)
+    if dt is None or dw is None:
+        return signal.lombscargle(times, samples, frequencies, normalize=normalize)
+
+    n = samples.shape[0]
+    t0 = times[0]
+    # sum(samples * exp(i w t)) for t = t0 + k dt, w = w0 + j dw
+    z = signal.czt(samples, frequencies.shape[0], np.exp(1j * dw * dt), np.exp(-1j * frequencies[0] * dt))
+    z *= np.exp(1j * frequencies * t0)
+
+    # sum(exp(2i w t)), the geometric series (1 - r^n) / (1 - r) with r = exp(2i w dt)
+    r = np.exp(2j * frequencies * dt)
+    whole_turns = np.abs(1 - r) < 1e-12
+    q = np.exp(2j * frequencies * t0) * np.where(whole_turns, n, (1 - r ** n) / np.where(whole_turns, 1, 1 - r))
+
+    # Shifting the times by tau, where tan(2 w tau) = sum(sin(2 w t)) / sum(cos(2 w t)), makes sum(exp(2i w (t - tau)))
+    # real, so sum(cos^2) = (n + |q|) / 2 and sum(sin^2) = (n - |q|) / 2
+    z *= np.exp(-0.5j * np.angle(q))
+    q = np.abs(q)
+    pgram = z.real ** 2 / (n + q) + z.imag ** 2 / (n - q)
+    if normalize:
+        pgram *= 2 / np.dot(samples, samples)
+    return pgram
+
+
+def lombscargle_average(times, samples, frequencies, chunk_samples, normalize=False):
+    """
+    The mean of the Lomb-Scargle periodograms of each whole chunk of the samples
+    :param times: Sample times
+    :param samples: Samples
+    :param frequencies: Angular frequencies to calculate the periodogram at
+    :param chunk_samples: Samples per chunk. Samples after the last whole chunk are left out
+    :param normalize: Normalise each chunk's periodogram by the power in its samples
+    :return: ndarray of the averaged periodogram at each frequency
+    """
+    num_chunks = max(1, samples.shape[0] // chunk_samples)
+    pgram = np.zeros(np.shape(frequencies))
+    for chunk in range(num_chunks):
+        chunk_slice = slice(chunk * chunk_samples, (chunk + 1) * chunk_samples)
+        pgram += lombscargle(times[chunk_slice], samples[chunk_slice], frequencies, normalize)
+    return pgram / num_chunks
+
+
+def _select(channel):
+    return slice(None) if channel is None else channel
+
+
+class Spectra(object):
+    """
+    Spectral views of one or more channels of samples, computed from one shared set of FFTs
+    """
+
+    def __init__(self, samples, sample_rate, nperseg=256, window=('tukey', 0.5), workers=-1):
+        """
+        :param samples: ndarray of X = channels, Y = samples, or a single channel of samples
+        :param sample_rate: Sample rate of the signal
+        :param nperseg: Samples per segment for the segmented views
+        :param window: Window to apply, in any form accepted by scipy.signal.get_window
+        :param workers: Number of threads to split the batches of FFTs across, -1 for all cpus
+        """
+        samples = np.atleast_2d(np.asarray(samples, dtype=np.float64))
+        if samples.shape[1] < nperseg:
+            raise Exception("{0} samples is fewer than a segment of {1}".format(samples.shape[1], nperseg))
+        self.sample_rate = sample_rate
+        self.nperseg = nperseg
+        self.hop = nperseg // 2
+        self.length = samples.shape[1]
+
+        # Segments are views into the samples, so only the windowed copy is made
+        segments = sliding_window_view(samples, nperseg, axis=1)[:, ::self.hop]
+        self.segment_window = signal.get_window(window, nperseg)
+        self.segment_window_fft = fft.rfft(self.segment_window)
+        self.segment_means = segments.mean(axis=2)
+        self.segment_fft = fft.rfft(segments * self.segment_window, axis=2, workers=workers)
+
+        # The FFT of the full length window is needed for detrending, so transform it in the same batch
+        self.window = signal.get_window(window, self.length)
+        self.mean = samples.mean(axis=1)
+        ffts = fft.rfft(np.concatenate((samples * self.window, self.window[np.newaxis])), axis=1, workers=workers)
+        self.fft = ffts[:-1]
+        self.window_fft = ffts[-1]
+
+    @property
+    def num_segments(self):
+        return self.segment_fft.shape[1]
+
+    def segment_frequencies(self):
+        return np.fft.rfftfreq(self.nperseg, 1.0 / self.sample_rate)
+
+    def _segment_density(self, channel, segments=slice(None), detrend=True):
+        ft = self.segment_fft[channel][..., segments, :]
+        if detrend:
+            ft = ft - self.segment_means[channel][..., segments, np.newaxis] * self.segment_window_fft
+        return one_sided_density(ft, self.segment_window, self.sample_rate, self.nperseg)
+
+    def spectrogram(self, channel=None):
+        """
+        As scipy.signal.spectrogram with noverlap = nperseg // 2
+        :param channel: Index of the channel to return, or None for all of them
+        :return: frequencies, segment times, ndarray of [channels], frequencies, times
+        """
+        times = (self.nperseg / 2 + np.arange(self.num_segments) * self.hop) / self.sample_rate
+        return self.segment_frequencies(), times, np.swapaxes(self._segment_density(_select(channel)), -1, -2)
+
+    def welch(self, channel=None):
+        """
+        As scipy.signal.welch
+        :param channel: Index of the channel to return, or None for all of them
+        :return: frequencies, ndarray of [channels], power spectral density
+        """
+        return self.segment_frequencies(), self._segment_density(_select(channel)).mean(axis=-2)
+
+    def psd(self, channel=None):
+        """
+        As matplotlib.mlab.psd, which uses non overlapping segments without detrending
+        :param channel: Index of the channel to return, or None for all of them
+        :return: ndarray of [channels], power spectral density, frequencies
+        """
+        density = self._segment_density(_select(channel), slice(None, None, 2), detrend=False)
+        return density.mean(axis=-2), self.segment_frequencies()
+
+    def asd(self, channel=None):
+        """
+        Amplitude spectral density, the square root of the psd
+        :param channel: Index of the channel to return, or None for all of them
+        :return: ndarray of [channels], amplitude spectral density, frequencies
+        """
+        pxx, f = self.psd(channel)
+        return np.sqrt(pxx, pxx), f
+
+    def periodogram(self, channel=None):
+        """
+        As scipy.signal.periodogram
+        :param channel: Index of the channel to return, or None for all of them
+        :return: frequencies, ndarray of [channels], power spectral density
+        """
+        channel = _select(channel)
+        ft = self.fft[channel] - self.mean[channel][..., np.newaxis] * self.window_fft
+        return np.fft.rfftfreq(self.length, 1.0 / self.sample_rate), \
+            one_sided_density(ft, self.window, self.sample_rate, self.length)
+
+    def rfft(self, channel=None):
+        """
+        :param channel: Index of the channel to return, or None for all of them
+        :return: frequencies, ndarray of [channels], magnitude of the windowed FFT
+        """
+        return np.fft.rfftfreq(self.length, 1.0 / self.sample_rate), np.abs(self.fft[_select(channel)])
+
+    def ifft(self, channel=None):
+        """
+        The imaginary part of the full windowed FFT. The samples are real, so the negative frequencies
+        are the conjugates of the positive ones and come from the same rfft.
+        :param channel: Index of the channel to return, or None for all of them
+        :return: frequencies in np.fft.fftfreq order, ndarray of [channels], imaginary part of the FFT
+        """
+        ft = self.fft[_select(channel)]
+        positive = ft.shape[-1]
+        imag = np.empty(ft.shape[:-1] + (self.length,))
+        imag[..., :positive] = ft.imag
+        imag[..., positive:] = -ft.imag[..., self.length - positive:0:-1]
+        return np.fft.fftfreq(self.length, 1.0 / self.sample_rate), imag
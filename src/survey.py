@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+#
+#    ICRAR - International Centre for Radio Astronomy Research
+#    (c) UWA - The University of Western Australia
+#    Copyright by UWA (in the framework of the ICRAR)
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+
+"""
+Long term RFI occupancy survey of a tree of LBA files.
+
+Every LBA file under a directory is streamed a chunk at a time, and for each fixed time bin of each
+file the power, kurtosis and spectral occupancy of every channel are appended to a HDF5 store. Power
+and kurtosis come from the counts of each sample value. Occupancy is the fraction of frequencies in
+the channel whose spectral kurtosis over the bin is outside sk_sigma standard deviations of that of
+gaussian noise, i.e. the fraction of the band where there is something other than noise.
+
+Files already in the store with the same size and modification time are skipped, so the survey can be
+rerun over a growing archive and only new or changed files are read.
+
+Store layout, one row per time bin:
+    attrs: bin_samples, sample_rate, nperseg, sk_sigma
+    channel_frequencies: (frequencies, 2) MHz range of each frequency channel, from lba.CHANNEL_FREQUENCY_MAP
+    files/path, files/size, files/mtime: one entry per surveyed file
+    files/row_start, files/row_end: the rows of the file's bins
+    bins/file: index into files of each bin
+    bins/time: start of each bin in seconds from the start of its file
+    bins/samples: samples in each bin, fewer than bin_samples for the last bin of a file
+    bins/power, bins/kurtosis, bins/occupancy: (rows, frequencies, polarisations)
+
+python survey.py /data/lba survey.h5 --bin_seconds 1 --processes 4
+"""
+
+import argparse
+import logging
+import os
+import h5py
+import numpy as np
+from jobs import JobQueue
+from lba import CHANNEL_FREQUENCY_MAP, SAMPLE_RATE, LBAFile
+from sample_statistics import SampleStatistics, VALUES
+from spectral import segment_densities
+
+LOG = logging.getLogger(__name__)
+
+# Samples read at a time. A multiple of nperseg, so no segments are lost at chunk boundaries.
+CHUNK_SAMPLES = 1024 * 1024
+
+STATISTICS = ["power", "kurtosis", "occupancy"]
+
+
+def find_lba_files(directory):
+    """
+    :param directory: Directory to search
+    :return: Sorted list of every .lba file under the directory
+    """
+    filenames = []
+    for root, _, files in os.walk(directory):
+        filenames.extend(os.path.join(root, name) for name in files if name.endswith(".lba"))
+    return sorted(filenames)
+
+
+def moments(statistics):
+    """
+    :param statistics: SampleStatistics of each channel
+    :return: Power and kurtosis of each channel
+    """
+    counts = statistics.counts[..., :len(VALUES)].astype(np.float64)
+    values = np.array(VALUES, dtype=np.float64)
+    total = np.maximum(counts.sum(axis=-1), 1)
+    power = (counts * values ** 2).sum(axis=-1) / total
+    mean = (counts * values).sum(axis=-1) / total
+    deviations = values - mean[..., np.newaxis]
+    variance = (counts * deviations ** 2).sum(axis=-1) / total
+    fourth = (counts * deviations ** 4).sum(axis=-1) / total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return power, fourth / variance ** 2
+
+
+def occupancy(power_sum, power_squared_sum, segments, sk_sigma):
+    """
+    The fraction of frequencies whose spectral kurtosis is outside that expected of gaussian noise
+    :param power_sum: Sum over segments of the power at each frequency, X = channels, Y = frequencies
+    :param power_squared_sum: Sum over segments of the squared power at each frequency
+    :param segments: Number of segments summed
+    :param sk_sigma: Number of standard deviations from 1 a frequency's spectral kurtosis must be to be occupied
+    :return: Occupancy of each channel
+    """
+    if segments < 2:
+        return np.full(power_sum.shape[0], np.nan)
+    # The generalised spectral kurtosis estimator, which is 1 with a standard deviation of about sqrt(4 / M) for noise
+    valid = power_sum > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sk = (segments + 1) / (segments - 1) * (segments * power_squared_sum / power_sum ** 2 - 1)
+    occupied = valid & (np.abs(sk - 1) > sk_sigma * np.sqrt(4.0 / segments))
+    return occupied.sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+
+
+class SurveyJob(object):
+    """
+    Survey one LBA file, returning the statistics of each time bin
+    """
+
+    def __init__(self, lba_filename, bin_samples, chunk_samples=CHUNK_SAMPLES, nperseg=256, sk_sigma=3.0):
+        self.lba_filename = lba_filename
+        self.bin_samples = bin_samples
+        self.chunk_samples = chunk_samples
+        self.nperseg = nperseg
+        self.sk_sigma = sk_sigma
+
+    def _survey_bin(self, lba, offset, samples):
+        statistics = None
+        power_sum = power_squared_sum = 0
+        segments = 0
+        for chunk in lba.iter_chunks(self.chunk_samples, offset, samples):
+            if statistics is None:
+                statistics = SampleStatistics(chunk.shape[1:])
+            statistics.add(chunk)
+            if chunk.shape[0] >= self.nperseg:
+                # Unwindowed and without overlap, so the segments' powers are independent as spectral kurtosis expects
+                densities = segment_densities(chunk.reshape(chunk.shape[0], -1).T, SAMPLE_RATE, self.nperseg,
+                                              self.nperseg, 'boxcar')
+                # The DC and nyquist frequencies are real, so their spectral kurtosis isn't that of the others
+                densities = densities[:, :, 1:(self.nperseg + 1) // 2]
+                power_sum = power_sum + densities.sum(axis=1)
+                power_squared_sum = power_squared_sum + (densities ** 2).sum(axis=1)
+                segments += densities.shape[1]
+
+        power, kurtosis = moments(statistics)
+        if segments == 0:
+            occupied = np.full(power.shape, np.nan)
+        else:
+            occupied = occupancy(power_sum, power_squared_sum, segments, self.sk_sigma).reshape(power.shape)
+        return power, kurtosis, occupied
+
+    def __call__(self):
+        LOG.info("Surveying {0}".format(self.lba_filename))
+        with open(self.lba_filename, "r") as f:
+            lba = LBAFile(f)
+            starts = np.arange(0, lba.max_samples, self.bin_samples, dtype=np.int64)
+            samples = np.minimum(lba.max_samples - starts, self.bin_samples)
+            results = [self._survey_bin(lba, start, count) for start, count in zip(starts, samples)]
+
+        columns = {"time": starts / SAMPLE_RATE, "samples": samples}
+        for index, name in enumerate(STATISTICS):
+            columns[name] = np.array([result[index] for result in results], dtype=np.float32)
+        return columns
+
+
+class SurveyStore(object):
+    """
+    HDF5 store of the statistics of each time bin of each surveyed file
+    """
+
+    def __init__(self, filename, bin_samples, nperseg, sk_sigma, mode='a'):
+        """
+        :param filename: HDF5 file to store the survey in
+        :param bin_samples: Samples per time bin
+        :param nperseg: Samples per segment for the spectral kurtosis
+        :param sk_sigma: Standard deviations of spectral kurtosis for a frequency to be occupied
+        :param mode: h5py mode to open the file with
+        """
+        self._file = h5py.File(filename, mode)
+        settings = {"bin_samples": bin_samples, "sample_rate": SAMPLE_RATE, "nperseg": nperseg, "sk_sigma": sk_sigma}
+        if "files" not in self._file:
+            for key, value in settings.items():
+                self._file.attrs[key] = value
+            self._file.create_dataset("channel_frequencies", data=np.array(CHANNEL_FREQUENCY_MAP))
+            files = self._file.create_group("files")
+            files.create_dataset("path", (0,), dtype=h5py.string_dtype(), maxshape=(None,), chunks=True)
+            for name, dtype in [("size", np.int64), ("mtime", np.float64), ("row_start", np.int64), ("row_end", np.int64)]:
+                files.create_dataset(name, (0,), dtype=dtype, maxshape=(None,), chunks=True)
+            self._file.create_group("bins")
+        else:
+            for key, value in settings.items():
+                if self._file.attrs[key] != value:
+                    self._file.close()
+                    raise Exception("{0} was surveyed with {1} = {2}, not {3}".format(filename, key, self._file.attrs[key], value))
+            self._discard_uncommitted()
+
+        files = self._file["files"]
+        # Latest entry of each file
+        self._surveyed = {path: index for index, path in enumerate(files["path"].asstr()[:])}
+
+    def _discard_uncommitted(self):
+        """
+        Remove rows written for a file that was never added to the file list, e.g. if the survey was killed
+        """
+        rows = int(self._file["files/row_end"][-1]) if self._file["files/row_end"].shape[0] > 0 else 0
+        for dataset in self._file["bins"].values():
+            if dataset.shape[0] > rows:
+                LOG.info("Discarding {0} uncommitted rows".format(dataset.shape[0] - rows))
+                dataset.resize(rows, axis=0)
+
+    @property
+    def num_rows(self):
+        return self._file["bins/time"].shape[0] if "time" in self._file["bins"] else 0
+
+    def is_surveyed(self, path, size, mtime):
+        """
+        :return: True if the file has been surveyed since it was last modified
+        """
+        index = self._surveyed.get(path)
+        return index is not None and self._file["files/size"][index] == size and self._file["files/mtime"][index] == mtime
+
+    def append(self, path, size, mtime, columns):
+        """
+        Append the bins of a file. The file is only added to the file list once all of its rows are written.
+        :param path: Path of the file
+        :param size: Size of the file
+        :param mtime: Modification time of the file
+        :param columns: dict of column name to ndarray with a row per bin, as returned by SurveyJob
+        """
+        bins = self._file["bins"]
+        file_index = self._file["files/path"].shape[0]
+        row_start = self.num_rows
+        row_end = row_start + columns["time"].shape[0]
+        columns = dict(columns, file=np.full(columns["time"].shape[0], file_index, dtype=np.int32))
+        for name, column in columns.items():
+            if name not in bins:
+                bins.create_dataset(name, (0,) + column.shape[1:], dtype=column.dtype, maxshape=(None,) + column.shape[1:],
+                                    chunks=(1024,) + column.shape[1:], compression="gzip", shuffle=True)
+            dataset = bins[name]
+            if dataset.shape[1:] != column.shape[1:]:
+                raise Exception("{0} has {1} shape {2}, expected {3}".format(path, name, column.shape[1:], dataset.shape[1:]))
+            dataset.resize(row_end, axis=0)
+            dataset[row_start:] = column
+
+        files = self._file["files"]
+        for name, value in [("size", size), ("mtime", mtime), ("row_start", row_start), ("row_end", row_end), ("path", path)]:
+            files[name].resize(file_index + 1, axis=0)
+            files[name][file_index] = value
+        self._file.flush()
+        self._surveyed[path] = file_index
+
+    def read(self, path):
+        """
+        :param path: Path of a surveyed file
+        :return: dict of column name to ndarray for the bins of the latest survey of the file
+        """
+        index = self._surveyed.get(path)
+        if index is None:
+            raise Exception("{0} hasn't been surveyed".format(path))
+        rows = slice(self._file["files/row_start"][index], self._file["files/row_end"][index])
+        return {name: dataset[rows] for name, dataset in self._file["bins"].items() if name != "file"}
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+
+def survey(directory, output_file, bin_seconds=1.0, chunk_samples=CHUNK_SAMPLES, nperseg=256, sk_sigma=3.0,
+           processes=1, force=False):
+    """
+    Survey every LBA file under a directory that isn't already in the store
+    :param directory: Directory to search for LBA files
+    :param output_file: HDF5 store to append to
+    :param bin_seconds: Length of each time bin
+    :param chunk_samples: Samples to read at a time
+    :param nperseg: Samples per segment for the spectral kurtosis
+    :param sk_sigma: Standard deviations of spectral kurtosis for a frequency to be occupied
+    :param processes: Number of files to survey in parallel
+    :param force: Survey files again even if they're already in the store
+    """
+    bin_samples = int(round(bin_seconds * SAMPLE_RATE))
+    if bin_samples <= 0 or chunk_samples % nperseg != 0:
+        raise Exception("Chunks of {0} samples must be a multiple of nperseg {1}, and bins of {2} samples > 0".format(
+            chunk_samples, nperseg, bin_samples))
+
+    with SurveyStore(output_file, bin_samples, nperseg, sk_sigma) as store:
+        jobs = []
+        for filename in find_lba_files(directory):
+            path = os.path.relpath(filename, directory)
+            stat = os.stat(filename)
+            if not force and store.is_surveyed(path, stat.st_size, stat.st_mtime):
+                LOG.info("Skipping {0}, already surveyed".format(path))
+            else:
+                jobs.append((path, stat, SurveyJob(filename, bin_samples, chunk_samples, nperseg, sk_sigma)))
+
+        def store_result(path, stat, columns):
+            store.append(path, stat.st_size, stat.st_mtime, columns)
+            LOG.info("Surveyed {0}, {1} bins".format(path, columns["time"].shape[0]))
+
+        if processes <= 1 or len(jobs) <= 1:
+            for path, stat, job in jobs:
+                store_result(path, stat, job())
+            return
+
+        failed = []
+        with JobQueue(min(processes, len(jobs))) as queue:
+            futures = [(path, stat, queue.submit(job)) for path, stat, job in jobs]
+            # Store each file in the order they're listed, as soon as it's done
+            for path, stat, future in futures:
+                if future.exception() is None:
+                    store_result(path, stat, future.result())
+                else:
+                    failed.append(path)
+        if failed:
+            raise Exception("Failed to survey {0}".format(", ".join(failed)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Survey the RFI occupancy of every LBA file in a directory tree.")
+    parser.add_argument('directory', type=str, help="Directory to search for LBA files")
+    parser.add_argument('output_file', type=str, help="HDF5 file to add the survey to")
+    parser.add_argument('--bin_seconds', type=float, default=1.0, help="Length of each time bin in seconds")
+    parser.add_argument('--chunk_samples', type=int, default=CHUNK_SAMPLES, help="Number of samples to read at a time")
+    parser.add_argument('--nperseg', type=int, default=256, help="Samples per segment for the spectral kurtosis")
+    parser.add_argument('--sk_sigma', type=float, default=3.0, help="Standard deviations of spectral kurtosis from noise for a frequency to be occupied")
+    parser.add_argument('--processes', type=int, default=1, help="Number of files to survey in parallel")
+    parser.add_argument('--force', action='store_true', help="Survey files again even if they're already in the store")
+    return vars(parser.parse_args())
+
+
+def main():
+    survey(**parse_args())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
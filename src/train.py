@@ -21,19 +21,28 @@
 #    MA 02111-1307  USA
 #
 import logging
+from timeit import default_timer
 
 import numpy as np
 import torch
 import torch.nn.functional as functional
 import torch.optim as optim
-import torch.utils.data as data
 from torch.autograd import Variable
 
 from constants import NUMBER_OF_CLASSES
 from histogram import Histogram
+from utilities import create_data_loader
 
 LOGGER = logging.getLogger(__name__)
 
+# The dtype of the model parameters, and the dtype autocast runs the forward pass in, for each --precision.
+# bfloat16 keeps float32 parameters, as most SGD updates are below bfloat16's resolution and would be lost.
+PRECISIONS = {
+    'float64': (torch.float64, None),
+    'float32': (torch.float32, None),
+    'bfloat16': (torch.float32, torch.bfloat16),
+}
+
 
 def train(model, rfi_data, rank=0, **kwargs):
     # This is needed to "trick" numpy into using different seeds for different processes
@@ -42,37 +51,59 @@ def train(model, rfi_data, rank=0, **kwargs):
     else:
         np.random.seed()
 
-    train_loader = data.DataLoader(
+    batch_loading = not kwargs['per_item_loading']
+    train_loader = create_data_loader(
         rfi_data.get_rfi_dataset('training', rank=rank, short_run_size=kwargs['short_run']),
-        batch_size=kwargs['batch_size'],
-        num_workers=1,
-        pin_memory=kwargs['using_gpu'],
+        kwargs['batch_size'],
+        kwargs['using_gpu'],
+        batch_loading,
     )
-    test_loader = data.DataLoader(
+    test_loader = create_data_loader(
         rfi_data.get_rfi_dataset('validation', rank=rank, short_run_size=kwargs['short_run']),
-        batch_size=kwargs['batch_size'],
-        num_workers=1,
-        pin_memory=kwargs['using_gpu'],
+        kwargs['batch_size'],
+        kwargs['using_gpu'],
+        batch_loading,
     )
 
+    _, autocast_dtype = PRECISIONS[kwargs['precision']]
     optimizer = optim.SGD(model.parameters(), lr=kwargs['learning_rate'], momentum=kwargs['momentum'])
     for epoch in range(1, kwargs['epochs'] + 1):
         # Adjust the learning rate
         adjust_learning_rate(optimizer, epoch, kwargs['learning_rate_decay'], kwargs['start_learning_rate_decay'], kwargs['learning_rate'])
-        train_epoch(epoch, model, train_loader, optimizer, kwargs['log_interval'])
-        test_epoch(model, test_loader, kwargs['log_interval'])
+        train_epoch(epoch, model, train_loader, optimizer, kwargs['log_interval'], autocast_dtype)
+        test_epoch(model, test_loader, kwargs['log_interval'], autocast_dtype)
+
+
+def model_dtype(model):
+    """ The floating point type of a model's parameters """
+    return next(model.parameters()).dtype
+
+
+def forward(model, x_data_raw, autocast_dtype=None):
+    """
+    Run the model, with autocast if autocast_dtype is set
+    :param model: the model
+    :param x_data_raw: the features, in the model's dtype
+    :param autocast_dtype: the dtype to autocast the forward pass to, or None
+    :return: the output on the CPU, in the model's dtype
+    """
+    device_type = 'cuda' if x_data_raw.is_cuda or next(model.parameters()).is_cuda else 'cpu'
+    with torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+        output = model(x_data_raw)
+    # binary_cross_entropy is not autocast safe, so the loss is always in the model's dtype
+    return output.cpu().to(model_dtype(model))
 
 
-def train_epoch(epoch, model, data_loader, optimizer, log_interval):
+def train_epoch(epoch, model, data_loader, optimizer, log_interval, autocast_dtype=None):
     model.train()
+    start = default_timer()
     for batch_idx, (x_data_raw, target) in enumerate(data_loader):
         # x_data_ts = Variable(x_data_ts)
-        x_data_raw = Variable(x_data_raw)
-        target = Variable(target)
+        # The features are float64 or float32, so convert them to the model's dtype
+        x_data_raw = Variable(x_data_raw.to(model_dtype(model)))
+        target = Variable(target.to(model_dtype(model)))
         optimizer.zero_grad()
-        output = model(x_data_raw)
-        if type(output.data) == torch.cuda.DoubleTensor:
-            output = output.cpu()
+        output = forward(model, x_data_raw, autocast_dtype)
         loss = functional.binary_cross_entropy(output, target)
         loss.backward()
         optimizer.step()
@@ -82,8 +113,9 @@ def train_epoch(epoch, model, data_loader, optimizer, log_interval):
                 batch_idx * len(x_data_raw),
                 len(data_loader.dataset),
                 100. * batch_idx / len(data_loader),
-                loss.data[0])
+                loss.item())
             )
+    LOGGER.info('Train Epoch: {}, {:.2f} batches/second'.format(epoch, len(data_loader) / (default_timer() - start)))
 
 
 def build_histogram(output, target_column, histogram_data):
@@ -92,7 +124,7 @@ def build_histogram(output, target_column, histogram_data):
         histogram_data[column].append(values[column])
 
 
-def test_epoch(model, data_loader, log_interval):
+def test_epoch(model, data_loader, log_interval, autocast_dtype=None):
     model.eval()
     test_loss = 0
     correct = 0
@@ -100,12 +132,10 @@ def test_epoch(model, data_loader, log_interval):
     histogram_data['all'] = []
     for batch_index, (x_data_raw, target) in enumerate(data_loader):
         # x_data_ts = Variable(x_data_ts, volatile=True)
-        x_data_raw = Variable(x_data_raw, volatile=True)
-        target = Variable(target)
-        output = model(x_data_raw)
-        if type(output.data) == torch.cuda.DoubleTensor:
-            output = output.cpu()
-        test_loss += functional.binary_cross_entropy(output, target).data[0]
+        x_data_raw = Variable(x_data_raw.to(model_dtype(model)), volatile=True)
+        target = Variable(target.to(model_dtype(model)))
+        output = forward(model, x_data_raw, autocast_dtype)
+        test_loss += functional.binary_cross_entropy(output, target).item()
         pred = output.data.max(1)[1]
         target_column = target.data.max(1)[1]
         correct += pred.eq(target_column).sum()
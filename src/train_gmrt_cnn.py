@@ -30,41 +30,40 @@ import torch
 import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as functional
-import torch.utils.data as data
 
 from constants import NUMBER_CHANNELS, NUMBER_OF_CLASSES
-from train import test_epoch, train
-from utilities import RfiData, Timer, build_data
+from train import PRECISIONS, test_epoch, train
+from utilities import DATA_SOURCES, RfiData, Timer, build_data, build_features, create_data_loader
 
 LOGGER = logging.getLogger(__name__)
 HIDDEN_LAYERS = 200
 
 
 class GmrtCNN(nn.Module):
-    def __init__(self, keep_probability):
+    def __init__(self, keep_probability, dtype=torch.float64):
         super(GmrtCNN, self).__init__()
         self.keep_probability = keep_probability
         self.conv1 = nn.Conv1d(NUMBER_CHANNELS, 50, kernel_size=3, stride=1)
-        self.conv1.double()     # Force the Conv1d to use a double
+        self.conv1.to(dtype)     # Force the Conv1d to use the training precision
         self.max_pool1 = nn.MaxPool1d(2, stride=2)
         self.conv2 = nn.Conv1d(50, 100, kernel_size=2, stride=1)
-        self.conv2.double()     # Force the Conv1d to use a double
+        self.conv2.to(dtype)     # Force the Conv1d to use the training precision
         self.max_pool2 = nn.MaxPool1d(2, stride=2)
         self.conv3 = nn.Conv1d(100, 200, kernel_size=1, stride=1)
-        self.conv3.double()     # Force the Conv1d to use a double
+        self.conv3.to(dtype)     # Force the Conv1d to use the training precision
         self.max_pool3 = nn.MaxPool1d(2, stride=1)
         self.fc1a = nn.Linear(600, 300)
-        self.fc1a.double()       # Force the layer to a double
+        self.fc1a.to(dtype)       # Force the layer to use the training precision
         self.fc1b = nn.Linear(300, 10)
-        self.fc1b.double()       # Force the layer to a double
+        self.fc1b.to(dtype)       # Force the layer to use the training precision
 
         self.fc2 = nn.Linear(18, 2048)
         self.fc2 = nn.Linear(8, 2048)
-        self.fc2.double()       # Force the layer to use a double
+        self.fc2.to(dtype)       # Force the layer to use the training precision
         self.fc3 = nn.Linear(2048, 1024)
-        self.fc3.double()       # Force the layer to use a double
+        self.fc3.to(dtype)       # Force the layer to use the training precision
         self.fc4 = nn.Linear(1024, NUMBER_OF_CLASSES)
-        self.fc4.double()       # Force the layer to use a double
+        self.fc4.to(dtype)       # Force the layer to use the training precision
 
     def forward(self, input_data_ts, input_data_values):
         x = self.max_pool1(functional.relu(self.conv1(input_data_ts)))
@@ -85,17 +84,17 @@ class GmrtCNN(nn.Module):
 
 
 class GmrtLinear(nn.Module):
-    def __init__(self, keep_probability, sequence_length):
+    def __init__(self, keep_probability, sequence_length, dtype=torch.float64):
         super(GmrtLinear, self).__init__()
         self.keep_probability = keep_probability
         self.input_layer_length = 6 + (sequence_length * 7)
 
-        self.fc1 = nn.Linear(self.input_layer_length, HIDDEN_LAYERS).double()
-        self.fc2 = nn.Linear(HIDDEN_LAYERS + self.input_layer_length, HIDDEN_LAYERS).double()
-        self.fc3 = nn.Linear(HIDDEN_LAYERS, HIDDEN_LAYERS).double()
-        self.fc4 = nn.Linear(HIDDEN_LAYERS, HIDDEN_LAYERS).double()
-        self.fc5 = nn.Linear(HIDDEN_LAYERS, HIDDEN_LAYERS).double()
-        self.fc6 = nn.Linear(HIDDEN_LAYERS, NUMBER_OF_CLASSES).double()
+        self.fc1 = nn.Linear(self.input_layer_length, HIDDEN_LAYERS).to(dtype)
+        self.fc2 = nn.Linear(HIDDEN_LAYERS + self.input_layer_length, HIDDEN_LAYERS).to(dtype)
+        self.fc3 = nn.Linear(HIDDEN_LAYERS, HIDDEN_LAYERS).to(dtype)
+        self.fc4 = nn.Linear(HIDDEN_LAYERS, HIDDEN_LAYERS).to(dtype)
+        self.fc5 = nn.Linear(HIDDEN_LAYERS, HIDDEN_LAYERS).to(dtype)
+        self.fc6 = nn.Linear(HIDDEN_LAYERS, NUMBER_OF_CLASSES).to(dtype)
 
     def forward(self, input_data_values):
         x = functional.leaky_relu(self.fc1(input_data_values))
@@ -124,6 +123,7 @@ def main():
     parser.add_argument('--use-gpu', action='store_true', default=False, help='use the GPU if it is available')
     parser.add_argument('--data-path', default='./data', help='the path to the data file')
     parser.add_argument('--data-file', default='data.h5', help='the name of the data file')
+    parser.add_argument('--data-sources', nargs='+', default=DATA_SOURCES, help='the simulations to train on, each optionally followed by :<rfi label>')
     parser.add_argument('--sequence-length', type=int, default=10, help='how many elements in a sequence')
     parser.add_argument('--validation-percentage', type=int, default=10, help='amount of data used for validation')
     parser.add_argument('--training-percentage', type=int, default=80, help='amount of data used for training')
@@ -132,6 +132,8 @@ def main():
     parser.add_argument('--start-learning-rate-decay', type=int, default=5, help='the epoch to start applying the LRD')
     parser.add_argument('--short_run', type=int, default=None, help='use a short run of the test data')
     parser.add_argument('--save', type=str,  default=None, help='path to save the final model')
+    parser.add_argument('--precision', choices=sorted(PRECISIONS), default='float64', help='the floating point type to train in (default: float64)')
+    parser.add_argument('--per-item-loading', action='store_true', default=False, help='load and collate each item of a batch separately, rather than the whole batch at once')
 
     kwargs = vars(parser.parse_args())
     LOGGER.debug(kwargs)
@@ -154,13 +156,14 @@ def main():
     # Do this first so all the data is built before we go parallel and get race conditions
     with Timer('Checking/Building data file'):
         build_data(**kwargs)
+        build_features(**kwargs)
 
     rfi_data = RfiData(**kwargs)
 
     if kwargs['using_gpu']:
         # The DataParallel will distribute the model to all the available GPUs
         # model = nn.DataParallel(GmrtCNN(kwargs['keep_probability'])).cuda()
-        model = nn.DataParallel(GmrtLinear(kwargs['keep_probability'], kwargs['sequence_length'])).cuda()
+        model = nn.DataParallel(GmrtLinear(kwargs['keep_probability'], kwargs['sequence_length'], PRECISIONS[kwargs['precision']][0])).cuda()
 
         # Train
         train(model, rfi_data, **kwargs)
@@ -168,7 +171,7 @@ def main():
     else:
         # This uses the HOGWILD! approach to lock free SGD
         # model = GmrtCNN(kwargs['keep_probability'])
-        model = GmrtLinear(kwargs['keep_probability'], kwargs['sequence_length'])
+        model = GmrtLinear(kwargs['keep_probability'], kwargs['sequence_length'], PRECISIONS[kwargs['precision']][0])
         model.share_memory()  # gradients are allocated lazily, so they are not shared here
 
         processes = []
@@ -180,14 +183,14 @@ def main():
             p.join()
 
     with Timer('Reading final test data'):
-        test_loader = data.DataLoader(
+        test_loader = create_data_loader(
             rfi_data.get_rfi_dataset('test', short_run_size=kwargs['short_run']),
-            batch_size=kwargs['batch_size'],
-            num_workers=1,
-            pin_memory=kwargs['using_gpu'],
+            kwargs['batch_size'],
+            kwargs['using_gpu'],
+            not kwargs['per_item_loading'],
         )
     with Timer('Final test'):
-        test_epoch(model, test_loader, kwargs['log_interval'])
+        test_epoch(model, test_loader, kwargs['log_interval'], PRECISIONS[kwargs['precision']][1])
 
     if kwargs['save'] is not None:
         with Timer('Saving model'):
@@ -25,7 +25,10 @@
 """
 from __future__ import print_function
 
+import hashlib
+import json
 import logging
+import mmap
 import os
 from os import makedirs
 from os.path import exists
@@ -33,32 +36,117 @@ from timeit import default_timer
 
 import h5py
 import numpy as np
-import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
 from astropy.utils.console import human_time
 from statsmodels.robust import scale
-from torch.utils.data import Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 
 from constants import NUMBER_CHANNELS, NUMBER_OF_CLASSES, H5_VERSION
+from jobs import JobQueue
 
 LOGGER = logging.getLogger(__name__)
 
+# Windows to calculate the statistics of at a time when precomputing features
+CHUNK_WINDOWS = 1024 * 1024
+
+# The dtype of the features and labels for each training precision. numpy has no bfloat16,
+# so those are float32, the dtype of the parameters autocast runs them against.
+FEATURE_DTYPES = {
+    'float64': np.float64,
+    'float32': np.float32,
+    'bfloat16': np.float32,
+}
+
+# Rows copied at a time when assembling the training data from the ingested sources
+CHUNK_ROWS = 1024 * 1024
+
+# Approximate size of each HDF5 chunk of the resizable ingested datasets
+CHUNK_BYTES = 1024 * 1024
+
+# The simulations to train on, each a <source>.txt of data and <source>_loc.txt of labels.
+# A source can end in :<label> to use that label for its RFI instead of 1.
+DATA_SOURCES = [
+    '../data/GMRT/impulsive_broadband_simulation_random_5p',
+    '../data/GMRT/impulsive_broadband_simulation_random_10p',
+    '../data/GMRT/repetitive_rfi_timeseries',
+    '../data/GMRT/repetitive_rfi_random_timeseries',
+    # '../data/GMRT/impulsive_broadband_simulation_random_norfi:0',
+]
+
 
 class H5Exception(Exception):
     pass
 
 
-class RfiData(object):
+class MappedArray(object):
+    """ The file, offset, dtype and shape of a read only memmap, to open it again in another process """
+    def __init__(self, array):
+        self.filename = array.filename
+        self.offset = array.offset
+        self.dtype = array.dtype
+        self.shape = array.shape
+
+    def open(self):
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape)
+
+
+class MemmapPickling(object):
+    """
+    Pickles the memmaps of an object as references to their files rather than copies of their data,
+    so unpickling it in another process maps the same file and shares the same page cache
+    """
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key, value in state.items():
+            # Only whole mappings, which know their own offset and shape. Views of them are copied.
+            if isinstance(value, np.memmap) and isinstance(value.base, mmap.mmap) and value.mode == 'r':
+                state[key] = MappedArray(value)
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            if isinstance(value, MappedArray):
+                state[key] = value.open()
+        self.__dict__.update(state)
+
+
+def open_array(filename, h5_file, name):
+    """
+    Open a dataset of a HDF5 file as a read only memmap, so it isn't read until it is used and every process
+    using it shares one copy. Chunked or compressed datasets can't be mapped, so they are read into memory.
+    :param filename: The HDF5 file
+    :param h5_file: The open HDF5 file
+    :param name: Name of the dataset
+    :return: ndarray of the dataset
+    """
+    dataset = h5_file[name]
+    offset = dataset.id.get_offset()
+    if dataset.chunks is None and dataset.compression is None and offset is not None and dataset.size > 0:
+        return np.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+    LOGGER.info('{0} in {1} is chunked or compressed, reading it into memory'.format(name, filename))
+    return np.copy(dataset)
+
+
+class RfiData(MemmapPickling):
     def __init__(self, **kwargs):
         self._sequence_length = kwargs['sequence_length']
         self._num_processes = kwargs['num_processes']
         self._using_gpu = kwargs['using_gpu']
+        self._dtype = FEATURE_DTYPES[kwargs['precision']]
         output_file = os.path.join(kwargs['data_path'], kwargs['data_file'])
         with h5py.File(output_file, 'r') as h5_file:
-            data_group = h5_file['data']
-
-            # Move the data into memory
-            self._data_channel_0 = np.copy(data_group['data_channel_0'])
-            self._labels = np.copy(data_group['labels'])
+            # Map the data rather than reading it, so all the training processes share it
+            self._data_channel_0 = open_array(output_file, h5_file, 'data/data_channel_0')
+            self._labels = open_array(output_file, h5_file, 'data/labels')
+
+            features_group = h5_file.get(features_group_name(self._sequence_length))
+            if features_group is not None:
+                self._global_statistics = np.copy(features_group.attrs['global_statistics'])
+                self._window_statistics = open_array(output_file, h5_file, features_group.name + '/window_statistics')
+            else:
+                LOGGER.info('No precomputed features for sequence length {0}, calculating them'.format(self._sequence_length))
+                self._global_statistics = global_statistics(self._data_channel_0)
+                self._window_statistics = window_statistics(self._data_channel_0, self._sequence_length)
 
             length_data = len(self._labels) - kwargs['sequence_length']
             split_point1 = int(length_data * kwargs['training_percentage'] / 100.)
@@ -85,7 +173,7 @@ class RfiData(object):
             if short_run_size is not None:
                 sequence = sequence[0:short_run_size]
         else:
-            section_length = len(sequence) / self._num_processes
+            section_length = len(sequence) // self._num_processes
             start = rank * section_length
             if rank == self._num_processes - 1:
                 if short_run_size is not None:
@@ -98,45 +186,141 @@ class RfiData(object):
                 else:
                     sequence = sequence[start:start + section_length]
 
-        return RfiDataset(sequence, self._data_channel_0, self._labels, self._sequence_length)
-
-
-class RfiDataset(Dataset):
-    def __init__(self, selection_order, x_data, y_data, sequence_length):
+        return RfiDataset(sequence, self._data_channel_0, self._labels, self._sequence_length,
+                          self._global_statistics, self._window_statistics, self._dtype)
+
+
+def features_group_name(sequence_length):
+    """ The group in the data file holding the precomputed features for a sequence length """
+    return 'features_{0}'.format(sequence_length)
+
+
+def global_statistics(x_data):
+    """ The median, median absolute deviation and mean of all the data """
+    return np.array([np.median(x_data), scale.mad(x_data, c=1), np.mean(x_data)])
+
+
+def window_statistics(x_data, sequence_length, out=None, chunk_windows=CHUNK_WINDOWS):
+    """
+    The median, median absolute deviation and mean of every window of sequence_length elements,
+    calculated a chunk of windows at a time from sliding window views of the data
+    :param x_data: The data
+    :param sequence_length: Elements in each window
+    :param out: Array or HDF5 dataset to write the statistics to, instead of a new array
+    :param chunk_windows: Number of windows to calculate at a time
+    :return: X = window start, Y = (median, median absolute deviation, mean)
+    """
+    num_windows = max(len(x_data) - sequence_length + 1, 0)
+    if out is None:
+        out = np.empty((num_windows, 3))
+    for start in range(0, num_windows, chunk_windows):
+        end = min(start + chunk_windows, num_windows)
+        windows = sliding_window_view(x_data[start:end + sequence_length - 1], sequence_length)
+        statistics = np.empty((end - start, 3))
+        statistics[:, 0] = np.median(windows, axis=1)
+        statistics[:, 1] = np.median(np.abs(windows - statistics[:, 0:1]), axis=1)
+        statistics[:, 2] = np.mean(windows, axis=1)
+        out[start:end] = statistics
+    return out
+
+
+def window_features(x_data, starts, sequence_length, global_stats, window_stats, dtype=np.float64):
+    """
+    Builds the features of a batch of windows with a few array operations, rather than per element
+    :param x_data: The data
+    :param starts: ndarray of the start of each window
+    :param sequence_length: Elements in each window
+    :param global_stats: (median, median absolute deviation, mean) of all the data
+    :param window_stats: (median, median absolute deviation, mean) of every window, as from window_statistics
+    :param dtype: dtype of the features. They are calculated in float64 and rounded once.
+    :return: ndarray of X = windows, Y = 6 + 7 * sequence_length features
+    """
+    windows = x_data[starts[:, np.newaxis] + np.arange(sequence_length)]
+    median, median_absolute_deviation, mean = global_stats
+    local = window_stats[starts]
+    local_median = local[:, 0:1]
+    local_median_absolute_deviation = local[:, 1:2]
+    local_mean = local[:, 2:3]
+
+    values = np.empty((len(starts), sequence_length, 7), dtype=dtype)
+    values[:, :, 0] = windows
+    values[:, :, 1] = windows - mean
+    values[:, :, 2] = windows - median
+    values[:, :, 3] = windows - median_absolute_deviation
+    values[:, :, 4] = windows - local_mean
+    values[:, :, 5] = windows - local_median
+    values[:, :, 6] = windows - local_median_absolute_deviation
+
+    statistics = np.empty((len(starts), 6), dtype=dtype)
+    statistics[:, 0:3] = global_stats
+    statistics[:, 3:6] = local
+    return np.concatenate((statistics, values.reshape(len(starts), -1)), axis=1)
+
+
+class RfiDataset(MemmapPickling, Dataset):
+    def __init__(self, selection_order, x_data, y_data, sequence_length, global_stats=None, window_stats=None, dtype=np.float64):
         self._x_data = x_data
         self._y_data = y_data
         self._selection_order = selection_order
         self._length = len(selection_order)
         self._sequence_length = sequence_length
-        self._actual_node = self._sequence_length / 2
-        self._median = np.median(x_data)
-        self._median_absolute_deviation = scale.mad(x_data, c=1)
-        self._mean = np.mean(x_data)
+        self._actual_node = self._sequence_length // 2
+        self._dtype = dtype
+        self._global_statistics = global_statistics(x_data) if global_stats is None else global_stats
+        self._window_statistics = window_statistics(x_data, sequence_length) if window_stats is None else window_stats
         LOGGER.debug('Length: {}'.format(self._length))
 
     def __len__(self):
         return self._length
 
+    def get_batch(self, indexes):
+        """
+        Gets the features and labels of many items at once
+        :param indexes: ndarray of item indexes
+        :return: ndarray of X = items, Y = features, and ndarray of the items' one hot labels
+        """
+        starts = self._selection_order[indexes]
+        data = window_features(self._x_data, starts, self._sequence_length, self._global_statistics, self._window_statistics, self._dtype)
+        # The labels are stored as class indexes, and only expanded for the batch
+        return data, one_hot(self._y_data[starts + self._actual_node], NUMBER_OF_CLASSES, self._dtype)
+
     def __getitem__(self, index):
-        selection_index = self._selection_order[index]
-        x_data = self._x_data[selection_index:selection_index + self._sequence_length]
-        local_median = np.median(x_data)
-        local_median_absolute_deviation = scale.mad(x_data, c=1)
-        local_mean = np.mean(x_data)
-        # x_data_last = x_data[self._actual_node]
-
-        data = [self._median, self._median_absolute_deviation, self._mean, local_median, local_median_absolute_deviation, local_mean]
-        for item in x_data:
-            data.append(item)
-            data.append(item - self._mean)
-            data.append(item - self._median)
-            data.append(item - self._median_absolute_deviation)
-            data.append(item - local_mean)
-            data.append(item - local_median)
-            data.append(item - local_median_absolute_deviation)
-
-        # return np.reshape(x_data, (NUMBER_CHANNELS, -1)), values, self._y_data[selection_index + self._actual_node]
-        return np.array(data), self._y_data[selection_index + self._actual_node]
+        if isinstance(index, np.ndarray):
+            # A whole batch from a BatchIndexSampler
+            return self.get_batch(index)
+        data, labels = self.get_batch(np.array([index]))
+        return data[0], labels[0]
+
+
+class BatchIndexSampler(Sampler):
+    """
+    Samples an ndarray of the indexes in each batch, so a DataLoader with batch_size=None gets each
+    batch from RfiDataset with one __getitem__ call rather than one per item
+    """
+    def __init__(self, length, batch_size):
+        self._length = length
+        self._batch_size = batch_size
+
+    def __iter__(self):
+        for start in range(0, self._length, self._batch_size):
+            yield np.arange(start, min(start + self._batch_size, self._length))
+
+    def __len__(self):
+        return -(-self._length // self._batch_size)
+
+
+def create_data_loader(dataset, batch_size, using_gpu, batch_loading=True):
+    """
+    Create a DataLoader for a RfiDataset
+    :param dataset: RfiDataset to load
+    :param batch_size: Items per batch
+    :param using_gpu: Pin the batches in memory for copying to the GPU
+    :param batch_loading: Load each batch with one vectorised __getitem__, otherwise load and collate each item
+    :return: DataLoader
+    """
+    if batch_loading:
+        return DataLoader(dataset, batch_size=None, sampler=BatchIndexSampler(len(dataset), batch_size), num_workers=1, pin_memory=using_gpu)
+    return DataLoader(dataset, batch_size=batch_size, num_workers=1, pin_memory=using_gpu)
 
 
 def process_files(filename, rfi_label):
@@ -151,14 +335,12 @@ def process_files(filename, rfi_label):
         LOGGER.error('The line counts do not match for: {0}'.format(filename))
         return
 
-    # Load the files into numpy
+    # Load the files into numpy. loadtxt parses in C, and the values are read row by row as they are in the file
     LOGGER.info('Loading: {}'.format(files_to_process[0]))
-    data_frame = pd.read_csv(files_to_process[0], header=None, delimiter=' ')
-    data = data_frame.values.flatten()
+    data = np.loadtxt(files_to_process[0], ndmin=1).ravel()
 
     LOGGER.info('Loading: {}'.format(files_to_process[1]))
-    data_frame = pd.read_csv(files_to_process[1], header=None, delimiter=' ')
-    labels = data_frame.values.flatten()
+    labels = np.loadtxt(files_to_process[1], dtype=np.int64, ndmin=1).ravel()
 
     # Check the lengths match
     assert len(data) == len(labels), 'The line counts do not match for: {0}'.format(filename)
@@ -167,49 +349,221 @@ def process_files(filename, rfi_label):
     if rfi_label != 1:
         labels[labels == 1] = rfi_label
 
-    return data, labels
+    # Stored as one byte class indexes
+    assert np.all((labels >= 0) & (labels < NUMBER_OF_CLASSES)), 'Labels out of range for: {0}'.format(filename)
+    return data, labels.astype(np.uint8)
+
+
+def parse_source(source):
+    """ Split a source into its filename and RFI label """
+    filename, separator, label = source.rpartition(':')
+    if separator and label.isdigit():
+        return filename, int(label)
+    return source, 1
+
+
+def file_hash(path):
+    """ The SHA1 of a file's contents """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def source_files(filename, hashes=True):
+    """ The manifest entries of a source's data and labels files """
+    files = []
+    for ending in ['.txt', '_loc.txt']:
+        path = filename + ending
+        stat = os.stat(path)
+        files.append({'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': file_hash(path) if hashes else None})
+    return files
+
+
+def source_unchanged(entry):
+    """
+    True if a source's files are the same as when it was ingested.
+    Sources whose files can't be found are kept, so training can run from the data file without the text files.
+    """
+    try:
+        current = source_files(entry['filename'], hashes=False)
+    except OSError as exception:
+        LOGGER.warning('Cannot check {0} ({1}), keeping the rows already ingested from it'.format(entry['filename'], exception))
+        return True
+    for recorded, now in zip(entry['files'], current):
+        if recorded['size'] != now['size']:
+            return False
+        # Only hash when the modification time says it might have changed, e.g. a copy or touch
+        if recorded['mtime'] != now['mtime']:
+            if recorded['sha1'] != file_hash(now['path']):
+                return False
+            recorded['mtime'] = now['mtime']
+    return True
+
+
+def ingest_source(source):
+    """ Parse a source in a worker process """
+    filename, rfi_label = source
+    files = source_files(filename)
+    data, labels = process_files(filename, rfi_label)
+    return {'filename': filename, 'rfi_label': rfi_label, 'files': files}, data, labels
+
+
+def _append_rows(group, name, array):
+    if name not in group:
+        # Size the chunks by the width of a row, so a narrow dataset's chunks aren't far bigger than a wide one's
+        row_bytes = max(1, array.dtype.itemsize * int(np.prod(array.shape[1:])))
+        chunk_rows = max(1, CHUNK_BYTES // row_bytes)
+        group.create_dataset(name, (0,) + array.shape[1:], dtype=array.dtype, maxshape=(None,) + array.shape[1:], chunks=(chunk_rows,) + array.shape[1:])
+    dataset = group[name]
+    start = dataset.shape[0]
+    dataset.resize(start + array.shape[0], axis=0)
+    dataset[start:] = array
+
+
+def _copy_rows(source, group, name, ranges):
+    """ Append ranges of rows from one dataset to a resizable one, a chunk at a time """
+    for start, end in ranges:
+        for chunk_start in range(start, end, CHUNK_ROWS):
+            _append_rows(group, name, source[chunk_start:min(chunk_start + CHUNK_ROWS, end)])
+
+
+def ingest_sources(h5_file, sources, num_processes):
+    """
+    Bring the ingested sources in the file up to date with a list of sources. Sources that are already
+    ingested and unchanged are kept, and only new or changed sources are parsed, in parallel.
+    The new sources' rows are appended to resizable datasets in the order of sources, as soon as the
+    source and those before it have been parsed, and recorded in the manifest once they're written.
+    :param h5_file: The open data file
+    :param sources: list of (filename, rfi label) of the sources to ingest
+    :param num_processes: Number of sources to parse at a time
+    :return: The manifest, a list of the ingested sources with their files and rows
+    """
+    ingest = h5_file.require_group('ingest')
+    manifest = json.loads(ingest.attrs.get('manifest', '[]'))
+    rows = manifest[-1]['end'] if manifest else 0
+
+    # Rows past the end of the manifest are from an interrupted ingest
+    for dataset in ingest.values():
+        if dataset.shape[0] > rows:
+            dataset.resize(rows, axis=0)
+
+    keep = [entry for entry in manifest if (entry['filename'], entry['rfi_label']) in sources and source_unchanged(entry)]
+    if len(keep) != len(manifest):
+        # Copy the rows of the sources that are kept to new datasets, leaving out the rest
+        LOGGER.info('Removing {0} sources from {1}'.format(len(manifest) - len(keep), h5_file.filename))
+        for name in [name for name in ingest.keys() if not name.endswith('_kept')]:
+            if name + '_kept' in ingest:
+                # Left by an interrupted copy
+                del ingest[name + '_kept']
+            _append_rows(ingest, name + '_kept', ingest[name][0:0])
+            _copy_rows(ingest[name], ingest, name + '_kept', [(entry['start'], entry['end']) for entry in keep])
+            del ingest[name]
+            ingest.move(name + '_kept', name)
+        rows = 0
+        for entry in keep:
+            entry['start'], entry['end'] = rows, rows + entry['end'] - entry['start']
+            rows = entry['end']
+    manifest = keep
+    ingest.attrs['manifest'] = json.dumps(manifest)
+
+    ingested = {(entry['filename'], entry['rfi_label']) for entry in manifest}
+    new_sources = [source for source in dict.fromkeys(sources) if source not in ingested]
+    if new_sources:
+        with JobQueue(max(1, min(num_processes, len(new_sources)))) as queue:
+            parsed = {}
+            next_source = 0
+            for result in queue.imap_unordered(ingest_source, new_sources):
+                parsed[(result[0]['filename'], result[0]['rfi_label'])] = result
+                # Append in the order of sources, so the rows are laid out the same on every run
+                while next_source < len(new_sources) and new_sources[next_source] in parsed:
+                    entry, data, labels = parsed.pop(new_sources[next_source])
+                    next_source += 1
+                    _append_rows(ingest, 'data_channel_0', data)
+                    _append_rows(ingest, 'labels', labels)
+                    entry['start'], entry['end'] = rows, rows + len(data)
+                    rows = entry['end']
+                    manifest.append(entry)
+                    ingest.attrs['manifest'] = json.dumps(manifest)
+                    h5_file.flush()
+                    LOGGER.info('Ingested {0}, {1} rows'.format(entry['filename'], len(data)))
+    return manifest
 
 
 def build_data(**kwargs):
     """ Read data """
     output_file = os.path.join(kwargs['data_path'], kwargs['data_file'])
-    if os.path.exists(output_file):
+    sources = [parse_source(source) for source in kwargs['data_sources']]
+    if not exists(kwargs['data_path']):
+        makedirs(kwargs['data_path'])
+
+    version = None
+    if exists(output_file):
         with h5py.File(output_file, 'r') as h5_file:
-            # Everything matches
-            if 'version' in h5_file.attrs and h5_file.attrs['version'] == H5_VERSION:
-                # All good nothing to do
-                return
-
-    # Open the output files
-    with Timer('Processing input files'):
-        data1, labels1 = process_files('../data/GMRT/impulsive_broadband_simulation_random_5p', 1)
-        data2, labels2 = process_files('../data/GMRT/impulsive_broadband_simulation_random_10p', 1)
-        data3, labels3 = process_files('../data/GMRT/repetitive_rfi_timeseries', 1)
-        data4, labels4 = process_files('../data/GMRT/repetitive_rfi_random_timeseries', 1)
-        # data0, labels0 = process_files('../data/GMRT/impulsive_broadband_simulation_random_norfi', 0)
-
-    # Concatenate
-    with Timer('Concatenating data'):
-        labels = np.concatenate((labels1, labels2, labels3, labels4))
-        data = np.concatenate((data1, data2, data3, data4))
-
-    # Standardise and one hot
-    with Timer('Standardise & One hot'):
-        labels = one_hot(labels, NUMBER_OF_CLASSES)
-        # data = normalize(data)
-
-    with Timer('Saving to {0}'.format(output_file)):
-        if not exists(kwargs['data_path']):
-            makedirs(kwargs['data_path'])
-        with h5py.File(output_file, 'w') as h5_file:
+            version = h5_file.attrs.get('version')
+
+    # Start again if the file has a different layout
+    with h5py.File(output_file, 'a' if version == H5_VERSION else 'w') as h5_file:
+        if version != H5_VERSION:
             h5_file.attrs['number_channels'] = NUMBER_CHANNELS
             h5_file.attrs['number_classes'] = NUMBER_OF_CLASSES
             h5_file.attrs['version'] = H5_VERSION
 
+        with Timer('Ingesting input files'):
+            manifest = ingest_sources(h5_file, sources, kwargs['num_processes'])
+        # The training data is in the order of the sources, wherever each one is in the ingested rows
+        order = {source: index for index, source in enumerate(sources)}
+        manifest = sorted(manifest, key=lambda entry: order[(entry['filename'], entry['rfi_label'])])
+        rows = json.dumps([[entry['filename'], entry['rfi_label'], entry['start'], entry['end']] for entry in manifest])
+        if 'data' in h5_file and h5_file['data'].attrs.get('rows') == rows:
+            # All good nothing to do
+            return
+
+        # The training data is one contiguous copy of the ingested rows, so RfiData can map it
+        ingest = h5_file['ingest']
+        length_data = sum(entry['end'] - entry['start'] for entry in manifest)
+        with Timer('Saving to {0}'.format(output_file)):
+            for name in list(h5_file.keys()):
+                if name == 'data' or name.startswith(features_group_name('')):
+                    del h5_file[name]
             data_group = h5_file.create_group('data')
-            data_group.attrs['length_data'] = len(data)
-            data_group.create_dataset('data_channel_0', data=data, compression='gzip')
-            data_group.create_dataset('labels', data=labels, compression='gzip')
+            data_group.attrs['length_data'] = length_data
+            data_group.create_dataset('data_channel_0', (length_data,), dtype=np.float64)
+            data_group.create_dataset('labels', (length_data,), dtype=np.uint8)
+            position = 0
+            for entry in manifest:
+                for start in range(entry['start'], entry['end'], CHUNK_ROWS):
+                    end = min(start + CHUNK_ROWS, entry['end'])
+                    data_group['data_channel_0'][position:position + end - start] = ingest['data_channel_0'][start:end]
+                    data_group['labels'][position:position + end - start] = ingest['labels'][start:end]
+                    position += end - start
+            # Written last, so an interrupted copy is redone
+            data_group.attrs['rows'] = rows
+
+
+def build_features(**kwargs):
+    """ Precompute the statistics of every window for the sequence length, and cache them in the data file """
+    output_file = os.path.join(kwargs['data_path'], kwargs['data_file'])
+    group_name = features_group_name(kwargs['sequence_length'])
+    with h5py.File(output_file, 'a') as h5_file:
+        # The group is written last, so if it's there it's complete. build_data replaces the whole file.
+        if group_name in h5_file:
+            return
+
+        if group_name + '_building' in h5_file:
+            # Left by an interrupted build
+            del h5_file[group_name + '_building']
+
+        x_data = open_array(output_file, h5_file, 'data/data_channel_0')
+        with Timer('Precomputing features for sequence length {0}'.format(kwargs['sequence_length'])):
+            num_windows = max(len(x_data) - kwargs['sequence_length'] + 1, 0)
+            building = h5_file.create_group(group_name + '_building')
+            building.attrs['global_statistics'] = global_statistics(x_data)
+            # Contiguous, so RfiData can map it
+            dataset = building.create_dataset('window_statistics', (num_windows, 3), dtype=np.float64)
+            window_statistics(x_data, kwargs['sequence_length'], dataset)
+            h5_file.move(group_name + '_building', group_name)
 
 
 def get_h5_file(args):
@@ -233,10 +587,10 @@ def normalize(all_data):
     return (all_data - min_value) / (max_value - min_value)
 
 
-def one_hot(labels, number_class):
+def one_hot(labels, number_class, dtype=np.float64):
     """ One-hot encoding """
-    expansion = np.eye(number_class)
-    y = expansion[:, labels].T
+    expansion = np.eye(number_class, dtype=dtype)
+    y = expansion[labels]
     assert y.shape[1] == number_class, "Wrong number of labels!"
 
     return y